@@ -1,28 +1,36 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import websocket
+from PIL import Image, ImageOps
+import numpy as np
 import os
 import json
 import re
+import hashlib
+import sqlite3
 import subprocess
+import tempfile
 from datetime import datetime
 import uuid
 import threading
 import random
+import queue
+import math
 import time
 import copy
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, as_completed
 from pathlib import Path
+from urllib.parse import urlencode, urlsplit
 
 app = Flask(__name__)
 CORS(app)
 
-# 全局任务存储和线程锁
-generation_tasks = {}
-task_lock = threading.Lock()
-
 # ComfyUI 并发控制
 comfyui_lock = threading.Lock()
 
@@ -40,7 +48,15 @@ DEFAULT_COMFYUI_CONFIG = {
     'timeout_seconds': 180,
     'max_attempts': 2,
     'seed': -1,
-    'workflow_path': ''
+    'workflow_path': '',
+    'use_websocket': True,
+    'pipeline': True,         # 提前把 prompt 排进 ComfyUI 队列，下载图片时不占用队列名额
+    'batch_size': 1,          # >1 时把提示词相同的请求合并为一个 batch_size=N 的 workflow
+    'batch_window_ms': 200,   # 合并时等待相同请求的最长时间
+    # 多台渲染服务器：[{url, weight, queue_size, enabled}]，为空时只使用 server_url
+    'servers': [],
+    'probe_interval': 5,      # /queue 与 /system_stats 探测结果的缓存秒数
+    'unhealthy_cooldown': 30  # 服务器连接失败后暂停分配的秒数
 }
 
 # 预设的视觉模板，用于构建提示词
@@ -136,12 +152,46 @@ def get_comfyui_settings(config):
     merged['enabled'] = bool(merged.get('enabled', DEFAULT_COMFYUI_CONFIG['enabled']))
     merged['seed'] = int(merged.get('seed', DEFAULT_COMFYUI_CONFIG['seed']))
     merged['workflow_path'] = merged.get('workflow_path', DEFAULT_COMFYUI_CONFIG['workflow_path'])
+    merged['use_websocket'] = bool(merged.get('use_websocket', DEFAULT_COMFYUI_CONFIG['use_websocket']))
+    merged['pipeline'] = bool(merged.get('pipeline', DEFAULT_COMFYUI_CONFIG['pipeline']))
+    merged['batch_size'] = max(1, int(merged.get('batch_size', DEFAULT_COMFYUI_CONFIG['batch_size'])))
+    merged['batch_window_ms'] = max(0, int(merged.get('batch_window_ms', DEFAULT_COMFYUI_CONFIG['batch_window_ms'])))
+    merged['probe_interval'] = max(1, int(merged.get('probe_interval', DEFAULT_COMFYUI_CONFIG['probe_interval'])))
+    merged['unhealthy_cooldown'] = max(1, int(merged.get('unhealthy_cooldown', DEFAULT_COMFYUI_CONFIG['unhealthy_cooldown'])))
+    merged['servers'] = get_comfyui_servers(merged)
     return merged
 
+def get_comfyui_servers(settings):
+    """规范化服务器列表；未配置 servers 时以 server_url + queue_size 作为唯一服务器"""
+    servers = []
+    for item in settings.get('servers') or []:
+        if isinstance(item, str):
+            item = {'url': item}
+        if not isinstance(item, dict) or not item.get('url'):
+            continue
+        servers.append({
+            'url': str(item['url']).rstrip('/'),
+            'weight': max(0.1, float(item.get('weight', 1) or 1)),
+            'queue_size': max(1, int(item.get('queue_size', settings.get('queue_size', DEFAULT_COMFYUI_CONFIG['queue_size'])))),
+            'enabled': bool(item.get('enabled', True))
+        })
+    if not servers:
+        servers.append({
+            'url': (settings.get('server_url') or DEFAULT_COMFYUI_CONFIG['server_url']).rstrip('/'),
+            'weight': 1.0,
+            'queue_size': max(1, int(settings.get('queue_size', DEFAULT_COMFYUI_CONFIG['queue_size']))),
+            'enabled': True
+        })
+    return servers
+
+def get_comfyui_total_queue_size(settings):
+    """所有启用服务器的队列深度之和"""
+    return sum(server['queue_size'] for server in settings['servers'] if server['enabled']) or 1
+
 def update_comfyui_runtime(config):
     """根据配置更新并发控制等运行时参数"""
     settings = get_comfyui_settings(config)
-    queue_size = settings.get('queue_size', DEFAULT_COMFYUI_CONFIG['queue_size'])
+    queue_size = get_comfyui_total_queue_size(settings)
     with comfyui_lock:
         if queue_size != comfyui_runtime['queue_size']:
             comfyui_runtime['semaphore'] = threading.BoundedSemaphore(queue_size)
@@ -149,34 +199,2676 @@ def update_comfyui_runtime(config):
         comfyui_runtime['config'] = settings
     return settings
 
+# 默认的文章流式生成配置
+DEFAULT_ARTICLE_STREAM_CONFIG = {
+    'enabled': True,
+    'connect_timeout': 10,
+    'inactivity_timeout': 60
+}
+
+def get_article_stream_settings(config):
+    """合并默认流式生成配置和用户配置"""
+    merged = DEFAULT_ARTICLE_STREAM_CONFIG.copy()
+    user_cfg = (config or {}).get('article_streaming') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['connect_timeout'] = max(1, int(merged.get('connect_timeout', DEFAULT_ARTICLE_STREAM_CONFIG['connect_timeout'])))
+    merged['inactivity_timeout'] = max(5, int(merged.get('inactivity_timeout', DEFAULT_ARTICLE_STREAM_CONFIG['inactivity_timeout'])))
+    return merged
+
+# 默认的 HTTP 客户端配置：按主机区分超时与重试策略
+DEFAULT_HTTP_CLIENT_CONFIG = {
+    'pool_maxsize': 0,  # 0 表示根据 max_concurrent_tasks 自动计算
+    'default': {
+        'connect_timeout': 10,
+        'read_timeout': 30,
+        'retries': 2,
+        'backoff_factor': 0.5
+    },
+    'hosts': {
+        'dashscope.aliyuncs.com': {'connect_timeout': 10, 'read_timeout': 180, 'retries': 1, 'backoff_factor': 1.0},
+        'api.unsplash.com': {'connect_timeout': 5, 'read_timeout': 10, 'retries': 2, 'backoff_factor': 0.5},
+        'images.unsplash.com': {'connect_timeout': 5, 'read_timeout': 10, 'retries': 2, 'backoff_factor': 0.5},
+        'api.pexels.com': {'connect_timeout': 5, 'read_timeout': 10, 'retries': 2, 'backoff_factor': 0.5},
+        'images.pexels.com': {'connect_timeout': 5, 'read_timeout': 10, 'retries': 2, 'backoff_factor': 0.5},
+        'pixabay.com': {'connect_timeout': 5, 'read_timeout': 10, 'retries': 2, 'backoff_factor': 0.5}
+    }
+}
+
+# HTTP 连接池运行时：每个主机一个 Session，复用 keep-alive 连接
+http_client_lock = threading.Lock()
+http_client_runtime = {
+    'sessions': {},
+    'pool_maxsize': 10,
+    'settings': copy.deepcopy(DEFAULT_HTTP_CLIENT_CONFIG),
+    'stats': {}
+}
+
+def get_http_client_settings(config):
+    """合并默认 HTTP 客户端配置和用户配置"""
+    merged = copy.deepcopy(DEFAULT_HTTP_CLIENT_CONFIG)
+    user_cfg = (config or {}).get('http_client_settings') or {}
+
+    if user_cfg.get('pool_maxsize') is not None:
+        merged['pool_maxsize'] = max(0, int(user_cfg['pool_maxsize']))
+    merged['default'].update(user_cfg.get('default') or {})
+    for host, profile in (user_cfg.get('hosts') or {}).items():
+        merged['hosts'].setdefault(host.lower(), {}).update(profile or {})
+
+    # 计算连接池大小：每个并发任务可能同时进行文本和多张图片请求
+    if not merged['pool_maxsize']:
+        max_tasks = int((config or {}).get('max_concurrent_tasks', 3) or 3)
+        merged['pool_maxsize'] = max(4, max_tasks * 2)
+    return merged
+
+def _get_host_profile(host, settings):
+    """获取指定主机的超时与重试配置"""
+    profile = dict(settings['default'])
+    profile.update(settings['hosts'].get(host, {}))
+    return profile
+
+def _build_http_session(host, settings, pool_maxsize):
+    """为指定主机创建带连接池和重试策略的 Session"""
+    profile = _get_host_profile(host, settings)
+    retries = int(profile.get('retries', 0))
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        backoff_factor=float(profile.get('backoff_factor', 0.5)),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def update_http_client_runtime(config):
+    """根据配置更新连接池大小和主机策略，变更时重建 Session"""
+    settings = get_http_client_settings(config)
+    with http_client_lock:
+        if (settings['pool_maxsize'] != http_client_runtime['pool_maxsize']
+                or settings != http_client_runtime['settings']):
+            # 旧 Session 上可能仍有进行中的请求，交给垃圾回收关闭
+            http_client_runtime['sessions'] = {}
+        http_client_runtime['pool_maxsize'] = settings['pool_maxsize']
+        http_client_runtime['settings'] = settings
+    return settings
+
+def get_http_session(url):
+    """获取目标主机对应的共享 Session"""
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    key = f'{parts.scheme}://{parts.netloc.lower()}'
+    with http_client_lock:
+        session = http_client_runtime['sessions'].get(key)
+        if session is None:
+            session = _build_http_session(host, http_client_runtime['settings'], http_client_runtime['pool_maxsize'])
+            http_client_runtime['sessions'][key] = session
+        profile = _get_host_profile(host, http_client_runtime['settings'])
+    return key, session, profile
+
+def http_request(method, url, **kwargs):
+    """通过共享连接池发送请求，未指定 timeout 时使用主机默认超时"""
+    key, session, profile = get_http_session(url)
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = (profile.get('connect_timeout', 10), profile.get('read_timeout', 30))
+
+    with http_client_lock:
+        stats = http_client_runtime['stats'].setdefault(key, {'requests': 0, 'errors': 0})
+        stats['requests'] += 1
+    try:
+        return session.request(method, url, **kwargs)
+    except requests.RequestException:
+        with http_client_lock:
+            http_client_runtime['stats'][key]['errors'] += 1
+        raise
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http_request('POST', url, **kwargs)
+
+def get_http_client_stats():
+    """汇总各主机的请求数、新建连接数和连接复用数"""
+    with http_client_lock:
+        sessions = dict(http_client_runtime['sessions'])
+        stats = {key: dict(value) for key, value in http_client_runtime['stats'].items()}
+        pool_maxsize = http_client_runtime['pool_maxsize']
+
+    hosts = {}
+    for key, host_stats in stats.items():
+        new_connections = 0
+        pooled_requests = 0
+        session = sessions.get(key)
+        if session is not None:
+            adapter = session.get_adapter(key + '/')
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    new_connections += pool.num_connections
+                    pooled_requests += pool.num_requests
+        hosts[key] = {
+            'requests': host_stats['requests'],
+            'errors': host_stats['errors'],
+            'new_connections': new_connections,
+            'reused_connections': max(0, pooled_requests - new_connections)
+        }
+
+    return {
+        'pool_maxsize': pool_maxsize,
+        'hosts': hosts,
+        'total_requests': sum(h['requests'] for h in hosts.values()),
+        'total_new_connections': sum(h['new_connections'] for h in hosts.values()),
+        'total_reused_connections': sum(h['reused_connections'] for h in hosts.values())
+    }
+
+# 默认的图片下载配置
+DEFAULT_IMAGE_DOWNLOAD_CONFIG = {
+    'max_size_mb': 30,
+    'chunk_size_kb': 256
+}
+
+IMAGE_CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': 'jpg', 'image/jpg': 'jpg', 'image/png': 'png', 'image/gif': 'gif',
+    'image/webp': 'webp', 'image/bmp': 'bmp', 'image/x-ms-bmp': 'bmp'
+}
+
+class ImageDownloadError(Exception):
+    """下载的内容不是图片或超过大小限制时抛出"""
+
+def get_image_download_settings(config):
+    """合并默认图片下载配置和用户配置"""
+    merged = DEFAULT_IMAGE_DOWNLOAD_CONFIG.copy()
+    user_cfg = (config or {}).get('image_download_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['max_size_mb'] = max(1, int(merged.get('max_size_mb') or DEFAULT_IMAGE_DOWNLOAD_CONFIG['max_size_mb']))
+    merged['chunk_size_kb'] = max(16, int(merged.get('chunk_size_kb') or DEFAULT_IMAGE_DOWNLOAD_CONFIG['chunk_size_kb']))
+    return merged
+
+def _sniff_image_extension(head):
+    """根据文件头判断图片格式，无法识别时返回 None"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+def download_image_to_file(url, target_dir=None, target_path=None, filename_prefix='image', config=None, **request_kwargs):
+    """流式下载图片：分块写入同目录临时文件，边下载边计算 sha256，完成后原子重命名
+
+    Content-Type 必须为 image/*；类型缺失或为 application/octet-stream 时按文件头判断。
+    超过 max_size_mb 时中止下载并删除临时文件。
+
+    Args:
+        target_dir: 保存目录，文件名按 {filename_prefix}_{时间}_{随机}.{扩展名} 生成
+        target_path: 指定完整保存路径（优先于 target_dir）
+        request_kwargs: 透传给 http_get 的参数（params、headers、timeout 等）
+    Returns:
+        {'path', 'sha256', 'size', 'content_type'}
+    """
+    settings = get_image_download_settings(config)
+    max_bytes = settings['max_size_mb'] * 1024 * 1024
+    chunk_size = settings['chunk_size_kb'] * 1024
+
+    with http_get(url, stream=True, **request_kwargs) as response:
+        response.raise_for_status()
+        content_type = (response.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if content_type and not content_type.startswith('image/') and content_type != 'application/octet-stream':
+            raise ImageDownloadError(f'URL 不是有效的图片 (Content-Type: {content_type})')
+        declared_length = response.headers.get('Content-Length')
+        if declared_length and declared_length.isdigit() and int(declared_length) > max_bytes:
+            raise ImageDownloadError(f'图片超过大小限制 ({int(declared_length) // 1024 // 1024} MB > {settings["max_size_mb"]} MB)')
+
+        save_dir = os.path.dirname(target_path) if target_path else (target_dir or '.')
+        os.makedirs(save_dir or '.', exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        ext = IMAGE_CONTENT_TYPE_EXTENSIONS.get(content_type)
+        fd, temp_path = tempfile.mkstemp(dir=save_dir or '.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if not chunk:
+                        continue
+                    if size == 0 and not ext:
+                        ext = _sniff_image_extension(chunk[:16])
+                        if not ext:
+                            raise ImageDownloadError('下载内容不是可识别的图片格式')
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ImageDownloadError(f'图片超过大小限制 ({settings["max_size_mb"]} MB)')
+                    digest.update(chunk)
+                    f.write(chunk)
+            if size == 0:
+                raise ImageDownloadError('下载的图片为空')
+
+            if not target_path:
+                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+                target_path = os.path.join(save_dir, f'{filename_prefix}_{timestamp}_{uuid.uuid4().hex[:8]}.{ext or "jpg"}')
+            os.replace(temp_path, target_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    return {
+        'path': target_path,
+        'sha256': digest.hexdigest(),
+        'size': size,
+        'content_type': content_type or f'image/{ext}'
+    }
+
+# 默认的内容寻址图片仓库配置：下载/生成的图片按 sha256 存放，URL→哈希索引避免重复下载
+DEFAULT_IMAGE_STORE_CONFIG = {
+    'enabled': True,
+    'path': os.path.join('cache', 'images'),
+    'url_ttl_hours': 24 * 7,     # URL 索引有效期，过期后重新下载
+    'retain_hours': 24,          # 引用归零后保留的时间，便于重试和其他主题复用
+    'stale_ref_hours': 72        # 超过该时间仍未释放的引用视为泄漏（文章中途失败等）
+}
+
+IMAGE_STORE_GC_INTERVAL = 600
+
+# 图片仓库运行时：索引库共享一个 SQLite 连接，由锁串行化访问；inflight 合并同一 URL 的并发下载
+image_store_lock = threading.Lock()
+image_store_runtime = {
+    'settings': DEFAULT_IMAGE_STORE_CONFIG.copy(),
+    'conn': None,
+    'conn_path': None,
+    'inflight': {},
+    'last_gc': 0,
+    'stats': {'url_hits': 0, 'downloads': 0, 'dedup_hits': 0, 'released': 0, 'collected': 0}
+}
+
+def get_image_store_settings(config):
+    """合并默认图片仓库配置和用户配置"""
+    merged = DEFAULT_IMAGE_STORE_CONFIG.copy()
+    user_cfg = (config or {}).get('image_store_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['path'] = merged.get('path') or DEFAULT_IMAGE_STORE_CONFIG['path']
+    for key in ('url_ttl_hours', 'retain_hours', 'stale_ref_hours'):
+        merged[key] = max(0, float(merged.get(key, DEFAULT_IMAGE_STORE_CONFIG[key])))
+    return merged
+
+def update_image_store_runtime(config):
+    """根据配置更新图片仓库参数，路径变化时在下次访问时重新打开索引库"""
+    settings = get_image_store_settings(config)
+    with image_store_lock:
+        image_store_runtime['settings'] = settings
+    return settings
+
+def _get_image_store_conn():
+    """获取（必要时创建）图片索引库连接，调用方需持有 image_store_lock"""
+    root = image_store_runtime['settings']['path']
+    path = os.path.join(root, 'index.sqlite3')
+    if image_store_runtime['conn'] is not None and image_store_runtime['conn_path'] == path:
+        return image_store_runtime['conn']
+    if image_store_runtime['conn'] is not None:
+        image_store_runtime['conn'].close()
+
+    os.makedirs(root, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            content_type TEXT,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            keep INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # 旧版本仓库没有 keep 字段（生成的图片不参与清理）
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(images)')}
+    if 'keep' not in columns:
+        conn.execute('ALTER TABLE images ADD COLUMN keep INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_urls (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_path ON images(path)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_last_used ON images(last_used)')
+    conn.commit()
+    image_store_runtime['conn'] = conn
+    image_store_runtime['conn_path'] = path
+    return conn
+
+def is_image_store_path(path):
+    """判断路径是否位于图片仓库内"""
+    if not path:
+        return False
+    root = os.path.abspath(image_store_runtime['settings']['path'])
+    return os.path.abspath(path).startswith(root + os.sep)
+
+def _image_store_lookup_url(url):
+    """按 URL 索引查找已下载的图片，命中时增加一次引用并返回路径，调用方需持有 image_store_lock"""
+    settings = image_store_runtime['settings']
+    conn = _get_image_store_conn()
+    row = conn.execute(
+        'SELECT i.sha256, i.path, u.fetched_at FROM image_urls u JOIN images i ON i.sha256 = u.sha256 WHERE u.url = ?',
+        (url,)
+    ).fetchone()
+    now = time.time()
+    if not row:
+        return None
+    if (settings['url_ttl_hours'] and now - row[2] > settings['url_ttl_hours'] * 3600) or not os.path.exists(row[1]):
+        conn.execute('DELETE FROM image_urls WHERE url = ?', (url,))
+        conn.commit()
+        return None
+    conn.execute('UPDATE images SET refcount = refcount + 1, last_used = ? WHERE sha256 = ?', (now, row[0]))
+    conn.commit()
+    image_store_runtime['stats']['url_hits'] += 1
+    return row[1]
+
+def _image_store_ingest(downloaded, url=None, keep=False):
+    """把暂存区中下载完成的文件移入 <root>/<sha256[:2]>/<sha256>.<ext>，内容相同则复用已有文件
+
+    每次入库都为调用方增加一次引用；keep 的图片（如 ComfyUI 生成的图片）永不被清理。
+    调用方需持有 image_store_lock。
+    """
+    conn = _get_image_store_conn()
+    digest = downloaded['sha256']
+    now = time.time()
+    row = conn.execute('SELECT path FROM images WHERE sha256 = ?', (digest,)).fetchone()
+    if row and os.path.exists(row[0]):
+        os.remove(downloaded['path'])
+        path = row[0]
+        conn.execute(
+            'UPDATE images SET refcount = refcount + 1, last_used = ?, keep = MAX(keep, ?) WHERE sha256 = ?',
+            (now, int(keep), digest)
+        )
+        image_store_runtime['stats']['dedup_hits'] += 1
+    else:
+        ext = os.path.splitext(downloaded['path'])[1] or '.jpg'
+        path = os.path.join(image_store_runtime['settings']['path'], digest[:2], f'{digest}{ext}')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(downloaded['path'], path)
+        conn.execute(
+            'INSERT OR REPLACE INTO images (sha256, path, size, content_type, refcount, created_at, last_used, keep) VALUES (?, ?, ?, ?, 1, ?, ?, ?)',
+            (digest, path, downloaded['size'], downloaded['content_type'], now, now, int(keep))
+        )
+    if url:
+        conn.execute('INSERT OR REPLACE INTO image_urls (url, sha256, fetched_at) VALUES (?, ?, ?)', (url, digest, now))
+    conn.commit()
+    return path
+
+def fetch_image_to_store(url, config=None, filename_prefix='temp', index_url=True, keep=False, **request_kwargs):
+    """下载图片到内容寻址仓库并返回本地路径，同时为调用方持有一次引用
+
+    同一 URL 在索引有效期内直接复用已有文件，并发请求同一 URL 时只下载一次；
+    内容相同的不同 URL 也只保存一份。文档生成完成后需调用 release_image_refs 释放引用。
+    仓库关闭时退化为在输出目录保存 {filename_prefix}_*.ext 临时文件。
+
+    Args:
+        index_url: 是否记录 URL→哈希索引；URL 不能唯一标识内容时（如 ComfyUI 的 /view）应关闭
+        keep: 永久保留该图片，不随引用归零被清理（生成的图片无法重新下载）
+        request_kwargs: 透传给 download_image_to_file 的参数
+    """
+    settings = image_store_runtime['settings']
+    if not settings['enabled']:
+        output_dir = (config or {}).get('output_directory', 'output')
+        return download_image_to_file(url, target_dir=output_dir, filename_prefix=filename_prefix, config=config, **request_kwargs)['path']
+
+    params = request_kwargs.get('params')
+    url_key = f'{url}?{urlencode(sorted(params.items()))}' if index_url and params else (url if index_url else None)
+
+    while True:
+        with image_store_lock:
+            if url_key:
+                path = _image_store_lookup_url(url_key)
+                if path:
+                    return path
+                waiter = image_store_runtime['inflight'].get(url_key)
+                if waiter is None:
+                    waiter = threading.Event()
+                    image_store_runtime['inflight'][url_key] = waiter
+                    break
+            else:
+                waiter = None
+                break
+        # 其他线程正在下载同一 URL，等待其完成后重新查索引
+        waiter.wait(timeout=60)
+
+    try:
+        staging_dir = os.path.join(settings['path'], 'staging')
+        downloaded = download_image_to_file(url, target_dir=staging_dir, filename_prefix='part', config=config, **request_kwargs)
+        with image_store_lock:
+            image_store_runtime['stats']['downloads'] += 1
+            return _image_store_ingest(downloaded, url=url_key, keep=keep)
+    finally:
+        if waiter is not None:
+            with image_store_lock:
+                image_store_runtime['inflight'].pop(url_key, None)
+            waiter.set()
+
+def release_image_refs(paths):
+    """释放文档对仓库内图片的引用，仓库外的路径忽略；引用归零的文件在保留期后由清理任务删除"""
+    store_paths = [path for path in paths or [] if is_image_store_path(path)]
+    if not store_paths:
+        return 0
+    with image_store_lock:
+        conn = _get_image_store_conn()
+        now = time.time()
+        for path in store_paths:
+            conn.execute(
+                'UPDATE images SET refcount = MAX(refcount - 1, 0), last_used = ? WHERE path = ?',
+                (now, path)
+            )
+        conn.commit()
+        image_store_runtime['stats']['released'] += len(store_paths)
+        due = now - image_store_runtime['last_gc'] >= IMAGE_STORE_GC_INTERVAL
+    if due:
+        collect_image_store()
+    return len(store_paths)
+
+def collect_image_store(force=False):
+    """删除无引用且超过保留期的图片，以及引用长期未释放的泄漏条目；keep 的图片不会被删除
+
+    Args:
+        force: 忽略保留期，立即删除所有无引用的图片
+    Returns:
+        删除的图片数量
+    """
+    with image_store_lock:
+        settings = image_store_runtime['settings']
+        conn = _get_image_store_conn()
+        now = time.time()
+        image_store_runtime['last_gc'] = now
+        retain_before = now if force else now - settings['retain_hours'] * 3600
+        stale_before = now - settings['stale_ref_hours'] * 3600
+        rows = conn.execute(
+            'SELECT sha256, path FROM images WHERE keep = 0 AND ((refcount <= 0 AND last_used <= ?) OR (refcount > 0 AND last_used < ?))',
+            (retain_before, stale_before)
+        ).fetchall()
+        for digest, path in rows:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"删除仓库图片失败 {path}: {e}")
+                continue
+            conn.execute('DELETE FROM images WHERE sha256 = ?', (digest,))
+        conn.execute('DELETE FROM image_urls WHERE sha256 NOT IN (SELECT sha256 FROM images)')
+        conn.commit()
+        image_store_runtime['stats']['collected'] += len(rows)
+    return len(rows)
+
+def get_image_store_stats():
+    """返回图片仓库的复用情况和容量信息"""
+    with image_store_lock:
+        stats = dict(image_store_runtime['stats'])
+        settings = dict(image_store_runtime['settings'])
+        images, referenced, total_size, urls = 0, 0, 0, 0
+        if settings['enabled']:
+            conn = _get_image_store_conn()
+            images, referenced, total_size = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(refcount > 0), 0), COALESCE(SUM(size), 0) FROM images'
+            ).fetchone()
+            urls = conn.execute('SELECT COUNT(*) FROM image_urls').fetchone()[0]
+    fetches = stats['url_hits'] + stats['downloads']
+    stats.update({
+        'images': images,
+        'referenced': referenced,
+        'urls': urls,
+        'size_bytes': total_size,
+        'reuse_rate': round((stats['url_hits'] + stats['dedup_hits']) / fetches, 4) if fetches else 0,
+        'settings': settings
+    })
+    return stats
+
+# 默认的本地图库索引配置：启动时加载持久化索引并与磁盘对账，后台线程按目录 mtime 轮询增量更新
+DEFAULT_LOCAL_IMAGE_INDEX_CONFIG = {
+    'enabled': True,
+    'path': os.path.join('cache', 'local_images.sqlite3'),
+    'poll_interval': 10,            # 检查目录 mtime 的间隔（秒）
+    'full_rescan_interval': 600,    # 全量对账间隔（秒），用于发现原地覆盖等不改变目录 mtime 的修改
+    'enrich_batch': 200,            # 每轮后台补全尺寸和 sha256 的文件数
+    'semantic': True,               # 按 TF-IDF 相似度匹配段落摘要/关键词，关闭时只按标签精确匹配
+    'min_score': 0.1,               # 最高相似度低于该值时回退到标签匹配
+    'top_k': 5                      # 在相似度最高的若干张中加权随机选择，避免总是同一张
+}
+
+# 说明文件（sidecar）扩展名：图片 a.jpg 可配 a.txt 或 a.jpg.txt 描述画面内容
+LOCAL_IMAGE_CAPTION_EXTENSION = '.txt'
+# 语义匹配中各字段的权重：目录标签最可靠，其次是人工写的说明文件，文件名最弱
+LOCAL_IMAGE_FIELD_WEIGHTS = {'tags': 2.0, 'caption': 1.5, 'filename': 1.0}
+MATCHING_STOPWORDS = {
+    'the', 'and', 'of', 'to', 'in', 'on', 'for', 'with', 'at', 'by', 'from', 'an', 'is', 'are', 'was',
+    'be', 'as', 'its', 'it', 'this', 'that', 'or', 'into', 'over', 'under', 'high', 'quality', 'detailed'
+}
+
+def get_local_image_index_settings(config):
+    """合并默认本地图库索引配置和用户配置"""
+    merged = DEFAULT_LOCAL_IMAGE_INDEX_CONFIG.copy()
+    user_cfg = (config or {}).get('local_image_index_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['path'] = merged.get('path') or DEFAULT_LOCAL_IMAGE_INDEX_CONFIG['path']
+    merged['poll_interval'] = max(1, int(merged.get('poll_interval') or DEFAULT_LOCAL_IMAGE_INDEX_CONFIG['poll_interval']))
+    merged['full_rescan_interval'] = max(merged['poll_interval'], int(merged.get('full_rescan_interval') or DEFAULT_LOCAL_IMAGE_INDEX_CONFIG['full_rescan_interval']))
+    merged['enrich_batch'] = max(1, int(merged.get('enrich_batch') or DEFAULT_LOCAL_IMAGE_INDEX_CONFIG['enrich_batch']))
+    merged['semantic'] = bool(merged.get('semantic', True))
+    merged['min_score'] = max(0.0, float(merged.get('min_score', DEFAULT_LOCAL_IMAGE_INDEX_CONFIG['min_score'])))
+    merged['top_k'] = max(1, int(merged.get('top_k') or DEFAULT_LOCAL_IMAGE_INDEX_CONFIG['top_k']))
+    return merged
+
+def _normalize_local_image_directories(config):
+    """规范化 local_image_directories：标签统一小写，weight 默认为 1"""
+    directories = []
+    for dir_config in (config or {}).get('local_image_directories', [{'path': 'pic', 'tags': ['default']}]):
+        path = dir_config.get('path', '')
+        if not path:
+            continue
+        directories.append({
+            'path': path,
+            'tags': [str(tag).strip().lower() for tag in dir_config.get('tags', []) if str(tag).strip()],
+            'weight': max(0.0, float(dir_config.get('weight', 1) or 0))
+        })
+    return directories
+
+def _filename_tags(filename):
+    """从文件名提取标签，例如 mountain_lake-01.jpg -> ['mountain', 'lake']"""
+    stem = os.path.splitext(filename)[0].lower()
+    return [word for word in re.findall(r'[^\W\d_]+', stem) if len(word) >= 2]
+
+def tokenize_for_matching(text):
+    """匹配用分词：英文单词（去停用词、简单去复数）+ 中文连续字符的二元组
+
+    例如 "Misty mountains 山间云海" -> ['misty', 'mountain', '山间', '间云', '云海']
+    """
+    text = (text or '').lower()
+    tokens = []
+    for word in re.findall(r'[a-z][a-z0-9]+', text):
+        if word in MATCHING_STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    for run in re.findall(r'[\u4e00-\u9fff]+', text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def _image_caption_path(directory, filename, names):
+    """在目录文件名集合中查找图片的说明文件，返回路径或 None"""
+    for caption_name in (filename + LOCAL_IMAGE_CAPTION_EXTENSION, os.path.splitext(filename)[0] + LOCAL_IMAGE_CAPTION_EXTENSION):
+        if caption_name in names:
+            return os.path.join(directory, caption_name)
+    return None
+
+def _read_image_caption(caption_path):
+    """读取说明文件内容（最多 4000 字符）"""
+    try:
+        with open(caption_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read(4000).strip()
+    except OSError:
+        return ''
+
+def _weighted_choice_with_recent_use(candidates, weights, task_id=None):
+    """按 权重 × 近期使用系数 随机选择并记录使用；系数全为 0（都在本批次用过）时退回原权重
+
+    权重为 0 的候选（如 weight 为 0 的目录）永不选中，没有正权重候选时返回 None。
+    """
+    pairs = [(candidate, weight) for candidate, weight in zip(candidates, weights) if weight > 0]
+    if not pairs:
+        return None
+    candidates = [candidate for candidate, _ in pairs]
+    weights = [weight for _, weight in pairs]
+    adjusted = [weight * factor for weight, factor in zip(weights, recent_image_ledger.weights(candidates, task_id))]
+    if any(adjusted):
+        weights = adjusted
+    choice = random.choices(candidates, weights=weights)[0]
+    recent_image_ledger.record(choice, task_id)
+    return choice
+
+class LocalImageIndex:
+    """本地图库索引
+
+    内存中维护 路径→元数据 与 标签→路径 的倒排表；文件元数据（大小、mtime、尺寸、sha256、
+    说明文件内容）持久化到 SQLite，重启后只需 stat 对账，未变化的文件不再读取。标签由所在目录的
+    配置标签和文件名中的单词组成，随配置即时重建，不落盘。
+
+    语义匹配：由标签、文件名和说明文件计算每张图片的 TF-IDF 向量（L2 归一化），按词项存成
+    稀疏的倒排列（NumPy 数组），查询时对查询中的每个词做一次向量化累加即得到全部图片的余弦相似度。
+    索引变化后向量由后台线程在锁外重建，重建期间查询继续使用旧向量。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self.settings = DEFAULT_LOCAL_IMAGE_INDEX_CONFIG.copy()
+        self.directories = []
+        self.images = {}       # 路径 -> 元数据
+        self.tag_index = {}    # 标签 -> 路径集合
+        self.dir_mtimes = {}   # 目录 -> 上次扫描时的 mtime_ns
+        self.pending = OrderedDict()  # 待补全尺寸和 sha256 的路径
+        self.vectors = None           # 语义匹配用的 TF-IDF 倒排列
+        self.vectors_dirty = True
+        self.vectors_generation = 0   # 每次开始重建时递增，避免较旧的结果覆盖较新的结果
+        self.vectors_discarded = 0    # 不超过该值的重建基于已丢弃的目录配置
+        self.conn = None
+        self.conn_path = None
+        self.ready = False
+        self.last_full_scan = 0
+        self.thread = None
+        self.stats = {
+            'scans': 0, 'added': 0, 'removed': 0, 'updated': 0, 'enriched': 0, 'queries': 0,
+            'semantic_hits': 0, 'semantic_misses': 0, 'vector_builds': 0
+        }
+
+    def _get_conn(self):
+        """获取（必要时创建）索引数据库连接，调用方需持有 self._lock"""
+        path = self.settings['path']
+        if self.conn is not None and self.conn_path == path:
+            return self.conn
+        if self.conn is not None:
+            self.conn.close()
+        index_dir = os.path.dirname(path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS local_images (
+                path TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                sha256 TEXT,
+                caption TEXT,
+                caption_mtime_ns INTEGER
+            )
+        ''')
+        # 旧版本索引库没有说明文件字段
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(local_images)')}
+        for column, column_type in (('caption', 'TEXT'), ('caption_mtime_ns', 'INTEGER')):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE local_images ADD COLUMN {column} {column_type}')
+        conn.commit()
+        self.conn = conn
+        self.conn_path = path
+        return conn
+
+    def configure(self, settings, directories):
+        """更新配置；目录或标签变化时重建倒排表，首次配置时加载持久化索引并同步对账"""
+        with self._lock:
+            path_changed = settings['path'] != self.settings['path']
+            self.settings = settings
+            if directories != self.directories or path_changed:
+                self.directories = directories
+                self.images, self.tag_index, self.dir_mtimes = {}, {}, {}
+                # 丢弃旧目录的向量，进行中的重建结果也不再采用
+                self.vectors, self.vectors_dirty = None, True
+                self.vectors_discarded = self.vectors_generation
+                self.pending.clear()
+                self.ready = False
+            if not settings['enabled']:
+                return
+            load = not self.ready
+            if load:
+                self._load()
+        if load:
+            # 首次对账不持有锁；完成前 ready 为 False，查询走目录扫描
+            self.refresh(force=True)
+            with self._lock:
+                self.ready = True
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._watch_loop, name='local-image-index', daemon=True)
+                self.thread.start()
+        self._wake.set()
+
+    def _directory_config(self, directory):
+        for dir_config in self.directories:
+            if dir_config['path'] == directory:
+                return dir_config
+        return None
+
+    def _add(self, entry):
+        dir_config = self._directory_config(entry['directory']) or {'tags': [], 'weight': 1.0}
+        entry['dir_tags'] = list(dir_config['tags'])
+        entry['tags'] = sorted(set(dir_config['tags']) | set(_filename_tags(entry['filename'])))
+        entry['weight'] = dir_config['weight']
+        self.images[entry['path']] = entry
+        for tag in entry['tags']:
+            self.tag_index.setdefault(tag, set()).add(entry['path'])
+        self.vectors_dirty = True
+
+    def _remove(self, path):
+        entry = self.images.pop(path, None)
+        if not entry:
+            return
+        self.vectors_dirty = True
+        for tag in entry['tags']:
+            paths = self.tag_index.get(tag)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.tag_index[tag]
+        self.pending.pop(path, None)
+
+    def _load(self):
+        """从数据库加载当前配置目录下的条目，调用方需持有 self._lock"""
+        directories = {dir_config['path'] for dir_config in self.directories}
+        rows = self._get_conn().execute(
+            'SELECT path, directory, size, mtime_ns, width, height, sha256, caption, caption_mtime_ns FROM local_images'
+        ).fetchall()
+        for path, directory, size, mtime_ns, width, height, sha256, caption, caption_mtime_ns in rows:
+            if directory not in directories:
+                continue
+            self._add({
+                'path': path, 'directory': directory, 'filename': os.path.basename(path),
+                'size': size, 'mtime_ns': mtime_ns, 'width': width, 'height': height, 'sha256': sha256,
+                'caption': caption or '', 'caption_mtime_ns': caption_mtime_ns
+            })
+            if sha256 is None:
+                self.pending[path] = True
+
+    def _scan_directory(self, directory):
+        """列出目录并与索引对账，只处理新增、删除和大小/mtime 变化的文件
+
+        listdir、stat 和读取说明文件时不持有锁，只在应用对账结果时加锁，扫描大目录期间查询不受影响。
+        """
+        with self._lock:
+            known = {
+                path: (entry['size'], entry['mtime_ns'], entry['caption_mtime_ns'])
+                for path, entry in self.images.items() if entry['directory'] == directory
+            }
+        seen, changed, caption_updates = set(), [], []
+        try:
+            filenames = os.listdir(directory)
+        except OSError:
+            filenames = []
+        names = set(filenames)
+        for filename in filenames:
+            if not filename.lower().endswith(tuple(ALLOWED_EXTENSIONS)):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            seen.add(path)
+            existing = known.get(path)
+            caption_path = _image_caption_path(directory, filename, names)
+            try:
+                caption_mtime_ns = os.stat(caption_path).st_mtime_ns if caption_path else None
+            except OSError:
+                caption_path, caption_mtime_ns = None, None
+            if existing and existing[:2] == (stat.st_size, stat.st_mtime_ns):
+                # 图片未变，只有说明文件增删改时更新说明
+                if existing[2] != caption_mtime_ns:
+                    caption = _read_image_caption(caption_path) if caption_path else ''
+                    caption_updates.append((path, caption, caption_mtime_ns))
+                continue
+            caption = _read_image_caption(caption_path) if caption_path else ''
+            changed.append({
+                'path': path, 'directory': directory, 'filename': filename,
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'width': None, 'height': None, 'sha256': None,
+                'caption': caption, 'caption_mtime_ns': caption_mtime_ns
+            })
+        removed = [path for path in known if path not in seen]
+
+        with self._lock:
+            # 扫描期间目录被移出配置时丢弃结果
+            if self._directory_config(directory) is None:
+                return
+            conn = self._get_conn()
+            for path, caption, caption_mtime_ns in caption_updates:
+                entry = self.images.get(path)
+                if not entry:
+                    continue
+                entry.update(caption=caption, caption_mtime_ns=caption_mtime_ns)
+                self.vectors_dirty = True
+                conn.execute(
+                    'UPDATE local_images SET caption = ?, caption_mtime_ns = ? WHERE path = ?',
+                    (caption, caption_mtime_ns, path)
+                )
+                self.stats['updated'] += 1
+            for entry in changed:
+                path = entry['path']
+                self._remove(path)
+                self._add(entry)
+                self.pending[path] = True
+                conn.execute(
+                    'INSERT OR REPLACE INTO local_images (path, directory, size, mtime_ns, width, height, sha256, caption, caption_mtime_ns) '
+                    'VALUES (?, ?, ?, ?, NULL, NULL, NULL, ?, ?)',
+                    (path, directory, entry['size'], entry['mtime_ns'], entry['caption'], entry['caption_mtime_ns'])
+                )
+                self.stats['updated' if path in known else 'added'] += 1
+            for path in removed:
+                self._remove(path)
+                conn.execute('DELETE FROM local_images WHERE path = ?', (path,))
+            self.stats['removed'] += len(removed)
+            conn.commit()
+            self.stats['scans'] += 1
+
+    def refresh(self, force=False):
+        """检查各目录 mtime，只重新扫描发生变化的目录；force 时全部对账。扫描期间不持有锁"""
+        with self._lock:
+            directories = [dir_config['path'] for dir_config in self.directories]
+            dir_mtimes = dict(self.dir_mtimes)
+        for directory in directories:
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if force or mtime_ns != dir_mtimes.get(directory):
+                self._scan_directory(directory)
+                with self._lock:
+                    self.dir_mtimes[directory] = mtime_ns
+        if force:
+            with self._lock:
+                self.last_full_scan = time.time()
+
+    def _enrich_pending(self):
+        """补全一批文件的尺寸和 sha256；读取文件时不持有锁"""
+        with self._lock:
+            batch = []
+            while self.pending and len(batch) < self.settings['enrich_batch']:
+                path = self.pending.popitem(last=False)[0]
+                if path in self.images:
+                    batch.append((path, self.images[path]['mtime_ns']))
+        for path, mtime_ns in batch:
+            digest = hashlib.sha256()
+            width = height = None
+            try:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                with Image.open(path) as img:
+                    width, height = img.size
+            except Exception as e:
+                print(f"读取本地图片信息失败 {path}: {e}")
+                if not os.path.exists(path):
+                    continue
+            with self._lock:
+                entry = self.images.get(path)
+                # 读取期间文件被替换时，新的条目已重新排队
+                if not entry or entry['mtime_ns'] != mtime_ns:
+                    continue
+                entry.update(width=width, height=height, sha256=digest.hexdigest())
+                self._get_conn().execute(
+                    'UPDATE local_images SET width = ?, height = ?, sha256 = ? WHERE path = ?',
+                    (width, height, entry['sha256'], path)
+                )
+                self.stats['enriched'] += 1
+        if batch:
+            with self._lock:
+                self._get_conn().commit()
+        return len(batch)
+
+    def _watch_loop(self):
+        while True:
+            try:
+                if self.settings['enabled']:
+                    full = time.time() - self.last_full_scan >= self.settings['full_rescan_interval']
+                    self.refresh(force=full)
+                    # 在后台重建向量，查询时不必等待
+                    if self.settings['semantic'] and self.vectors_dirty:
+                        self._build_vectors()
+                    # 还有待补全的文件时不等待，连续处理
+                    if self._enrich_pending():
+                        continue
+            except Exception as e:
+                print(f"本地图库索引更新失败: {e}")
+            self._wake.wait(self.settings['poll_interval'])
+            self._wake.clear()
+
+    def _build_vectors(self):
+        """由目录标签、文件名和说明文件重建 TF-IDF 倒排列并返回
+
+        只在复制文档字段和替换 self.vectors 时持有锁，分词和计算在锁外进行。
+        """
+        with self._lock:
+            self.vectors_dirty = False
+            self.vectors_generation += 1
+            generation = self.vectors_generation
+            sources = [
+                (path, ' '.join(entry.get('dir_tags', [])), entry['filename'], entry.get('caption', ''))
+                for path, entry in self.images.items()
+            ]
+        paths = [path for path, _, _, _ in sources]
+        documents = []
+        document_frequency = Counter()
+        for _, dir_tags, filename, caption in sources:
+            term_weights = Counter()
+            fields = (
+                ('tags', dir_tags),
+                ('filename', ' '.join(_filename_tags(filename))),
+                ('caption', caption)
+            )
+            for field, text in fields:
+                for token in tokenize_for_matching(text):
+                    term_weights[token] += LOCAL_IMAGE_FIELD_WEIGHTS[field]
+            documents.append(term_weights)
+            document_frequency.update(term_weights.keys())
+
+        total = len(paths)
+        idf = {term: math.log((total + 1) / (df + 1)) + 1 for term, df in document_frequency.items()}
+        postings = {}
+        for row, term_weights in enumerate(documents):
+            vector = {term: math.log1p(weight) * idf[term] for term, weight in term_weights.items()}
+            norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+            for term, value in vector.items():
+                rows, values = postings.setdefault(term, ([], []))
+                rows.append(row)
+                values.append(value / norm)
+        postings = {
+            term: (np.asarray(rows, dtype=np.int32), np.asarray(values, dtype=np.float32))
+            for term, (rows, values) in postings.items()
+        }
+        vectors = {'paths': paths, 'idf': idf, 'postings': postings, 'generation': generation}
+        with self._lock:
+            if generation > self.vectors_discarded and (self.vectors is None or self.vectors['generation'] < generation):
+                self.vectors = vectors
+            self.stats['vector_builds'] += 1
+        return vectors
+
+    def search(self, query, top_k=5):
+        """返回与查询文本余弦相似度最高的 top_k 张图片 [(路径, 相似度)]，相似度为 0 的不返回"""
+        tokens = tokenize_for_matching(query)
+        if not tokens:
+            return []
+        with self._lock:
+            vectors = self.vectors
+            if vectors is not None and self.vectors_dirty:
+                # 使用旧向量，由后台线程重建
+                self._wake.set()
+        if vectors is None:
+            vectors = self._build_vectors()
+        # 向量构建后不再修改，可以不加锁读取
+        idf, postings, paths = vectors['idf'], vectors['postings'], vectors['paths']
+        query_vector = {term: math.log1p(count) * idf[term] for term, count in Counter(tokens).items() if term in idf}
+        norm = math.sqrt(sum(value * value for value in query_vector.values()))
+        if not query_vector or not paths:
+            return []
+
+        scores = np.zeros(len(paths), dtype=np.float32)
+        for term, value in query_vector.items():
+            rows, values = postings[term]
+            scores[rows] += values * (value / norm)
+        k = min(top_k, len(paths))
+        top = np.argpartition(-scores, k - 1)[:k]
+        ranked = sorted(((float(scores[row]), int(row)) for row in top), reverse=True)
+        return [(paths[row], score) for score, row in ranked if score > 0]
+
+    def choose(self, tags=None, query=None, task_id=None):
+        """选择一张图片
+
+        提供 query 且开启语义匹配时，在相似度不低于 min_score 的前 top_k 张中按 相似度 × 目录 weight
+        加权随机选择；否则按标签加权随机：权重 = 目录 weight × 命中的标签数；都没有命中时在全部图片中按目录 weight 选择。
+        weight 为 0 的目录不参与选择。权重再乘以近期使用记录的系数，同一批次用过的图片只在没有其他候选时才会再被选中。
+        """
+        if query and self.settings['semantic']:
+            matches = [(path, score) for path, score in self.search(query, self.settings['top_k']) if score >= self.settings['min_score']]
+            with self._lock:
+                matches = [(path, score * self.images[path]['weight']) for path, score in matches if path in self.images]
+                self.stats['semantic_hits' if matches else 'semantic_misses'] += 1
+            matches = [(path, weight) for path, weight in matches if weight > 0]
+            if matches:
+                return _weighted_choice_with_recent_use(
+                    [path for path, _ in matches], [weight for _, weight in matches], task_id
+                )
+
+        with self._lock:
+            self.stats['queries'] += 1
+            scores = {}
+            for tag in tags or []:
+                for path in self.tag_index.get(tag, ()):
+                    if self.images[path]['weight'] > 0:
+                        scores[path] = scores.get(path, 0) + 1
+            if scores:
+                candidates = list(scores)
+                weights = [self.images[path]['weight'] * scores[path] for path in candidates]
+            else:
+                candidates = [path for path, entry in self.images.items() if entry['weight'] > 0]
+                weights = [self.images[path]['weight'] for path in candidates]
+        if not candidates:
+            return None
+        return _weighted_choice_with_recent_use(candidates, weights, task_id)
+
+    def list_images(self):
+        """按目录配置顺序列出所有图片"""
+        with self._lock:
+            order = {dir_config['path']: index for index, dir_config in enumerate(self.directories)}
+            entries = sorted(self.images.values(), key=lambda entry: (order.get(entry['directory'], 0), entry['filename']))
+            return [dict(entry) for entry in entries]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                ready=self.ready,
+                images=len(self.images),
+                tags=len(self.tag_index),
+                vocabulary=len(self.vectors['postings']) if self.vectors else 0,
+                pending=len(self.pending),
+                directories=len(self.directories)
+            )
+
+local_image_index = LocalImageIndex()
+
+def update_local_image_index_runtime(config):
+    """根据配置更新本地图库索引，目录变化时重新对账"""
+    settings = get_local_image_index_settings(config)
+    local_image_index.configure(settings, _normalize_local_image_directories(config))
+    return settings
+
+# 默认的图片近期使用记录配置：同一批任务内不重复使用同一张图，全局近期用过的图片按时间衰减降权
+DEFAULT_IMAGE_RECENT_USE_CONFIG = {
+    'enabled': True,
+    'max_entries': 5000,        # 全局记录的图片数上限（LRU）
+    'half_life_minutes': 60,    # 全局降权的半衰期
+    'max_batches': 50           # 同时保留的批次（任务）记录数（LRU）
+}
+
+# 全局降权后的最低权重，避免图库较小时近期用过的图片完全选不到
+IMAGE_RECENT_USE_MIN_WEIGHT = 0.05
+
+def get_image_recent_use_settings(config):
+    """合并默认近期使用记录配置和用户配置"""
+    merged = DEFAULT_IMAGE_RECENT_USE_CONFIG.copy()
+    user_cfg = (config or {}).get('image_recent_use_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['max_entries'] = max(1, int(merged.get('max_entries') or DEFAULT_IMAGE_RECENT_USE_CONFIG['max_entries']))
+    merged['half_life_minutes'] = max(0.1, float(merged.get('half_life_minutes') or DEFAULT_IMAGE_RECENT_USE_CONFIG['half_life_minutes']))
+    merged['max_batches'] = max(1, int(merged.get('max_batches') or DEFAULT_IMAGE_RECENT_USE_CONFIG['max_batches']))
+    return merged
+
+class RecentImageLedger:
+    """图片近期使用记录
+
+    global_uses 为 图片键（本地路径或图库 URL）→ 最近使用时间 的有界 LRU；batches 为
+    task_id → 该批次已用图片集合 的有界 LRU。查询和记录都是字典操作，O(1)。
+    对冲获取时各来源在撤销日志中选图，落选来源的记录（及搜索缓存游标）随结果释放一并撤销。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.settings = DEFAULT_IMAGE_RECENT_USE_CONFIG.copy()
+        self.global_uses = OrderedDict()
+        self.batches = OrderedDict()
+
+    def configure(self, settings):
+        with self._lock:
+            self.settings = settings
+
+    def weights(self, keys, task_id=None):
+        """返回各候选的权重系数：本批次用过为 0；全局近期用过按 1 - 0.5^(间隔/半衰期) 降权；未用过为 1"""
+        with self._lock:
+            if not self.settings['enabled']:
+                return [1.0] * len(keys)
+            now = time.time()
+            half_life = self.settings['half_life_minutes'] * 60
+            batch = self.batches.get(task_id, ()) if task_id else ()
+            result = []
+            for key in keys:
+                if key in batch:
+                    result.append(0.0)
+                    continue
+                used_at = self.global_uses.get(key)
+                if used_at is None:
+                    result.append(1.0)
+                else:
+                    result.append(max(IMAGE_RECENT_USE_MIN_WEIGHT, 1 - 0.5 ** ((now - used_at) / half_life)))
+            return result
+
+    def record(self, key, task_id=None):
+        """记录一次使用；当前线程开启了撤销日志时同时记下撤销操作"""
+        with self._lock:
+            if not self.settings['enabled'] or not key:
+                return
+            previous = self.global_uses.get(key)
+            in_batch = bool(task_id) and key in self.batches.get(task_id, ())
+            self.global_uses[key] = time.time()
+            self.global_uses.move_to_end(key)
+            while len(self.global_uses) > self.settings['max_entries']:
+                self.global_uses.popitem(last=False)
+            if task_id:
+                batch = self.batches.setdefault(task_id, set())
+                self.batches.move_to_end(task_id)
+                batch.add(key)
+                while len(self.batches) > self.settings['max_batches']:
+                    self.batches.popitem(last=False)
+        self.add_undo(lambda: self._forget(key, task_id, previous, in_batch))
+
+    def _forget(self, key, task_id, previous, in_batch):
+        """撤销一次记录：恢复之前的使用时间，本批次原先没有的图片移出批次"""
+        with self._lock:
+            if previous is None:
+                self.global_uses.pop(key, None)
+            elif key in self.global_uses:
+                self.global_uses[key] = previous
+            if task_id and not in_batch:
+                self.batches.get(task_id, set()).discard(key)
+
+    def start_journal(self):
+        """在当前线程开启撤销日志"""
+        self._local.journal = []
+
+    def finish_journal(self):
+        """关闭当前线程的撤销日志，返回撤销操作列表（按执行顺序）"""
+        journal = getattr(self._local, 'journal', None) or []
+        self._local.journal = None
+        return journal
+
+    def add_undo(self, callback):
+        """当前线程开启了撤销日志时追加一个撤销操作"""
+        journal = getattr(self._local, 'journal', None)
+        if journal is not None:
+            journal.append(callback)
+
+    @staticmethod
+    def undo(journal):
+        """倒序执行撤销操作"""
+        for callback in reversed(journal or []):
+            callback()
+
+    def pick_index(self, keys, start=0, task_id=None):
+        """从 start 开始轮询候选，返回第一个未被用过的下标；都用过时返回权重最高（最久未用）的下标"""
+        if not keys:
+            return None
+        order = [(start + offset) % len(keys) for offset in range(len(keys))]
+        weights = self.weights([keys[index] for index in order], task_id)
+        for index, weight in zip(order, weights):
+            if weight >= 1.0:
+                return index
+        return max(zip(weights, [-position for position in range(len(order))], order))[2]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'enabled': self.settings['enabled'],
+                'tracked_images': len(self.global_uses),
+                'tracked_batches': len(self.batches)
+            }
+
+recent_image_ledger = RecentImageLedger()
+
+def update_image_recent_use_runtime(config):
+    """根据配置更新近期使用记录参数"""
+    settings = get_image_recent_use_settings(config)
+    recent_image_ledger.configure(settings)
+    return settings
+
+# 默认的 LLM 响应缓存配置（蓝图、摘要、选题等非正文请求）
+DEFAULT_LLM_CACHE_CONFIG = {
+    'enabled': True,
+    'path': os.path.join('cache', 'llm_cache.sqlite3'),
+    'ttl_seconds': 7 * 24 * 3600,
+    'max_entries': 5000,
+    'max_size_mb': 50
+}
+
+# LLM 缓存运行时：共享一个 SQLite 连接，由锁串行化访问
+llm_cache_lock = threading.Lock()
+llm_cache_runtime = {
+    'settings': DEFAULT_LLM_CACHE_CONFIG.copy(),
+    'conn': None,
+    'conn_path': None,
+    'stats': {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'bypassed': 0, 'expired': 0}
+}
+
+def get_llm_cache_settings(config):
+    """合并默认 LLM 缓存配置和用户配置"""
+    merged = DEFAULT_LLM_CACHE_CONFIG.copy()
+    user_cfg = (config or {}).get('llm_cache_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['path'] = merged.get('path') or DEFAULT_LLM_CACHE_CONFIG['path']
+    merged['ttl_seconds'] = max(0, int(merged.get('ttl_seconds', DEFAULT_LLM_CACHE_CONFIG['ttl_seconds'])))
+    merged['max_entries'] = max(1, int(merged.get('max_entries', DEFAULT_LLM_CACHE_CONFIG['max_entries'])))
+    merged['max_size_mb'] = max(1, int(merged.get('max_size_mb', DEFAULT_LLM_CACHE_CONFIG['max_size_mb'])))
+    return merged
+
+def update_llm_cache_runtime(config):
+    """根据配置更新缓存参数，路径变化时在下次访问时重新打开数据库"""
+    settings = get_llm_cache_settings(config)
+    with llm_cache_lock:
+        llm_cache_runtime['settings'] = settings
+    return settings
+
+def _get_llm_cache_conn():
+    """获取（必要时创建）缓存数据库连接，调用方需持有 llm_cache_lock"""
+    path = llm_cache_runtime['settings']['path']
+    if llm_cache_runtime['conn'] is not None and llm_cache_runtime['conn_path'] == path:
+        return llm_cache_runtime['conn']
+    if llm_cache_runtime['conn'] is not None:
+        llm_cache_runtime['conn'].close()
+
+    cache_dir = os.path.dirname(path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)')
+    conn.commit()
+    llm_cache_runtime['conn'] = conn
+    llm_cache_runtime['conn_path'] = path
+    return conn
+
+def llm_cache_key(model_name, messages, parameters):
+    """根据 (模型, 提示词, 参数) 计算缓存键"""
+    raw = json.dumps([model_name, messages, parameters or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def llm_cache_get(key):
+    """读取缓存，过期条目视为未命中并删除"""
+    with llm_cache_lock:
+        settings = llm_cache_runtime['settings']
+        if not settings['enabled']:
+            return None
+        conn = _get_llm_cache_conn()
+        row = conn.execute('SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row and settings['ttl_seconds'] and now - row[1] > settings['ttl_seconds']:
+            conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+            conn.commit()
+            llm_cache_runtime['stats']['expired'] += 1
+            row = None
+        if row is None:
+            llm_cache_runtime['stats']['misses'] += 1
+            return None
+        conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+        conn.commit()
+        llm_cache_runtime['stats']['hits'] += 1
+        return row[0]
+
+def llm_cache_put(key, model_name, response_text):
+    """写入缓存，并按条目数和总大小淘汰最久未使用的条目"""
+    with llm_cache_lock:
+        settings = llm_cache_runtime['settings']
+        if not settings['enabled']:
+            return
+        conn = _get_llm_cache_conn()
+        now = time.time()
+        size = len(response_text.encode('utf-8'))
+        conn.execute(
+            'INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, model_name, response_text, size, now, now)
+        )
+        llm_cache_runtime['stats']['writes'] += 1
+
+        count, total_size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        max_bytes = settings['max_size_mb'] * 1024 * 1024
+        if count > settings['max_entries'] or total_size > max_bytes:
+            evicted = 0
+            rows = conn.execute('SELECT key, size FROM llm_cache ORDER BY last_access ASC').fetchall()
+            for old_key, old_size in rows:
+                if count <= settings['max_entries'] and total_size <= max_bytes:
+                    break
+                conn.execute('DELETE FROM llm_cache WHERE key = ?', (old_key,))
+                count -= 1
+                total_size -= old_size
+                evicted += 1
+            llm_cache_runtime['stats']['evictions'] += evicted
+        conn.commit()
+
+def get_llm_cache_stats():
+    """返回缓存命中率和容量信息"""
+    with llm_cache_lock:
+        stats = dict(llm_cache_runtime['stats'])
+        settings = dict(llm_cache_runtime['settings'])
+        entries, total_size = 0, 0
+        if settings['enabled']:
+            conn = _get_llm_cache_conn()
+            entries, total_size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+    lookups = stats['hits'] + stats['misses']
+    stats.update({
+        'entries': entries,
+        'size_bytes': total_size,
+        'hit_rate': round(stats['hits'] / lookups, 4) if lookups else 0,
+        'settings': settings
+    })
+    return stats
+
+def clear_llm_cache():
+    """清空缓存"""
+    with llm_cache_lock:
+        conn = _get_llm_cache_conn()
+        conn.execute('DELETE FROM llm_cache')
+        conn.commit()
+
+# 默认的熔断器配置：按外部服务（图库、ComfyUI、DashScope）分别统计滚动窗口内的错误率和慢调用比例
+DEFAULT_CIRCUIT_BREAKER_CONFIG = {
+    'enabled': True,
+    'window_seconds': 60,
+    'min_requests': 5,            # 窗口内请求数达到该值才计算比例
+    'error_rate_threshold': 0.5,
+    'slow_call_ms': 0,            # 超过该耗时视为慢调用，0 表示不统计
+    'slow_rate_threshold': 0.8,
+    'open_seconds': 30,           # 打开后多久进入半开状态
+    'half_open_max_calls': 1,     # 半开状态放行的探测请求数，全部成功才关闭
+    'providers': {                # 按服务覆盖以上参数
+        'unsplash': {'slow_call_ms': 8000},
+        'pexels': {'slow_call_ms': 8000},
+        'pixabay': {'slow_call_ms': 8000}
+    }
+}
+
+# 受熔断器保护的图片来源（本地图库和用户上传不经过网络）
+CIRCUIT_BREAKER_IMAGE_SOURCES = ('comfyui', 'unsplash', 'pexels', 'pixabay')
+
+class CircuitOpenError(Exception):
+    """服务处于熔断状态时抛出，调用方应直接跳过该服务"""
+
+class CircuitBreaker:
+    """单个外部服务的熔断器：closed → open → half_open → closed
+
+    closed 时记录每次调用的结果，窗口内错误率或慢调用比例超过阈值即打开；
+    open 时直接拒绝，open_seconds 后进入 half_open，放行少量探测请求，
+    探测全部成功则关闭，任一失败重新打开。allow() 返回 True 的调用方必须随后调用 record()。
+    """
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.opened_at = 0
+        self.calls = deque()  # (时间, 是否成功, 是否慢调用, 耗时毫秒)
+        self.half_open_in_flight = 0
+        self.half_open_successes = 0
+        self.stats = {'rejected': 0, 'opened': 0, 'last_error': None, 'last_state_change': time.time()}
+
+    def configure(self, settings):
+        with self._lock:
+            self.settings = settings
+
+    def _set_state(self, state, now):
+        self.state = state
+        self.stats['last_state_change'] = now
+        if state == 'open':
+            self.opened_at = now
+            self.stats['opened'] += 1
+            print(f"熔断器打开: {self.name}，{self.settings['open_seconds']} 秒内跳过该服务")
+        elif state == 'half_open':
+            self.half_open_in_flight = 0
+            self.half_open_successes = 0
+        else:
+            self.calls.clear()
+            print(f"熔断器关闭: {self.name} 已恢复")
+
+    def _trim(self, now):
+        horizon = now - self.settings['window_seconds']
+        while self.calls and self.calls[0][0] < horizon:
+            self.calls.popleft()
+
+    def is_open(self):
+        """是否处于打开且未到探测时间的状态（不改变状态，用于提前跳过）"""
+        with self._lock:
+            return self.settings['enabled'] and self.state == 'open' and time.time() - self.opened_at < self.settings['open_seconds']
+
+    def allow(self):
+        """是否放行一次调用"""
+        with self._lock:
+            if not self.settings['enabled']:
+                return True
+            now = time.time()
+            if self.state == 'open':
+                if now - self.opened_at < self.settings['open_seconds']:
+                    self.stats['rejected'] += 1
+                    return False
+                self._set_state('half_open', now)
+            if self.state == 'half_open':
+                if self.half_open_in_flight >= self.settings['half_open_max_calls']:
+                    self.stats['rejected'] += 1
+                    return False
+                self.half_open_in_flight += 1
+            return True
+
+    def record(self, success, elapsed_ms=0, error=None):
+        """记录一次调用结果"""
+        with self._lock:
+            now = time.time()
+            slow = bool(self.settings['slow_call_ms']) and elapsed_ms >= self.settings['slow_call_ms']
+            if not success and error is not None:
+                self.stats['last_error'] = str(error)[:200]
+            self.calls.append((now, success, slow, elapsed_ms))
+            self._trim(now)
+            if not self.settings['enabled']:
+                return
+            if self.state == 'half_open':
+                self.half_open_in_flight = max(0, self.half_open_in_flight - 1)
+                if success and not slow:
+                    self.half_open_successes += 1
+                    if self.half_open_successes >= self.settings['half_open_max_calls']:
+                        self._set_state('closed', now)
+                else:
+                    self._set_state('open', now)
+                return
+            if self.state == 'closed' and len(self.calls) >= self.settings['min_requests']:
+                total = len(self.calls)
+                error_rate = sum(1 for call in self.calls if not call[1]) / total
+                slow_rate = sum(1 for call in self.calls if call[2]) / total
+                if error_rate >= self.settings['error_rate_threshold'] or slow_rate >= self.settings['slow_rate_threshold']:
+                    self._set_state('open', now)
+
+    def snapshot(self):
+        """当前状态与健康评分（0~1，打开时为 0）"""
+        with self._lock:
+            now = time.time()
+            self._trim(now)
+            total = len(self.calls)
+            errors = sum(1 for call in self.calls if not call[1])
+            slows = sum(1 for call in self.calls if call[2])
+            error_rate = errors / total if total else 0
+            slow_rate = slows / total if total else 0
+            health = 0 if self.state == 'open' else (1 - error_rate) * (1 - 0.5 * slow_rate)
+            return {
+                'name': self.name,
+                'state': self.state,
+                'health': round(health, 3),
+                'requests': total,
+                'error_rate': round(error_rate, 4),
+                'slow_rate': round(slow_rate, 4),
+                'avg_latency_ms': round(sum(call[3] for call in self.calls) / total) if total else 0,
+                'retry_in_seconds': round(max(0, self.opened_at + self.settings['open_seconds'] - now), 1) if self.state == 'open' else 0,
+                'rejected': self.stats['rejected'],
+                'opened': self.stats['opened'],
+                'last_error': self.stats['last_error'],
+                'settings': {key: value for key, value in self.settings.items() if key != 'providers'}
+            }
+
+circuit_breakers_lock = threading.Lock()
+circuit_breakers = {}  # 服务名 -> CircuitBreaker
+circuit_breaker_runtime = {'config': {}}
+
+def get_circuit_breaker_settings(config, name=None):
+    """合并默认熔断配置和用户配置；提供 name 时叠加该服务的覆盖项"""
+    merged = copy.deepcopy(DEFAULT_CIRCUIT_BREAKER_CONFIG)
+    user_cfg = (config or {}).get('circuit_breaker_settings') or {}
+    for key, value in user_cfg.items():
+        if key == 'providers' and isinstance(value, dict):
+            for provider, overrides in value.items():
+                merged['providers'].setdefault(provider, {}).update(overrides or {})
+        elif value is not None:
+            merged[key] = value
+    if name:
+        for key, value in merged['providers'].get(name, {}).items():
+            if value is not None:
+                merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['window_seconds'] = max(1, int(merged.get('window_seconds') or DEFAULT_CIRCUIT_BREAKER_CONFIG['window_seconds']))
+    merged['min_requests'] = max(1, int(merged.get('min_requests') or 1))
+    merged['slow_call_ms'] = max(0, int(merged.get('slow_call_ms') or 0))
+    merged['open_seconds'] = max(1, int(merged.get('open_seconds') or DEFAULT_CIRCUIT_BREAKER_CONFIG['open_seconds']))
+    merged['half_open_max_calls'] = max(1, int(merged.get('half_open_max_calls') or 1))
+    for key in ('error_rate_threshold', 'slow_rate_threshold'):
+        merged[key] = min(1.0, max(0.0, float(merged.get(key, DEFAULT_CIRCUIT_BREAKER_CONFIG[key]))))
+    return merged
+
+def update_circuit_breaker_runtime(config):
+    """根据配置更新所有已创建熔断器的参数"""
+    with circuit_breakers_lock:
+        circuit_breaker_runtime['config'] = {'circuit_breaker_settings': (config or {}).get('circuit_breaker_settings') or {}}
+        for name, breaker in circuit_breakers.items():
+            breaker.configure(get_circuit_breaker_settings(circuit_breaker_runtime['config'], name))
+
+def get_circuit_breaker(name):
+    """获取（必要时创建）服务对应的熔断器"""
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, get_circuit_breaker_settings(circuit_breaker_runtime['config'], name))
+            circuit_breakers[name] = breaker
+        return breaker
+
+def get_provider_health():
+    """返回所有服务的熔断状态"""
+    with circuit_breakers_lock:
+        breakers = list(circuit_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+class QwenResponseError(Exception):
+    """模型返回内容无法使用时抛出，raw_text 保留原始输出便于排查"""
+
+    def __init__(self, message, raw_text=''):
+        super().__init__(message)
+        self.raw_text = raw_text
+
+class QwenThrottledError(Exception):
+    """DashScope 在流式输出中返回限流错误码时抛出"""
+
+class QwenStreamInterruptedError(Exception):
+    """流式输出已收到部分内容后连接中断或超时时抛出；重试会重复计费且丢弃已生成内容，因此不重试"""
+
+# 默认的 DashScope 限流配置（0 表示不限制）
+DEFAULT_LLM_RATE_LIMIT_CONFIG = {
+    'enabled': True,
+    'requests_per_minute': 60,
+    'tokens_per_minute': 100000,
+    'initial_concurrency': 4,
+    'min_concurrency': 1,
+    'max_concurrency': 8,
+    'max_retries': 4,
+    'base_delay': 1.0,
+    'max_delay': 30.0,
+    'models': {}  # 按模型覆盖 requests_per_minute / tokens_per_minute 等
+}
+
+# 限流后至少间隔多少秒才再次减半并发，避免同一批并发请求的多个 429 连续减半
+LLM_RATE_LIMIT_DECREASE_COOLDOWN = 5.0
+QWEN_RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+llm_rate_limit_lock = threading.Lock()
+llm_rate_limiters = {}  # (api_key 摘要, model) -> QwenRateLimiter
+
+def get_llm_rate_limit_settings(config, model_name=None):
+    """合并默认限流配置和用户配置；提供 model_name 时叠加该模型的覆盖项"""
+    merged = copy.deepcopy(DEFAULT_LLM_RATE_LIMIT_CONFIG)
+    user_cfg = (config or {}).get('llm_rate_limit') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    if model_name:
+        for key, value in (merged.get('models') or {}).get(model_name, {}).items():
+            if value is not None:
+                merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    for key in ('requests_per_minute', 'tokens_per_minute', 'max_retries'):
+        merged[key] = max(0, int(merged.get(key) or 0))
+    merged['min_concurrency'] = max(1, int(merged.get('min_concurrency') or 1))
+    merged['max_concurrency'] = max(merged['min_concurrency'], int(merged.get('max_concurrency') or 1))
+    merged['initial_concurrency'] = min(merged['max_concurrency'], max(merged['min_concurrency'], int(merged.get('initial_concurrency') or 1)))
+    merged['base_delay'] = max(0.1, float(merged.get('base_delay') or DEFAULT_LLM_RATE_LIMIT_CONFIG['base_delay']))
+    merged['max_delay'] = max(merged['base_delay'], float(merged.get('max_delay') or DEFAULT_LLM_RATE_LIMIT_CONFIG['max_delay']))
+    return merged
+
+class QwenRateLimiter:
+    """单个 API Key + 模型的限流器
+
+    请求数和 token 数各用一个令牌桶控制（每分钟补满），并发上限按 AIMD 调整：
+    连续成功一轮（成功次数达到当前上限）后加 1，遇到 429/5xx 时减半。
+    """
+
+    def __init__(self, settings):
+        self._cond = threading.Condition()
+        self.settings = None
+        self.limit = settings['initial_concurrency']
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.request_allowance = float(settings['requests_per_minute'])
+        self.token_allowance = float(settings['tokens_per_minute'])
+        self.updated_at = time.monotonic()
+        self.stats = {'requests': 0, 'throttled': 0, 'server_errors': 0, 'retries': 0, 'wait_seconds': 0.0}
+        self.configure(settings)
+
+    def configure(self, settings):
+        with self._cond:
+            if settings == self.settings:
+                return
+            self.settings = settings
+            self.limit = min(settings['max_concurrency'], max(settings['min_concurrency'], self.limit))
+            self.request_allowance = min(self.request_allowance, float(settings['requests_per_minute']))
+            self.token_allowance = min(self.token_allowance, float(settings['tokens_per_minute']))
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        rpm = self.settings['requests_per_minute']
+        tpm = self.settings['tokens_per_minute']
+        if rpm:
+            self.request_allowance = min(rpm, self.request_allowance + elapsed * rpm / 60.0)
+        if tpm:
+            self.token_allowance = min(tpm, self.token_allowance + elapsed * tpm / 60.0)
+
+    def acquire(self, estimated_tokens):
+        """等待并发槽位和令牌，返回实际预扣的 token 数"""
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                rpm = self.settings['requests_per_minute']
+                tpm = self.settings['tokens_per_minute']
+                # 单次请求预估超过桶容量时按桶容量计，避免永远等不到
+                tokens = min(estimated_tokens, tpm) if tpm else 0
+                request_wait = (1 - self.request_allowance) * 60.0 / rpm if rpm and self.request_allowance < 1 else 0
+                token_wait = (tokens - self.token_allowance) * 60.0 / tpm if tpm and self.token_allowance < tokens else 0
+                if self.in_flight < self.limit and request_wait <= 0 and token_wait <= 0:
+                    if rpm:
+                        self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    self.in_flight += 1
+                    self.stats['requests'] += 1
+                    self.stats['wait_seconds'] += now - started
+                    return tokens
+                # 并发已满时等待 release 唤醒，令牌不足时等待到预计补足的时间
+                self._cond.wait(timeout=max(0.05, min(max(request_wait, token_wait) or 1.0, 5.0)))
+
+    def release(self, reserved_tokens, used_tokens=None, outcome='ok'):
+        """归还并发槽位；outcome 为 ok / throttled / server_error / error"""
+        with self._cond:
+            self.in_flight -= 1
+            tpm = self.settings['tokens_per_minute']
+            if tpm and used_tokens is not None:
+                # 以实际用量校正预扣的 token，允许暂时为负以体现超额
+                self.token_allowance = min(tpm, self.token_allowance - (used_tokens - reserved_tokens))
+            if outcome in ('throttled', 'server_error'):
+                self.stats['throttled' if outcome == 'throttled' else 'server_errors'] += 1
+                now = time.monotonic()
+                if now - self.last_decrease >= LLM_RATE_LIMIT_DECREASE_COOLDOWN:
+                    self.limit = max(self.settings['min_concurrency'], self.limit // 2)
+                    self.last_decrease = now
+                self.successes = 0
+                if outcome == 'throttled':
+                    # 被限流说明实际配额低于配置，清空请求令牌让后续请求稍作等待
+                    self.request_allowance = min(self.request_allowance, 0.0)
+            elif outcome == 'ok':
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.settings['max_concurrency']:
+                    self.limit += 1
+                    self.successes = 0
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'concurrency_limit': self.limit,
+                'in_flight': self.in_flight,
+                'request_allowance': round(self.request_allowance, 2),
+                'token_allowance': round(self.token_allowance, 1),
+                'requests_per_minute': self.settings['requests_per_minute'],
+                'tokens_per_minute': self.settings['tokens_per_minute'],
+                **{key: round(value, 2) if isinstance(value, float) else value for key, value in self.stats.items()}
+            }
+
+def get_qwen_rate_limiter(api_key, model_name, settings):
+    """获取（必要时创建）指定 API Key + 模型的限流器"""
+    key = (hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12], model_name)
+    with llm_rate_limit_lock:
+        limiter = llm_rate_limiters.get(key)
+        if limiter is None:
+            limiter = llm_rate_limiters[key] = QwenRateLimiter(settings)
+            return limiter
+    limiter.configure(settings)
+    return limiter
+
+def get_llm_rate_limit_stats():
+    with llm_rate_limit_lock:
+        limiters = dict(llm_rate_limiters)
+    return [
+        dict(limiter.snapshot(), key=key_hash, model=model_name)
+        for (key_hash, model_name), limiter in limiters.items()
+    ]
+
+def estimate_qwen_tokens(messages, expected_output=500):
+    """粗略估计一次请求消耗的 token 数（中文约每字 1 token）"""
+    return sum(len(str(message.get('content', ''))) for message in messages) + expected_output
+
+def _classify_qwen_error(exc):
+    """判断异常是否值得重试，返回 (outcome, Retry-After 秒数)；不可重试时 outcome 为 None"""
+    if isinstance(exc, QwenThrottledError):
+        return 'throttled', None
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        if status not in QWEN_RETRYABLE_STATUS:
+            return None, None
+        retry_after = exc.response.headers.get('Retry-After')
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        return ('throttled' if status == 429 else 'server_error'), retry_after
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return 'error', None
+    return None, None
+
+def _send_qwen_with_breaker(breaker, send):
+    """经熔断器执行一次请求：5xx 和网络错误计为失败，限流和其他响应说明服务可用，计为成功"""
+    if not breaker.allow():
+        raise CircuitOpenError('DashScope 暂时不可用（熔断中），请稍后重试')
+    started = time.monotonic()
+    try:
+        result = send()
+    except Exception as exc:
+        outcome, _ = _classify_qwen_error(exc)
+        healthy = outcome not in ('server_error', 'error') and not isinstance(exc, QwenStreamInterruptedError)
+        breaker.record(healthy, (time.monotonic() - started) * 1000, exc)
+        raise
+    breaker.record(True, (time.monotonic() - started) * 1000)
+    return result
+
+def call_qwen_with_limits(api_key, model_name, config, send, estimated_tokens=0, max_retries=None):
+    """在限流器控制下执行一次 DashScope 请求，429/5xx/网络错误时带抖动退避重试
+
+    Args:
+        send: 执行完整请求的函数，返回 (结果, 实际 token 用量或 None)；HTTP 错误需以 HTTPError 抛出
+        max_retries: 覆盖配置中的重试次数
+    """
+    settings = get_llm_rate_limit_settings(config, model_name)
+    breaker = get_circuit_breaker('dashscope')
+    if not settings['enabled']:
+        return _send_qwen_with_breaker(breaker, send)[0]
+
+    limiter = get_qwen_rate_limiter(api_key, model_name, settings)
+    retries = settings['max_retries'] if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        # 熔断期间不占用限流配额，直接失败
+        if breaker.is_open():
+            raise CircuitOpenError('DashScope 暂时不可用（熔断中），请稍后重试')
+        reserved = limiter.acquire(estimated_tokens)
+        try:
+            result, used_tokens = _send_qwen_with_breaker(breaker, send)
+        except Exception as exc:
+            outcome, retry_after = _classify_qwen_error(exc)
+            limiter.release(reserved, None, outcome or 'error')
+            if isinstance(exc, CircuitOpenError):
+                raise
+            if outcome is None or attempt >= retries:
+                raise
+            # full jitter：在指数退避上限内随机等待，服务端给出 Retry-After 时至少等待该时长
+            delay = random.uniform(0, min(settings['max_delay'], settings['base_delay'] * (2 ** attempt)))
+            if retry_after:
+                delay = max(delay, min(retry_after, settings['max_delay']))
+            attempt += 1
+            with limiter._cond:
+                limiter.stats['retries'] += 1
+            print(f"DashScope 请求失败 ({model_name}: {exc})，{delay:.1f} 秒后第 {attempt} 次重试")
+            time.sleep(delay)
+            continue
+        limiter.release(reserved, used_tokens, 'ok')
+        return result
+
+def _qwen_usage_tokens(usage):
+    """从 DashScope usage 中取总 token 数"""
+    if not usage:
+        return None
+    if usage.get('total_tokens') is not None:
+        return usage['total_tokens']
+    return (usage.get('input_tokens') or 0) + (usage.get('output_tokens') or 0)
+
+def request_qwen_text(api_key, base_url, model_name, prompt=None, messages=None, parameters=None,
+                      timeout=None, config=None, validator=None, use_cache=True):
+    """调用 DashScope 文本生成接口并返回结果（非流式），带持久化缓存
+
+    Args:
+        prompt: 单条 user 消息；也可直接传入 messages
+        parameters: DashScope parameters，默认 {'result_format': 'text'}
+        config: 配置对象，其中 llm_cache_bypass 为 True 时跳过缓存读取（仍会写入新结果）
+        validator: 校验/解析函数，接收文本返回解析结果，失败时抛出 ValueError；
+                   只有通过校验的响应才会写入缓存
+    Returns:
+        validator 的返回值；未提供 validator 时返回原始文本
+    """
+    if messages is None:
+        messages = [{'role': 'user', 'content': prompt}]
+    parameters = parameters or {'result_format': 'text'}
+    validate = validator or (lambda text: text)
+
+    cache_key = llm_cache_key(model_name, messages, parameters) if use_cache else None
+    if cache_key:
+        if (config or {}).get('llm_cache_bypass'):
+            with llm_cache_lock:
+                llm_cache_runtime['stats']['bypassed'] += 1
+        else:
+            cached_text = llm_cache_get(cache_key)
+            if cached_text is not None:
+                try:
+                    return validate(cached_text)
+                except ValueError:
+                    pass
+
+    url = f'{base_url}/api/v1/services/aigc/text-generation/generation'
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+        'X-DashScope-SSE': 'disable'
+    }
+    data = {
+        'model': model_name,
+        'input': {
+            'messages': messages
+        },
+        'parameters': parameters
+    }
+
+    def send():
+        response = http_post(url, headers=headers, json=data, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+        return result, _qwen_usage_tokens(result.get('usage'))
+
+    result = work_scheduler.run(
+        'llm', call_qwen_with_limits, api_key, model_name, config, send,
+        estimate_qwen_tokens(messages, int(parameters.get('max_tokens', 500))),
+        **schedule_options(config)
+    )
+    if 'output' not in result or 'text' not in result['output']:
+        raise QwenResponseError('无法从 API 响应中提取内容', json.dumps(result, ensure_ascii=False))
+
+    raw_text = result['output']['text']
+    try:
+        value = validate(raw_text)
+    except ValueError as exc:
+        raise QwenResponseError(str(exc), raw_text)
+
+    if cache_key:
+        llm_cache_put(cache_key, model_name, raw_text)
+    return value
+
+# 默认的任务存储配置
+DEFAULT_TASK_STORE_CONFIG = {
+    'backend': 'sqlite',  # sqlite | memory
+    'path': os.path.join('cache', 'tasks.sqlite3'),
+    'retention_hours': 72,
+    'max_tasks': 200
+}
+
+def get_task_store_settings(config):
+    """合并默认任务存储配置和用户配置"""
+    merged = DEFAULT_TASK_STORE_CONFIG.copy()
+    user_cfg = (config or {}).get('task_store_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    if merged.get('backend') not in ('sqlite', 'memory'):
+        merged['backend'] = DEFAULT_TASK_STORE_CONFIG['backend']
+    merged['path'] = merged.get('path') or DEFAULT_TASK_STORE_CONFIG['path']
+    merged['retention_hours'] = max(1, int(merged.get('retention_hours', DEFAULT_TASK_STORE_CONFIG['retention_hours'])))
+    merged['max_tasks'] = max(1, int(merged.get('max_tasks', DEFAULT_TASK_STORE_CONFIG['max_tasks'])))
+    return merged
+
+def _compact_task_result(result):
+    """精简模式下的结果：去掉 images_info 中的蓝图、提示词等大字段"""
+    return {
+        'topic': result.get('topic'),
+        'article_title': result.get('article_title'),
+        'filename': result.get('filename'),
+        'image_count': result.get('image_count', 0),
+        'has_image': result.get('has_image', False)
+    }
+
+def _compact_topic_progress(live_progress):
+    """精简模式下的流式进度：不返回中间文本"""
+    return {
+        topic: {key: value for key, value in progress.items() if key != 'partial_text'}
+        for topic, progress in (live_progress or {}).items()
+    }
+
+def _build_task_delta(task, counts, changed_rows, live_progress, compact):
+    """组装增量状态：只包含 seq 大于游标的结果、错误和重新排队的主题"""
+    total = task['total']
+    completed_count = counts.get('done', 0) + counts.get('error', 0)
+    changed_rows = sorted(changed_rows, key=lambda row: row['seq'])
+    results = [row['result'] for row in changed_rows if row['status'] == 'done']
+    return {
+        'incremental': True,
+        'version': task['seq'],
+        'status': task['status'],
+        'progress': (completed_count / total) * 100 if total > 0 else 0,
+        'total': total,
+        'completed': completed_count,
+        'results': [_compact_task_result(result) for result in results] if compact else results,
+        'errors': [{'topic': row['topic'], 'error': row['error']} for row in changed_rows if row['status'] == 'error'],
+        'retrying': [row['topic'] for row in changed_rows if row['status'] in ('pending', 'running')],
+        'topic_progress': _compact_topic_progress(live_progress) if compact else dict(live_progress or {})
+    }
+
+def _compact_task_snapshot(snapshot):
+    """将完整状态快照转换为精简模式"""
+    snapshot['results'] = [_compact_task_result(result) for result in snapshot['results']]
+    snapshot['topic_progress'] = _compact_topic_progress(snapshot['topic_progress'])
+    return snapshot
+
+def _build_task_snapshot(task, topic_rows, live_progress):
+    """将任务和主题行组装为状态接口返回的结构"""
+    done_rows = sorted((row for row in topic_rows if row['status'] == 'done'), key=lambda row: row['seq'])
+    error_rows = sorted((row for row in topic_rows if row['status'] == 'error'), key=lambda row: row['seq'])
+    total = task['total']
+    completed_count = len(done_rows) + len(error_rows)
+    return {
+        'version': task['seq'],
+        'status': task['status'],
+        'progress': (completed_count / total) * 100 if total > 0 else 0,
+        'results': [row['result'] for row in done_rows],
+        'errors': [{'topic': row['topic'], 'error': row['error']} for row in error_rows],
+        'total': total,
+        'topic_progress': dict(live_progress or {}),
+        'topic_images': task['topic_images']
+    }
+
+class MemoryTaskStore:
+    """进程内任务存储，重启后任务丢失；接口与 SQLiteTaskStore 一致"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._topics = {}
+        self._live = {}
+
+    def create_task(self, task_id, topics, topic_images):
+        now = time.time()
+        with self._lock:
+            self._tasks[task_id] = {
+                'status': 'running',
+                'total': len(topics),
+                'topic_images': topic_images or {},
+                'seq': 0,
+                'created_at': now,
+                'updated_at': now
+            }
+            self._topics[task_id] = [
+                {'position': index, 'topic': topic, 'status': 'pending', 'result': None, 'error': None, 'seq': 0}
+                for index, topic in enumerate(topics)
+            ]
+        self.evict()
+
+    def get_task(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            rows = [dict(row) for row in self._topics[task_id]]
+            return _build_task_snapshot(task, rows, self._live.get(task_id))
+
+    def get_task_delta(self, task_id, since, compact=False):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            counts = {}
+            changed_rows = []
+            for row in self._topics[task_id]:
+                counts[row['status']] = counts.get(row['status'], 0) + 1
+                if row['seq'] > since:
+                    changed_rows.append(dict(row))
+            return _build_task_delta(task, counts, changed_rows, self._live.get(task_id), compact)
+
+    def get_topic_images(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return dict(task['topic_images']) if task else {}
+
+    def list_tasks(self, status=None, limit=50):
+        with self._lock:
+            items = [
+                {'task_id': task_id, 'status': task['status'], 'total': task['total'],
+                 'created_at': task['created_at'], 'updated_at': task['updated_at']}
+                for task_id, task in self._tasks.items()
+                if status is None or task['status'] == status
+            ]
+        items.sort(key=lambda item: item['updated_at'], reverse=True)
+        return items[:limit]
+
+    def _find_row(self, task_id, topic, statuses):
+        for row in self._topics.get(task_id, []):
+            if row['topic'] == topic and row['status'] in statuses:
+                return row
+        return None
+
+    def _finish_row(self, task_id, topic, status, result=None, error=None):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            row = self._find_row(task_id, topic, ('running', 'pending'))
+            if row is None:
+                return
+            task['seq'] += 1
+            task['updated_at'] = time.time()
+            row.update({'status': status, 'result': result, 'error': error, 'seq': task['seq']})
+            self._live.get(task_id, {}).pop(topic, None)
+
+    def mark_topic_started(self, task_id, topic):
+        with self._lock:
+            row = self._find_row(task_id, topic, ('pending',))
+            if row is not None:
+                row['status'] = 'running'
+
+    def record_result(self, task_id, topic, result):
+        self._finish_row(task_id, topic, 'done', result=result)
+
+    def record_error(self, task_id, topic, error):
+        self._finish_row(task_id, topic, 'error', error=error)
+
+    def update_topic_progress(self, task_id, topic, progress):
+        with self._lock:
+            if task_id in self._tasks:
+                self._live.setdefault(task_id, {})[topic] = progress
+
+    def reset_topics_for_retry(self, task_id, topics):
+        """将指定主题的失败记录重置为待处理，返回实际重置的主题列表，任务不存在时返回 None"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            reset = []
+            for row in self._topics[task_id]:
+                if row['topic'] in topics and row['status'] == 'error':
+                    task['seq'] += 1
+                    row.update({'status': 'pending', 'error': None, 'seq': task['seq']})
+                    reset.append(row['topic'])
+            if reset:
+                task['status'] = 'running'
+                task['updated_at'] = time.time()
+            return reset
+
+    def get_unfinished_topics(self, task_id):
+        with self._lock:
+            return [row['topic'] for row in self._topics.get(task_id, []) if row['status'] in ('pending', 'running')]
+
+    def complete_if_finished(self, task_id):
+        """所有主题都有结果时将任务标记为 completed"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return False
+            if any(row['status'] in ('pending', 'running') for row in self._topics[task_id]):
+                return False
+            task['status'] = 'completed'
+            task['updated_at'] = time.time()
+            self._live.pop(task_id, None)
+            return True
+
+    def set_status(self, task_id, status):
+        with self._lock:
+            if task_id in self._tasks:
+                self._tasks[task_id]['status'] = status
+                self._tasks[task_id]['updated_at'] = time.time()
+
+    def evict(self):
+        """淘汰超过保留时间或超出数量上限的已结束任务"""
+        cutoff = time.time() - self.settings['retention_hours'] * 3600
+        with self._lock:
+            finished = sorted(
+                (task['updated_at'], task_id) for task_id, task in self._tasks.items()
+                if task['status'] != 'running'
+            )
+            overflow = max(0, len(self._tasks) - self.settings['max_tasks'])
+            for index, (updated_at, task_id) in enumerate(finished):
+                if updated_at < cutoff or index < overflow:
+                    self._tasks.pop(task_id, None)
+                    self._topics.pop(task_id, None)
+                    self._live.pop(task_id, None)
+
+class SQLiteTaskStore:
+    """基于 SQLite 的持久化任务存储
+
+    每个主题一行，按任务 ID 和状态建立索引；流式生成的中间文本只保存在内存中。
+    启动时会把上次进程遗留的 running 任务标记为 interrupted，可通过 /api/generate/resume 继续。
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._live = {}
+        path = settings['path']
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                topic_images TEXT,
+                seq INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status, updated_at);
+            CREATE TABLE IF NOT EXISTS task_topics (
+                task_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                topic TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                seq INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (task_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS idx_task_topics_status ON task_topics(task_id, status);
+            CREATE INDEX IF NOT EXISTS idx_task_topics_seq ON task_topics(task_id, seq);
+        ''')
+        self._recover_interrupted()
+
+    def _recover_interrupted(self):
+        with self._lock, self._conn:
+            now = time.time()
+            self._conn.execute("UPDATE task_topics SET status = 'pending', updated_at = ? WHERE status = 'running'", (now,))
+            self._conn.execute("UPDATE tasks SET status = 'interrupted', updated_at = ? WHERE status = 'running'", (now,))
+
+    def create_task(self, task_id, topics, topic_images):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO tasks (task_id, status, total, topic_images, seq, created_at, updated_at) VALUES (?, ?, ?, ?, 0, ?, ?)',
+                (task_id, 'running', len(topics), json.dumps(topic_images or {}, ensure_ascii=False), now, now)
+            )
+            self._conn.executemany(
+                "INSERT INTO task_topics (task_id, position, topic, status, seq, updated_at) VALUES (?, ?, ?, 'pending', 0, ?)",
+                [(task_id, index, topic, now) for index, topic in enumerate(topics)]
+            )
+        self.evict()
+
+    def _load_task(self, task_id):
+        row = self._conn.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'status': row['status'],
+            'total': row['total'],
+            'topic_images': json.loads(row['topic_images'] or '{}'),
+            'seq': row['seq'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    def _load_topic_rows(self, task_id, since=None):
+        if since is None:
+            rows = self._conn.execute(
+                'SELECT position, topic, status, result, error, seq FROM task_topics WHERE task_id = ? ORDER BY position',
+                (task_id,)
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                'SELECT position, topic, status, result, error, seq FROM task_topics WHERE task_id = ? AND seq > ? ORDER BY seq',
+                (task_id, since)
+            ).fetchall()
+        return [{
+            'position': row['position'],
+            'topic': row['topic'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'seq': row['seq']
+        } for row in rows]
+
+    def get_task(self, task_id):
+        with self._lock:
+            task = self._load_task(task_id)
+            if task is None:
+                return None
+            rows = self._load_topic_rows(task_id)
+            return _build_task_snapshot(task, rows, self._live.get(task_id))
+
+    def get_task_delta(self, task_id, since, compact=False):
+        with self._lock:
+            task = self._load_task(task_id)
+            if task is None:
+                return None
+            counts = dict(self._conn.execute(
+                'SELECT status, COUNT(*) FROM task_topics WHERE task_id = ? GROUP BY status', (task_id,)
+            ).fetchall())
+            changed_rows = self._load_topic_rows(task_id, since) if since < task['seq'] else []
+            return _build_task_delta(task, counts, changed_rows, self._live.get(task_id), compact)
+
+    def get_topic_images(self, task_id):
+        with self._lock:
+            task = self._load_task(task_id)
+            return task['topic_images'] if task else {}
+
+    def list_tasks(self, status=None, limit=50):
+        with self._lock:
+            if status:
+                rows = self._conn.execute(
+                    'SELECT task_id, status, total, created_at, updated_at FROM tasks WHERE status = ? ORDER BY updated_at DESC LIMIT ?',
+                    (status, limit)
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    'SELECT task_id, status, total, created_at, updated_at FROM tasks ORDER BY updated_at DESC LIMIT ?',
+                    (limit,)
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _finish_row(self, task_id, topic, status, result=None, error=None):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT position FROM task_topics WHERE task_id = ? AND topic = ? AND status IN ('running', 'pending') ORDER BY position LIMIT 1",
+                (task_id, topic)
+            ).fetchone()
+            if row is None:
+                return
+            now = time.time()
+            self._conn.execute('UPDATE tasks SET seq = seq + 1, updated_at = ? WHERE task_id = ?', (now, task_id))
+            seq = self._conn.execute('SELECT seq FROM tasks WHERE task_id = ?', (task_id,)).fetchone()[0]
+            self._conn.execute(
+                'UPDATE task_topics SET status = ?, result = ?, error = ?, seq = ?, updated_at = ? WHERE task_id = ? AND position = ?',
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, seq, now, task_id, row['position'])
+            )
+            self._live.get(task_id, {}).pop(topic, None)
+
+    def mark_topic_started(self, task_id, topic):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE task_topics SET status = 'running', updated_at = ? WHERE rowid = ("
+                "SELECT rowid FROM task_topics WHERE task_id = ? AND topic = ? AND status = 'pending' ORDER BY position LIMIT 1)",
+                (time.time(), task_id, topic)
+            )
+
+    def record_result(self, task_id, topic, result):
+        self._finish_row(task_id, topic, 'done', result=result)
+
+    def record_error(self, task_id, topic, error):
+        self._finish_row(task_id, topic, 'error', error=error)
+
+    def update_topic_progress(self, task_id, topic, progress):
+        with self._lock:
+            self._live.setdefault(task_id, {})[topic] = progress
+
+    def reset_topics_for_retry(self, task_id, topics):
+        """将指定主题的失败记录重置为待处理，返回实际重置的主题列表，任务不存在时返回 None"""
+        with self._lock, self._conn:
+            if self._load_task(task_id) is None:
+                return None
+            now = time.time()
+            rows = self._conn.execute(
+                "SELECT position, topic FROM task_topics WHERE task_id = ? AND status = 'error' ORDER BY position",
+                (task_id,)
+            ).fetchall()
+            reset = []
+            for row in rows:
+                if row['topic'] in topics:
+                    # 重置的主题也分配新的 seq，增量状态接口据此通知客户端移除旧错误
+                    self._conn.execute('UPDATE tasks SET seq = seq + 1 WHERE task_id = ?', (task_id,))
+                    self._conn.execute(
+                        "UPDATE task_topics SET status = 'pending', error = NULL, seq = (SELECT seq FROM tasks WHERE task_id = ?), updated_at = ? "
+                        "WHERE task_id = ? AND position = ?",
+                        (task_id, now, task_id, row['position'])
+                    )
+                    reset.append(row['topic'])
+            if reset:
+                self._conn.execute("UPDATE tasks SET status = 'running', updated_at = ? WHERE task_id = ?", (now, task_id))
+            return reset
+
+    def get_unfinished_topics(self, task_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT topic FROM task_topics WHERE task_id = ? AND status IN ('pending', 'running') ORDER BY position",
+                (task_id,)
+            ).fetchall()
+        return [row['topic'] for row in rows]
+
+    def complete_if_finished(self, task_id):
+        """所有主题都有结果时将任务标记为 completed"""
+        with self._lock, self._conn:
+            remaining = self._conn.execute(
+                "SELECT COUNT(*) FROM task_topics WHERE task_id = ? AND status IN ('pending', 'running')",
+                (task_id,)
+            ).fetchone()[0]
+            if remaining:
+                return False
+            self._conn.execute("UPDATE tasks SET status = 'completed', updated_at = ? WHERE task_id = ?", (time.time(), task_id))
+            self._live.pop(task_id, None)
+            return True
+
+    def set_status(self, task_id, status):
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE tasks SET status = ?, updated_at = ? WHERE task_id = ?', (status, time.time(), task_id))
+
+    def evict(self):
+        """淘汰超过保留时间或超出数量上限的已结束任务"""
+        cutoff = time.time() - self.settings['retention_hours'] * 3600
+        with self._lock, self._conn:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT task_id FROM tasks WHERE status != 'running' AND updated_at < ?", (cutoff,)
+            )]
+            total = self._conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+            overflow = max(0, total - len(expired) - self.settings['max_tasks'])
+            if overflow:
+                expired += [row[0] for row in self._conn.execute(
+                    "SELECT task_id FROM tasks WHERE status != 'running' AND updated_at >= ? ORDER BY updated_at ASC LIMIT ?",
+                    (cutoff, overflow)
+                )]
+            for task_id in expired:
+                self._conn.execute('DELETE FROM task_topics WHERE task_id = ?', (task_id,))
+                self._conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+                self._live.pop(task_id, None)
+
+def create_task_store(config):
+    """根据配置创建任务存储（后端在进程启动时确定，修改后需重启生效）"""
+    settings = get_task_store_settings(config)
+    if settings['backend'] == 'memory':
+        return MemoryTaskStore(settings)
+    return SQLiteTaskStore(settings)
+
+# 任务事件推送（SSE）：每个任务保留最近的事件环形缓冲，供断线重连时按 Last-Event-ID 补发
+# 事件 ID 形如 "<进程启动标识>:<序号>"，服务重启后旧 ID 无法续接，此时改为推送完整快照
+TASK_EVENT_BUFFER_SIZE = 500
+TASK_EVENT_MAX_TASKS = 200
+TASK_EVENT_KEEPALIVE_SECONDS = 15
+task_event_boot_id = uuid.uuid4().hex[:8]
+task_event_condition = threading.Condition()
+task_event_buffers = OrderedDict()  # task_id -> {'next_id': int, 'events': deque}
+
+def publish_task_event(task_id, event_type, data):
+    """向订阅该任务的 SSE 连接发布事件"""
+    with task_event_condition:
+        buffer = task_event_buffers.get(task_id)
+        if buffer is None:
+            buffer = {'next_id': 1, 'events': deque(maxlen=TASK_EVENT_BUFFER_SIZE)}
+            task_event_buffers[task_id] = buffer
+            while len(task_event_buffers) > TASK_EVENT_MAX_TASKS:
+                task_event_buffers.popitem(last=False)
+        else:
+            task_event_buffers.move_to_end(task_id)
+        buffer['events'].append((buffer['next_id'], event_type, data))
+        buffer['next_id'] += 1
+        task_event_condition.notify_all()
+
+def _parse_task_event_id(last_event_id):
+    """解析 Last-Event-ID，返回本进程内的事件序号；无法续接时返回 None"""
+    if not last_event_id or ':' not in last_event_id:
+        return None
+    boot_id, _, seq = last_event_id.partition(':')
+    if boot_id != task_event_boot_id or not seq.isdigit():
+        return None
+    return int(seq)
+
+def _get_task_events_after(task_id, last_seq):
+    """返回 (事件列表, 是否完整)；缓冲已丢弃所需事件时 是否完整 为 False"""
+    buffer = task_event_buffers.get(task_id)
+    if buffer is None:
+        return [], last_seq == 0
+    events = [event for event in buffer['events'] if event[0] > last_seq]
+    oldest = buffer['events'][0][0] if buffer['events'] else buffer['next_id']
+    return events, oldest <= last_seq + 1
+
+def _format_sse(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {task_event_boot_id}:{event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
 # 配置文件路径
 CONFIG_FILE = 'config.json'
 
+# 进程级配置快照：仅在文件 mtime 变化或保存配置时重新加载
+# current 保存 (文件签名, 配置字典)，整体替换以保证读取到的快照前后一致
+config_store_lock = threading.Lock()
+config_store = {
+    'current': (None, {})
+}
+
+def _config_file_signature():
+    """返回配置文件的 (mtime, size)，文件不存在时返回 None"""
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
 def load_config():
-    """加载配置文件"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    """加载配置（返回内存快照的副本，文件变化时自动重新读取）"""
+    signature = _config_file_signature()
+    cached_signature, snapshot = config_store['current']
+    if signature != cached_signature:
+        with config_store_lock:
+            cached_signature, snapshot = config_store['current']
+            if signature != cached_signature:
+                snapshot = {}
+                if signature is not None:
+                    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                        snapshot = json.load(f)
+                config_store['current'] = (signature, snapshot)
+    return copy.deepcopy(snapshot)
 
 def save_config(config):
-    """保存配置文件"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
-
-# 初始化线程池的函数
-def create_executor(max_workers=3):
-    global executor
-    # 检查现有的 executor 是否需要关闭
-    if 'executor' in globals() and executor:
-        executor.shutdown(wait=False)
-    executor = ThreadPoolExecutor(max_workers=max_workers)
-
-# 应用程序启动时创建线程池
+    """保存配置文件（写入临时文件后原子替换，并同步更新内存快照）"""
+    config_dir = os.path.dirname(os.path.abspath(CONFIG_FILE))
+    temp_path = os.path.join(config_dir, f'.{os.path.basename(CONFIG_FILE)}.{uuid.uuid4().hex[:8]}.tmp')
+    snapshot = copy.deepcopy(config)
+    with config_store_lock:
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, CONFIG_FILE)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        config_store['current'] = (_config_file_signature(), snapshot)
+
+def get_image_pipeline_workers(config):
+    """计算图片阶段的并发数，未配置时为并发任务数的两倍"""
+    workers = int(config.get('image_pipeline_workers', 0) or 0)
+    if workers <= 0:
+        workers = int(config.get('max_concurrent_tasks', 3) or 3) * 2
+    return max(1, workers)
+
+# 默认的全局调度配置（0 表示按并发任务数自动计算）
+DEFAULT_SCHEDULER_CONFIG = {
+    'llm_workers': 0,
+    'pandoc_workers': 2,
+    'thumbnail_workers': 2
+}
+
+# 调度阶段。阶段之间只允许按下列方向等待，保证不会出现循环等待：
+# article -> llm / image / pandoc，image -> llm / comfyui；llm、comfyui、pandoc、thumbnail 不等待其他阶段
+SCHEDULER_STAGES = ('article', 'llm', 'image', 'comfyui', 'pandoc', 'thumbnail')
+
+def get_comfyui_comfy_stage_workers(config):
+    """计算 comfyui 调度阶段的线程数"""
+    settings = get_comfyui_settings(config)
+    queue_size = get_comfyui_total_queue_size(settings)
+    if not settings['pipeline']:
+        return queue_size
+    return queue_size * max(2, settings['batch_size'])
+
+def get_scheduler_settings(config):
+    """合并默认调度配置和用户配置"""
+    merged = DEFAULT_SCHEDULER_CONFIG.copy()
+    user_cfg = (config or {}).get('scheduler_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['llm_workers'] = max(0, int(merged.get('llm_workers') or 0))
+    merged['pandoc_workers'] = max(1, int(merged.get('pandoc_workers') or DEFAULT_SCHEDULER_CONFIG['pandoc_workers']))
+    merged['thumbnail_workers'] = max(1, int(merged.get('thumbnail_workers') or DEFAULT_SCHEDULER_CONFIG['thumbnail_workers']))
+    return merged
+
+def get_scheduler_limits(config):
+    """计算各调度阶段的并发上限"""
+    settings = get_scheduler_settings(config)
+    max_tasks = max(1, int(config.get('max_concurrent_tasks', 3) or 3))
+    return {
+        'article': max_tasks,
+        # 文章流式生成会长时间占用 llm 阶段，默认留出同样数量给摘要和视觉蓝图
+        'llm': settings['llm_workers'] or max_tasks * 2,
+        'image': get_image_pipeline_workers(config),
+        # 流水线模式下部分工作在下载图片或等待合并，多留出一倍线程保持 ComfyUI 队列饱和
+        'comfyui': get_comfyui_comfy_stage_workers(config),
+        'pandoc': settings['pandoc_workers'],
+        # 缩略图在请求线程中等待生成，后台预生成也在此阶段排队
+        'thumbnail': settings['thumbnail_workers']
+    }
+
+class WorkScheduler:
+    """进程级工作调度器
+
+    每个阶段有独立的工作线程和并发上限，排队的工作按优先级从高到低执行，
+    同一优先级内在各任务之间轮转，避免大批量任务饿死后提交的小任务。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._stages = {}
+        self._local = threading.local()
+
+    def configure(self, limits):
+        """设置各阶段的并发上限；调小时多余的线程在完成当前工作后退出"""
+        with self._cond:
+            for stage, workers in limits.items():
+                state = self._stages.setdefault(stage, {
+                    'workers': 0, 'alive': 0, 'running': 0, 'completed': 0,
+                    'queues': {}  # priority -> OrderedDict(task_id -> deque)
+                })
+                state['workers'] = max(1, int(workers))
+                while state['alive'] < state['workers']:
+                    state['alive'] += 1
+                    threading.Thread(
+                        target=self._worker, args=(stage,), daemon=True,
+                        name=f'scheduler-{stage}-{state["alive"]}'
+                    ).start()
+            self._cond.notify_all()
+
+    def submit(self, stage, fn, *args, task_id=None, priority=0, **kwargs):
+        """提交工作到指定阶段，返回 Future"""
+        future = Future()
+        with self._cond:
+            queues = self._stages[stage]['queues'].setdefault(priority, OrderedDict())
+            queues.setdefault(task_id, deque()).append((future, fn, args, kwargs))
+            self._cond.notify_all()
+        return future
+
+    def run(self, stage, fn, *args, task_id=None, priority=0, **kwargs):
+        """在指定阶段执行并等待结果；当前线程已属于该阶段时直接执行，避免占满自身线程而死锁"""
+        if getattr(self._local, 'stage', None) == stage:
+            return fn(*args, **kwargs)
+        return self.submit(stage, fn, *args, task_id=task_id, priority=priority, **kwargs).result()
+
+    def _next_job(self, state):
+        for priority in sorted(state['queues'], reverse=True):
+            queues = state['queues'][priority]
+            # 取队首任务的一项工作后将该任务移到队尾，实现任务间轮转
+            task_id, jobs = next(iter(queues.items()))
+            job = jobs.popleft()
+            if jobs:
+                queues.move_to_end(task_id)
+            else:
+                del queues[task_id]
+            if not queues:
+                del state['queues'][priority]
+            return job
+        return None
+
+    def _worker(self, stage):
+        self._local.stage = stage
+        state = self._stages[stage]
+        while True:
+            with self._cond:
+                while True:
+                    if state['alive'] > state['workers']:
+                        state['alive'] -= 1
+                        return
+                    job = self._next_job(state)
+                    if job:
+                        break
+                    self._cond.wait()
+                state['running'] += 1
+
+            future, fn, args, kwargs = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as exc:
+                    future.set_exception(exc)
+
+            with self._cond:
+                state['running'] -= 1
+                state['completed'] += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                stage: {
+                    'workers': state['workers'],
+                    'running': state['running'],
+                    'queued': sum(len(jobs) for queues in state['queues'].values() for jobs in queues.values()),
+                    'queued_tasks': len({task_id for queues in state['queues'].values() for task_id in queues}),
+                    'completed': state['completed']
+                }
+                for stage, state in self._stages.items()
+            }
+
+work_scheduler = WorkScheduler()
+
+def update_scheduler_runtime(config):
+    """根据配置调整各调度阶段的并发上限"""
+    limits = get_scheduler_limits(config)
+    work_scheduler.configure(limits)
+    return limits
+
+def schedule_options(config):
+    """从配置中取出当前任务的调度参数（task_id 与优先级），用于 submit/run"""
+    config = config or {}
+    return {'task_id': config.get('task_id'), 'priority': int(config.get('task_priority', 0) or 0)}
+
+def start_generation_task(task_id, topics, config, priority=0):
+    """启动任务协调线程；主题本身的工作由全局调度器执行，协调线程只负责等待和汇总"""
+    config = dict(config, task_id=task_id, task_priority=priority)
+    threading.Thread(
+        target=_execute_generation_task, args=(task_id, topics, config),
+        daemon=True, name=f'task-{task_id[:8]}'
+    ).start()
+
+# 应用程序启动时初始化运行时组件
 config = load_config()
-initial_workers = config.get('max_concurrent_tasks', 3)
-create_executor(initial_workers)
 update_comfyui_runtime(config)
+update_scheduler_runtime(config)
+update_http_client_runtime(config)
+update_llm_cache_runtime(config)
+update_image_store_runtime(config)
+update_circuit_breaker_runtime(config)
+update_local_image_index_runtime(config)
+update_image_recent_use_runtime(config)
+task_store = create_task_store(config)
 
 @app.route('/')
 def index():
@@ -208,7 +2900,7 @@ def test_unsplash():
         headers = {'Authorization': f'Client-ID {access_key}'}
         params = {'query': 'nature', 'per_page': 1}
 
-        response = requests.get(search_url, headers=headers, params=params, timeout=10)
+        response = http_get(search_url, headers=headers, params=params, timeout=10)
 
         if response.status_code == 401:
             return jsonify({'success': False, 'error': 'Access Key 无效或已过期'})
@@ -249,7 +2941,7 @@ def test_pexels():
         headers = {'Authorization': api_key}
         params = {'query': 'nature', 'per_page': 1}
 
-        response = requests.get(search_url, headers=headers, params=params, timeout=10)
+        response = http_get(search_url, headers=headers, params=params, timeout=10)
 
         if response.status_code == 401:
             return jsonify({'success': False, 'error': 'API Key 无效或已过期'})
@@ -289,7 +2981,7 @@ def test_pixabay():
         search_url = 'https://pixabay.com/api/'
         params = {'key': api_key, 'q': 'nature', 'per_page': 3}
 
-        response = requests.get(search_url, params=params, timeout=10)
+        response = http_get(search_url, params=params, timeout=10)
 
         if response.status_code == 401 or response.status_code == 400:
             return jsonify({'success': False, 'error': 'API Key 无效或已过期'})
@@ -367,6 +3059,30 @@ def test_comfyui():
         return jsonify({'success': False, 'error': f'测试失败: {str(e)}'}), 500
 
 
+def _parse_topics_response(raw_text):
+    """从选题响应中解析话题数组，无法解析时抛出 ValueError"""
+    # 尝试提取JSON部分
+    json_match = re.search(r'\[.*\]', raw_text, re.S)
+    if json_match:
+        try:
+            return json.loads(json_match.group())
+        except json.JSONDecodeError:
+            pass
+
+    # 如果无法解析为数组，尝试查找对象内容
+    json_match = re.search(r'\{.*\}', raw_text, re.S)
+    if json_match:
+        try:
+            data = json.loads(json_match.group())
+            # 如果返回的数据不是数组格式，则封装为数组
+            if not isinstance(data, list):
+                return [data]
+            return data
+        except json.JSONDecodeError:
+            pass
+
+    raise ValueError('无法解析API返回的数据')
+
 @app.route('/api/auto-select-topics', methods=['POST'])
 def auto_select_topics():
     """自动选择文章主体 - 使用通义千问获取今日热点话题"""
@@ -381,101 +3097,385 @@ def auto_select_topics():
         if not api_key:
             return jsonify({'success': False, 'error': '请先配置阿里云 API Key'}), 400
 
-        url = f'{base_url}/api/v1/services/aigc/text-generation/generation'
-
         model_name = config.get('default_model', 'qwen-plus-2025-09-11')  # Use configured default model
-        payload = {
-            "model": model_name,
-            "input": {
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant"
-                    },
-                    {
-                        "role": "user",
-                        "content": f"你是一个新闻热点与内容创作专家。任务：实时联网检索今日（检索时间：{datetime.now().strftime('%Y-%m-%d')}）网络热点，优先来源包括微博热搜、知乎、今日头条、百度热搜、抖音热榜及主流媒体要闻。目标：从今日热点中筛选出{count}个最有可能引发大量讨论、且观点冲突明显的主题，并为每个主题给出可直接用于撰写“咪蒙风格”观点文章的选题包，同时要检索相关主题的关联图片数据，*要求图片数据是可直接访问的URL，若URL不可访问则不要提供*。高层特征示例：情绪化、第一人称叙述、强烈对比与情绪引导、故事化短句、针砭时弊但避免造谣或人身攻击。\\r\\n\\r\\n 输出要求（每个主题控制在100–300字）：\\r\\n\\r\\n一句话标题（吸引眼球），对应的key是 topic；\\r\\n事件摘要（50–80字，事实要点并标注来源链接并注明检索时间），对应的key是 desc；\\r\\n为什么会引发争议（列3点）,对应的key是 why；\\r\\n关键词与热搜词/标签建议,对应的key是 tag；\\r\\n关联的可访问图片地址，若无图片不处理，对应的key是 picList；\\r\\n约束与注意事项：\\r\\n\\r\\n所有话题必须是真实的热点话题，不得捏造话题数据，所有事实类断言必须标注来源或注明“来源/检索时间/话题地址”，不得捏造事实或散布未经证实传言。\\r\\n避免人身攻击、仇恨言论、违法教唆和详细违法手段。遇敏感话题请给出安全且合法的替代切入角度。\\r\\n 如果某主题风险过高（例如涉及未成年人性内容、重大个人隐私、正在调查的刑事案件），请过滤掉。\\r\\n 只有当你确认图片确实是可访问且与当前主题一致时，才输出到picList属性中，否则不处理。\\r\\n严格保证输出的争议话题是{count}条，不得出现条数不够的情况。\\r\\n如果你理解并准备开始，请输出“开始检索并列出Top{count}今日争议话题”，并在每个主题上按上述格式以JSON格式数据提供，使用对应的key维护。"
-                    }
-                ]
+        messages = [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant"
             },
-            "parameters": {
-                "enable_search": True,
-                "result_format": "text",
-                "search_options": {
-                    "forced_search": True
-                }
+            {
+                "role": "user",
+                "content": f"你是一个新闻热点与内容创作专家。任务：实时联网检索今日（检索时间：{datetime.now().strftime('%Y-%m-%d')}）网络热点，优先来源包括微博热搜、知乎、今日头条、百度热搜、抖音热榜及主流媒体要闻。目标：从今日热点中筛选出{count}个最有可能引发大量讨论、且观点冲突明显的主题，并为每个主题给出可直接用于撰写“咪蒙风格”观点文章的选题包，同时要检索相关主题的关联图片数据，*要求图片数据是可直接访问的URL，若URL不可访问则不要提供*。高层特征示例：情绪化、第一人称叙述、强烈对比与情绪引导、故事化短句、针砭时弊但避免造谣或人身攻击。\\r\\n\\r\\n 输出要求（每个主题控制在100–300字）：\\r\\n\\r\\n一句话标题（吸引眼球），对应的key是 topic；\\r\\n事件摘要（50–80字，事实要点并标注来源链接并注明检索时间），对应的key是 desc；\\r\\n为什么会引发争议（列3点）,对应的key是 why；\\r\\n关键词与热搜词/标签建议,对应的key是 tag；\\r\\n关联的可访问图片地址，若无图片不处理，对应的key是 picList；\\r\\n约束与注意事项：\\r\\n\\r\\n所有话题必须是真实的热点话题，不得捏造话题数据，所有事实类断言必须标注来源或注明“来源/检索时间/话题地址”，不得捏造事实或散布未经证实传言。\\r\\n避免人身攻击、仇恨言论、违法教唆和详细违法手段。遇敏感话题请给出安全且合法的替代切入角度。\\r\\n 如果某主题风险过高（例如涉及未成年人性内容、重大个人隐私、正在调查的刑事案件），请过滤掉。\\r\\n 只有当你确认图片确实是可访问且与当前主题一致时，才输出到picList属性中，否则不处理。\\r\\n严格保证输出的争议话题是{count}条，不得出现条数不够的情况。\\r\\n如果你理解并准备开始，请输出“开始检索并列出Top{count}今日争议话题”，并在每个主题上按上述格式以JSON格式数据提供，使用对应的key维护。"
+            }
+        ]
+        parameters = {
+            "enable_search": True,
+            "result_format": "text",
+            "search_options": {
+                "forced_search": True
             }
         }
 
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
+        print(f"✓ 请求主体获取: {messages}")
+        try:
+            topics_data = request_qwen_text(
+                api_key, base_url, model_name,
+                messages=messages,
+                parameters=parameters,
+                timeout=60,
+                config={'llm_cache_bypass': bool(data.get('bypass_cache'))},
+                validator=_parse_topics_response
+            )
+        except QwenResponseError as exc:
+            return jsonify({
+                'success': False,
+                'error': '无法解析API返回的数据',
+                'raw_response': exc.raw_text
+            }), 500
 
-        print(f"✓ 请求主体获取: {payload}")
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        print(f"✓ 请求主体返回: {result}")
-        if 'output' not in result or 'text' not in result['output']:
-            return jsonify({'success': False, 'error': '无法从API响应中获取内容'}), 500
+        print(f"✓ 请求主体返回: {topics_data}")
+        return jsonify({
+            'success': True,
+            'topics': topics_data
+        })
 
-        raw_text = result['output']['text']
+    except requests.exceptions.Timeout:
+        return jsonify({'success': False, 'error': '请求超时，请稍后重试'}), 500
+    except requests.exceptions.RequestException as e:
+        return jsonify({'success': False, 'error': f'API请求失败: {str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'自动选题失败: {str(e)}'}), 500
 
-        # 尝试提取JSON部分
-        json_match = re.search(r'\[.*\]', raw_text, re.S)
-        if json_match:
-            json_str = json_match.group()
-            try:
-                topics_data = json.loads(json_str)
-                return jsonify({
-                    'success': True,
-                    'topics': topics_data
-                })
-            except json.JSONDecodeError:
-                pass
 
-        # 如果无法解析为数组，尝试查找对象内容
-        json_match = re.search(r'\{.*\}', raw_text, re.S)
-        if json_match:
-            json_str = json_match.group()
-            try:
-                data = json.loads(json_str)
-                # 如果返回的数据不是数组格式，则封装为数组
-                if not isinstance(data, list):
-                    topics_data = [data]
-                else:
-                    topics_data = data
-                return jsonify({
-                    'success': True,
-                    'topics': topics_data
-                })
-            except json.JSONDecodeError:
-                pass
+@app.route('/api/check-pandoc', methods=['GET'])
+def check_pandoc():
+    """检查 Pandoc 配置状态"""
+    config = load_config()
+    pandoc_path = config.get('pandoc_path', '')
+    return jsonify({
+        'pandoc_configured': bool(pandoc_path),
+        'pandoc_path': pandoc_path if pandoc_path else None
+    })
 
-        return jsonify({
-            'success': False,
-            'error': '无法解析API返回的数据',
-            'raw_response': raw_text
-        }), 500
+@app.route('/api/llm-cache/stats', methods=['GET'])
+def llm_cache_stats():
+    """查看 LLM 响应缓存的命中情况"""
+    return jsonify({'success': True, 'stats': get_llm_cache_stats()})
+
+@app.route('/api/llm-cache/clear', methods=['POST'])
+def llm_cache_clear():
+    """清空 LLM 响应缓存"""
+    clear_llm_cache()
+    return jsonify({'success': True, 'message': '缓存已清空'})
+
+@app.route('/api/image-store/stats', methods=['GET'])
+def image_store_stats():
+    """查看图片仓库的复用率、引用情况和占用空间"""
+    return jsonify({'success': True, 'stats': get_image_store_stats()})
+
+@app.route('/api/image-store/gc', methods=['POST'])
+def image_store_gc():
+    """清理无引用的仓库图片，force=true 时忽略保留期"""
+    data = request.get_json(silent=True) or {}
+    removed = collect_image_store(force=bool(data.get('force')))
+    return jsonify({'success': True, 'removed': removed})
+
+@app.route('/api/image-search-cache/stats', methods=['GET'])
+def image_search_cache_stats_api():
+    """查看图库搜索结果缓存的命中情况"""
+    return jsonify({'success': True, 'stats': get_image_search_cache_stats()})
+
+@app.route('/api/image-sources/latency', methods=['GET'])
+def image_source_latency_api():
+    """查看各图片来源的平均延迟和当前对冲延迟"""
+    return jsonify({'success': True, **get_image_source_latency_stats(load_config())})
+
+@app.route('/api/providers/health', methods=['GET'])
+def providers_health():
+    """查看各外部服务（图库、ComfyUI、DashScope）的熔断状态、错误率与健康评分"""
+    # 未被调用过的服务也列出，便于确认初始状态
+    for name in CIRCUIT_BREAKER_IMAGE_SOURCES + ('dashscope',):
+        get_circuit_breaker(name)
+    return jsonify({'success': True, 'providers': get_provider_health()})
+
+@app.route('/api/comfyui/backends', methods=['GET'])
+def comfyui_backends():
+    """查看各 ComfyUI 服务器的权重、队列深度、健康状态与当前负载"""
+    return jsonify({'success': True, 'backends': get_comfyui_backend_status(get_comfyui_settings(load_config()))})
+
+@app.route('/api/comfyui/progress', methods=['GET'])
+def comfyui_progress():
+    """查看 ComfyUI 事件连接状态和进行中 prompt 的节点进度"""
+    return jsonify({'success': True, 'servers': get_comfyui_progress()})
+
+@app.route('/api/llm-rate-limit/stats', methods=['GET'])
+def llm_rate_limit_stats():
+    """查看各 API Key + 模型的限流状态（并发上限、剩余令牌、限流与重试次数）"""
+    return jsonify({'success': True, 'stats': get_llm_rate_limit_stats()})
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    """查看各调度阶段的并发上限、运行中与排队的工作数"""
+    return jsonify({'success': True, 'stats': work_scheduler.stats()})
+
+@app.route('/api/http-client/stats', methods=['GET'])
+def http_client_stats():
+    """查看连接池复用情况"""
+    return jsonify({'success': True, 'stats': get_http_client_stats()})
+
+# 默认的缩略图配置：首次请求时生成，按 (原图 sha256, 尺寸, 格式) 缓存到磁盘
+DEFAULT_THUMBNAIL_CONFIG = {
+    'enabled': True,
+    'path': os.path.join('cache', 'thumbnails'),
+    'sizes': [160, 320, 640],    # 允许的最长边尺寸，请求尺寸向上取整到其中之一
+    'default_size': 320,
+    'quality': 80,
+    'max_age': 7 * 24 * 3600,    # Cache-Control 缓存时间（秒）
+    'pregenerate': True,         # 上传后在后台预生成默认尺寸
+    'max_cache_mb': 512          # 缓存目录容量上限，超出时删除最久未访问的缩略图（0 表示不限制）
+}
+
+THUMBNAIL_FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+
+# 原图 (路径, 大小, mtime_ns) -> sha256，避免每次请求都重新读取原图
+thumbnail_hash_lock = threading.Lock()
+thumbnail_source_hashes = OrderedDict()
+THUMBNAIL_HASH_CACHE_SIZE = 10000
+
+# 缓存目录的容量检查间隔（秒），超出上限时清理到上限的 80%
+THUMBNAIL_PRUNE_INTERVAL = 600
+thumbnail_prune_lock = threading.Lock()
+thumbnail_prune_state = {'last_prune': 0}
+
+class ThumbnailError(Exception):
+    """缩略图请求无效（路径不允许、文件不存在或不是图片），status 为对应的 HTTP 状态码"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def get_thumbnail_settings(config):
+    """合并默认缩略图配置和用户配置"""
+    merged = DEFAULT_THUMBNAIL_CONFIG.copy()
+    user_cfg = (config or {}).get('thumbnail_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['path'] = merged.get('path') or DEFAULT_THUMBNAIL_CONFIG['path']
+    sizes = sorted({max(16, min(2048, int(size))) for size in (merged.get('sizes') or []) if str(size).isdigit()})
+    merged['sizes'] = sizes or list(DEFAULT_THUMBNAIL_CONFIG['sizes'])
+    merged['default_size'] = int(merged.get('default_size') or DEFAULT_THUMBNAIL_CONFIG['default_size'])
+    if merged['default_size'] not in merged['sizes']:
+        merged['default_size'] = min(merged['sizes'], key=lambda size: abs(size - merged['default_size']))
+    merged['quality'] = max(1, min(100, int(merged.get('quality') or DEFAULT_THUMBNAIL_CONFIG['quality'])))
+    merged['max_age'] = max(0, int(merged.get('max_age') or 0))
+    merged['pregenerate'] = bool(merged.get('pregenerate', True))
+    merged['max_cache_mb'] = max(0, float(merged.get('max_cache_mb') or 0))
+    return merged
+
+def _thumbnail_allowed_roots(config):
+    """允许生成缩略图的目录：上传目录、本地图库、输出目录和图片仓库"""
+    roots = [
+        config.get('uploaded_images_dir', 'uploads'),
+        config.get('output_directory', 'output'),
+        get_image_store_settings(config)['path']
+    ]
+    roots.extend(dir_config['path'] for dir_config in _normalize_local_image_directories(config))
+    return [os.path.realpath(root) for root in roots if root]
+
+def resolve_thumbnail_source(path, config):
+    """校验原图路径位于允许的目录内并且是支持的图片，返回真实路径"""
+    if not path:
+        raise ThumbnailError('缺少图片路径')
+    real_path = os.path.realpath(path)
+    if not any(real_path == root or real_path.startswith(root + os.sep) for root in _thumbnail_allowed_roots(config)):
+        raise ThumbnailError('不允许访问该路径', 403)
+    if not os.path.isfile(real_path) or not real_path.lower().endswith(tuple(ALLOWED_EXTENSIONS)):
+        raise ThumbnailError('图片不存在', 404)
+    return real_path
+
+def _thumbnail_source_hash(path):
+    """返回原图的 sha256（按路径、大小和 mtime 记忆），原图已被删除时抛出 ThumbnailError"""
+    try:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with thumbnail_hash_lock:
+            digest = thumbnail_source_hashes.get(key)
+            if digest:
+                thumbnail_source_hashes.move_to_end(key)
+                return digest
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+    except FileNotFoundError:
+        raise ThumbnailError('图片不存在', 404)
+    except OSError as e:
+        raise ThumbnailError(f'无法读取图片: {e}')
+    digest = sha.hexdigest()
+    with thumbnail_hash_lock:
+        thumbnail_source_hashes[key] = digest
+        while len(thumbnail_source_hashes) > THUMBNAIL_HASH_CACHE_SIZE:
+            thumbnail_source_hashes.popitem(last=False)
+    return digest
+
+def normalize_thumbnail_size(size, settings):
+    """把请求尺寸向上取整到允许的尺寸，限制缓存的派生图数量"""
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return settings['default_size']
+    for allowed in settings['sizes']:
+        if size <= allowed:
+            return allowed
+    return settings['sizes'][-1]
+
+def get_or_create_thumbnail(path, size, image_format, settings):
+    """返回 (缩略图路径, 原图 sha256)，缓存中没有时生成
+
+    缩略图保存在 <path>/<sha[:2]>/<sha>_<尺寸>.<格式>，先写临时文件再原子重命名，
+    并发请求同一缩略图时最多重复生成一次，不会读到半个文件。命中时刷新 mtime，容量清理据此淘汰最久未访问的文件。
+    """
+    digest = _thumbnail_source_hash(path)
+    pil_format = THUMBNAIL_FORMATS[image_format][0]
+    target = os.path.join(settings['path'], digest[:2], f'{digest}_{size}.{image_format}')
+    if os.path.exists(target):
+        try:
+            os.utime(target)
+        except OSError:
+            pass
+        return target, digest
 
-    except requests.exceptions.Timeout:
-        return jsonify({'success': False, 'error': '请求超时，请稍后重试'}), 500
-    except requests.exceptions.RequestException as e:
-        return jsonify({'success': False, 'error': f'API请求失败: {str(e)}'}), 500
-    except Exception as e:
-        return jsonify({'success': False, 'error': f'自动选题失败: {str(e)}'}), 500
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size), Image.LANCZOS)
+            if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                # JPEG 不支持透明通道，铺白色背景
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                rgba = img.convert('RGBA')
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                img = background
+            elif pil_format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    img.save(f, pil_format, quality=settings['quality'])
+                os.replace(temp_path, target)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+    except Image.DecompressionBombError as e:
+        raise ThumbnailError(f'图片像素过多，拒绝处理: {e}')
+    except (OSError, ValueError) as e:
+        raise ThumbnailError(f'无法读取图片: {e}')
+    _maybe_prune_thumbnail_cache(settings)
+    return target, digest
+
+def _maybe_prune_thumbnail_cache(settings):
+    """距上次检查超过 THUMBNAIL_PRUNE_INTERVAL 时清理缓存目录"""
+    with thumbnail_prune_lock:
+        now = time.time()
+        if now - thumbnail_prune_state['last_prune'] < THUMBNAIL_PRUNE_INTERVAL:
+            return
+        thumbnail_prune_state['last_prune'] = now
+    prune_thumbnail_cache(settings)
+
+def prune_thumbnail_cache(settings):
+    """缓存目录超过 max_cache_mb 时按 mtime 从旧到新删除缩略图，直到降到上限的 80%，返回删除的文件数"""
+    limit = settings['max_cache_mb'] * 1024 * 1024
+    if not limit:
+        return 0
+    entries, total = [], 0
+    for root, _, files in os.walk(settings['path']):
+        for name in files:
+            # 正在写入的临时文件不处理
+            if name.endswith('.part'):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_path))
+            total += stat.st_size
+    if total <= limit:
+        return 0
+    entries.sort()
+    removed = 0
+    for _, file_size, file_path in entries:
+        if total <= limit * 0.8:
+            break
+        try:
+            os.remove(file_path)
+        except OSError:
+            continue
+        total -= file_size
+        removed += 1
+    print(f"缩略图缓存超出 {settings['max_cache_mb']:g} MB，已删除 {removed} 个最久未访问的文件")
+    return removed
+
+def schedule_thumbnail_generation(path, config=None):
+    """上传完成后在后台生成默认尺寸的 WebP 与 JPEG 缩略图，失败只记录日志"""
+    config = config or load_config()
+    settings = get_thumbnail_settings(config)
+    if not settings['enabled'] or not settings['pregenerate']:
+        return
+
+    def generate():
+        for image_format in THUMBNAIL_FORMATS:
+            try:
+                get_or_create_thumbnail(path, settings['default_size'], image_format, settings)
+            except ThumbnailError as e:
+                print(f"预生成缩略图失败 {path}: {e}")
+                return
+
+    work_scheduler.submit('thumbnail', generate)
+
+def thumbnail_url(path, size=None):
+    """缩略图访问地址"""
+    params = {'path': path}
+    if size:
+        params['size'] = size
+    return f'/api/thumbnail?{urlencode(params)}'
+
+@app.route('/api/thumbnail', methods=['GET'])
+def thumbnail():
+    """返回图片缩略图（WebP/JPEG），参数 path、size、format
+
+    未指定 format 时按 Accept 头选择 WebP，否则 JPEG；响应带 ETag 和 Cache-Control，
+    If-None-Match 命中时返回 304。
+    """
+    config = load_config()
+    settings = get_thumbnail_settings(config)
+    if not settings['enabled']:
+        return jsonify({'success': False, 'error': '缩略图服务未启用'}), 404
 
+    image_format = (request.args.get('format') or '').lower().replace('jpg', 'jpeg')
+    if image_format not in THUMBNAIL_FORMATS:
+        image_format = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    size = normalize_thumbnail_size(request.args.get('size'), settings)
 
-@app.route('/api/check-pandoc', methods=['GET'])
-def check_pandoc():
-    """检查 Pandoc 配置状态"""
-    config = load_config()
-    pandoc_path = config.get('pandoc_path', '')
-    return jsonify({
-        'pandoc_configured': bool(pandoc_path),
-        'pandoc_path': pandoc_path if pandoc_path else None
-    })
+    try:
+        source = resolve_thumbnail_source(request.args.get('path', ''), config)
+        digest = _thumbnail_source_hash(source)
+        etag = f'{digest[:20]}-{size}-{image_format}'
+        cache_control = f'public, max-age={settings["max_age"]}'
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            target, _ = work_scheduler.run('thumbnail', get_or_create_thumbnail, source, size, image_format, settings)
+            response = send_file(os.path.abspath(target), mimetype=THUMBNAIL_FORMATS[image_format][1], etag=False, max_age=settings['max_age'])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.headers['Vary'] = 'Accept'
+        return response
+    except ThumbnailError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
 
 @app.route('/api/upload-image', methods=['POST'])
 def upload_image():
@@ -506,11 +3506,13 @@ def upload_image():
         filepath = os.path.join(upload_dir, safe_filename)
 
         file.save(filepath)
+        schedule_thumbnail_generation(filepath, config)
 
         return jsonify({
             'success': True,
             'filename': safe_filename,
             'path': filepath,
+            'thumbnail_url': thumbnail_url(filepath),
             'message': '图片上传成功'
         })
 
@@ -522,29 +3524,42 @@ def list_local_images():
     """列出本地图库中的所有图片"""
     try:
         config = load_config()
-        local_dirs = config.get('local_image_directories', [{'path': 'pic', 'tags': ['default']}])
-
-        images = []
-        for dir_config in local_dirs:
-            dir_path = dir_config.get('path', '')
-            dir_tags = dir_config.get('tags', [])
-
-            if os.path.exists(dir_path) and os.path.isdir(dir_path):
-                for file in os.listdir(dir_path):
-                    file_path = os.path.join(dir_path, file)
-                    if os.path.isfile(file_path) and file.lower().endswith(tuple(ALLOWED_EXTENSIONS)):
-                        images.append({
-                            'filename': file,
-                            'path': file_path,
-                            'directory': dir_path,
-                            'tags': dir_tags
-                        })
+        if local_image_index.settings['enabled'] and local_image_index.ready:
+            images = [
+                {
+                    'filename': entry['filename'],
+                    'path': entry['path'],
+                    'directory': entry['directory'],
+                    'tags': entry['tags'],
+                    'width': entry['width'],
+                    'height': entry['height'],
+                    'size': entry['size'],
+                    'thumbnail_url': thumbnail_url(entry['path'])
+                }
+                for entry in local_image_index.list_images()
+            ]
+        else:
+            local_dirs = config.get('local_image_directories', [{'path': 'pic', 'tags': ['default']}])
+            images = _scan_local_image_directories(local_dirs)
+            for image in images:
+                image['thumbnail_url'] = thumbnail_url(image['path'])
 
         return jsonify({'success': True, 'images': images, 'total': len(images)})
 
     except Exception as e:
         return jsonify({'success': False, 'error': f'获取图片列表失败: {str(e)}'}), 500
 
+@app.route('/api/local-image-index/stats', methods=['GET'])
+def local_image_index_stats():
+    """查看本地图库索引的规模与增量更新情况"""
+    return jsonify({'success': True, 'stats': local_image_index.snapshot()})
+
+@app.route('/api/local-image-index/rescan', methods=['POST'])
+def local_image_index_rescan():
+    """立即全量对账本地图库索引"""
+    local_image_index.refresh(force=True)
+    return jsonify({'success': True, 'stats': local_image_index.snapshot()})
+
 @app.route('/api/list-uploaded-images', methods=['GET'])
 def list_uploaded_images():
     """列出用户上传的所有图片"""
@@ -561,6 +3576,7 @@ def list_uploaded_images():
                     images.append({
                         'filename': file,
                         'path': file_path,
+                        'thumbnail_url': thumbnail_url(file_path),
                         'size': stat.st_size,
                         'created': datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S')
                     })
@@ -595,6 +3611,22 @@ def handle_config():
             'uploaded_images_dir': config.get('uploaded_images_dir', 'uploads'),
             'output_directory': config.get('output_directory', 'output'),
             'comfyui_settings': get_comfyui_settings(config),
+            'http_client_settings': get_http_client_settings(config),
+            'article_streaming': get_article_stream_settings(config),
+            'image_pipeline_workers': config.get('image_pipeline_workers', 0),
+            'enable_fused_visual_plan': config.get('enable_fused_visual_plan', True),
+            'llm_cache_settings': get_llm_cache_settings(config),
+            'image_store_settings': get_image_store_settings(config),
+            'image_search_cache_settings': get_image_search_cache_settings(config),
+            'image_hedge_settings': get_image_hedge_settings(config),
+            'circuit_breaker_settings': get_circuit_breaker_settings(config),
+            'local_image_index_settings': get_local_image_index_settings(config),
+            'image_recent_use_settings': get_image_recent_use_settings(config),
+            'thumbnail_settings': get_thumbnail_settings(config),
+            'task_store_settings': get_task_store_settings(config),
+            'scheduler_settings': get_scheduler_settings(config),
+            'llm_rate_limit': get_llm_rate_limit_settings(config),
+            'image_download_settings': get_image_download_settings(config),
             'comfyui_positive_style': config.get('comfyui_positive_style', ''),
             'comfyui_negative_style': config.get('comfyui_negative_style', ''),
             'comfyui_image_count': config.get('comfyui_image_count', 1),
@@ -626,7 +3658,23 @@ def handle_config():
             'comfyui_negative_style': new_config.get('comfyui_negative_style', old_config.get('comfyui_negative_style', '')),
             'comfyui_image_count': int(new_config.get('comfyui_image_count', old_config.get('comfyui_image_count', 1))),
             'comfyui_style_template': new_config.get('comfyui_style_template', old_config.get('comfyui_style_template', 'custom')),
-            'comfyui_summary_model': new_config.get('comfyui_summary_model', old_config.get('comfyui_summary_model', '__default__'))
+            'comfyui_summary_model': new_config.get('comfyui_summary_model', old_config.get('comfyui_summary_model', '__default__')),
+            'http_client_settings': new_config.get('http_client_settings', old_config.get('http_client_settings', {})),
+            'article_streaming': get_article_stream_settings({'article_streaming': new_config.get('article_streaming', old_config.get('article_streaming', {}))}),
+            'image_pipeline_workers': int(new_config.get('image_pipeline_workers', old_config.get('image_pipeline_workers', 0)) or 0),
+            'enable_fused_visual_plan': bool(new_config.get('enable_fused_visual_plan', old_config.get('enable_fused_visual_plan', True))),
+            'llm_cache_settings': get_llm_cache_settings({'llm_cache_settings': new_config.get('llm_cache_settings', old_config.get('llm_cache_settings', {}))}),
+            'image_store_settings': get_image_store_settings({'image_store_settings': new_config.get('image_store_settings', old_config.get('image_store_settings', {}))}),
+            'image_search_cache_settings': get_image_search_cache_settings({'image_search_cache_settings': new_config.get('image_search_cache_settings', old_config.get('image_search_cache_settings', {}))}),
+            'image_hedge_settings': get_image_hedge_settings({'image_hedge_settings': new_config.get('image_hedge_settings', old_config.get('image_hedge_settings', {}))}),
+            'circuit_breaker_settings': get_circuit_breaker_settings({'circuit_breaker_settings': new_config.get('circuit_breaker_settings', old_config.get('circuit_breaker_settings', {}))}),
+            'local_image_index_settings': get_local_image_index_settings({'local_image_index_settings': new_config.get('local_image_index_settings', old_config.get('local_image_index_settings', {}))}),
+            'image_recent_use_settings': get_image_recent_use_settings({'image_recent_use_settings': new_config.get('image_recent_use_settings', old_config.get('image_recent_use_settings', {}))}),
+            'thumbnail_settings': get_thumbnail_settings({'thumbnail_settings': new_config.get('thumbnail_settings', old_config.get('thumbnail_settings', {}))}),
+            'task_store_settings': get_task_store_settings({'task_store_settings': new_config.get('task_store_settings', old_config.get('task_store_settings', {}))}),
+            'scheduler_settings': get_scheduler_settings({'scheduler_settings': new_config.get('scheduler_settings', old_config.get('scheduler_settings', {}))}),
+            'llm_rate_limit': get_llm_rate_limit_settings({'llm_rate_limit': new_config.get('llm_rate_limit', old_config.get('llm_rate_limit', {}))}),
+            'image_download_settings': get_image_download_settings({'image_download_settings': new_config.get('image_download_settings', old_config.get('image_download_settings', {}))})
         }
 
         # 处理 API 密钥
@@ -667,9 +3715,18 @@ def handle_config():
             final_config['comfyui_summary_model'] = '__default__'
 
         save_config(final_config)
-        # 更新线程池大小
-        create_executor(final_config.get('max_concurrent_tasks', 3))
         update_comfyui_runtime(final_config)
+        # 更新各调度阶段的并发上限
+        update_scheduler_runtime(final_config)
+        update_http_client_runtime(final_config)
+        update_llm_cache_runtime(final_config)
+        update_image_store_runtime(final_config)
+        update_circuit_breaker_runtime(final_config)
+        update_local_image_index_runtime(final_config)
+        update_image_recent_use_runtime(final_config)
+        # 任务存储后端需重启生效，保留策略立即生效
+        store_settings = final_config['task_store_settings']
+        task_store.settings.update(retention_hours=store_settings['retention_hours'], max_tasks=store_settings['max_tasks'])
         return jsonify({'success': True, 'message': '配置保存成功'})
 
 @app.route('/api/models')
@@ -731,16 +3788,18 @@ def test_qwen_model():
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-
-        if response.status_code == 401:
-            return jsonify({'success': False, 'error': 'API Key 无效或已过期'})
-        elif response.status_code == 403:
-            return jsonify({'success': False, 'error': '权限不足或配额已用完'})
-        elif response.status_code == 404:
-            return jsonify({'success': False, 'error': f'模型 {model_name} 不存在'})
-
-        response.raise_for_status()
+        def send():
+            # HTTP 错误以 HTTPError 抛出，限流器和熔断器才能正确记录 429/5xx
+            response = http_post(url, headers=headers, json=payload, timeout=30)
+            response.raise_for_status()
+            return response, None
+
+        # 测试请求也计入限流，但不重试，以便如实反馈限流状态
+        response = call_qwen_with_limits(
+            api_key, model_name, load_config(), send,
+            estimate_qwen_tokens(payload['input']['messages'], 100),
+            max_retries=0
+        )
 
         result = response.json()
 
@@ -759,7 +3818,18 @@ def test_qwen_model():
     except requests.exceptions.ConnectionError:
         return jsonify({'success': False, 'error': '无法连接到 API 服务器，请检查 Base URL 和网络'})
     except requests.exceptions.HTTPError as e:
+        status_code = e.response.status_code if e.response is not None else None
+        if status_code == 401:
+            return jsonify({'success': False, 'error': 'API Key 无效或已过期'})
+        elif status_code == 403:
+            return jsonify({'success': False, 'error': '权限不足或配额已用完'})
+        elif status_code == 404:
+            return jsonify({'success': False, 'error': f'模型 {model_name} 不存在'})
+        elif status_code == 429:
+            return jsonify({'success': False, 'error': '请求过于频繁，已触发限流'})
         return jsonify({'success': False, 'error': f'HTTP 错误: {str(e)}'})
+    except CircuitOpenError as e:
+        return jsonify({'success': False, 'error': str(e)})
     except Exception as e:
         return jsonify({'success': False, 'error': f'测试失败: {str(e)}'})
 
@@ -823,8 +3893,273 @@ def get_image_with_priority(keyword, config, user_uploaded_path=None):
     print("所有图片源都失败，将不使用配图")
     return None
 
+# 默认的图片来源对冲配置：serial 逐个回退；delay 在上一来源迟迟未返回时延迟启动下一来源；all 同时启动全部来源
+# ComfyUI 属于生成而非检索，始终按优先级单独执行，对冲只作用于其前后连续的检索类来源
+DEFAULT_IMAGE_HEDGE_CONFIG = {
+    'mode': 'delay',
+    'hedge_delay_ms': 1500,
+    'adaptive': True,          # 按来源的历史延迟自动调整对冲延迟
+    'min_delay_ms': 200,
+    'max_delay_ms': 8000,
+    'deadline_seconds': 20     # 截止时间内优先等待更高优先级的来源，超时后取已到达的最佳结果
+}
+
+IMAGE_HEDGE_MODES = ('serial', 'delay', 'all')
+
+# 各图片来源的延迟统计（平滑均值 + 平均偏差，同 TCP RTO 估计）
+image_source_latency_lock = threading.Lock()
+image_source_latency = {}
+
+def get_image_hedge_settings(config):
+    """合并默认对冲配置和用户配置"""
+    merged = DEFAULT_IMAGE_HEDGE_CONFIG.copy()
+    user_cfg = (config or {}).get('image_hedge_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    if merged.get('mode') not in IMAGE_HEDGE_MODES:
+        merged['mode'] = DEFAULT_IMAGE_HEDGE_CONFIG['mode']
+    merged['adaptive'] = bool(merged.get('adaptive', True))
+    for key in ('hedge_delay_ms', 'min_delay_ms', 'max_delay_ms'):
+        merged[key] = max(0, int(merged.get(key, DEFAULT_IMAGE_HEDGE_CONFIG[key])))
+    merged['max_delay_ms'] = max(merged['min_delay_ms'], merged['max_delay_ms'])
+    merged['deadline_seconds'] = max(0.0, float(merged.get('deadline_seconds', DEFAULT_IMAGE_HEDGE_CONFIG['deadline_seconds'])))
+    return merged
+
+def record_image_source_latency(source, elapsed_ms, success):
+    """记录一次来源请求的耗时（成功和失败都计入，失败耗时同样决定何时该启动下一来源）"""
+    with image_source_latency_lock:
+        stat = image_source_latency.setdefault(source, {
+            'srtt_ms': None, 'rttvar_ms': 0.0, 'samples': 0, 'failures': 0, 'last_ms': 0
+        })
+        stat['samples'] += 1
+        stat['last_ms'] = round(elapsed_ms)
+        if not success:
+            stat['failures'] += 1
+        if stat['srtt_ms'] is None:
+            stat['srtt_ms'] = elapsed_ms
+            stat['rttvar_ms'] = elapsed_ms / 2
+        else:
+            stat['rttvar_ms'] = 0.75 * stat['rttvar_ms'] + 0.25 * abs(stat['srtt_ms'] - elapsed_ms)
+            stat['srtt_ms'] = 0.875 * stat['srtt_ms'] + 0.125 * elapsed_ms
+
+def get_image_hedge_delay(source, settings):
+    """启动下一来源前等待 source 的时间（秒）：样本足够时取 srtt + 2 * rttvar，并限制在上下限之间"""
+    delay_ms = settings['hedge_delay_ms']
+    if settings['adaptive']:
+        with image_source_latency_lock:
+            stat = image_source_latency.get(source)
+            if stat and stat['samples'] >= 3:
+                delay_ms = stat['srtt_ms'] + 2 * stat['rttvar_ms']
+    return min(max(delay_ms, settings['min_delay_ms']), settings['max_delay_ms']) / 1000
+
+def get_image_source_latency_stats(config=None):
+    """返回各来源的延迟统计和当前对冲延迟"""
+    settings = get_image_hedge_settings(config if config is not None else load_config())
+    with image_source_latency_lock:
+        snapshot = {source: dict(stat) for source, stat in image_source_latency.items()}
+    sources = {}
+    for source, stat in snapshot.items():
+        sources[source] = {
+            'avg_ms': round(stat['srtt_ms'] or 0),
+            'deviation_ms': round(stat['rttvar_ms']),
+            'last_ms': stat['last_ms'],
+            'samples': stat['samples'],
+            'failures': stat['failures'],
+            'hedge_delay_ms': round(get_image_hedge_delay(source, settings) * 1000)
+        }
+    return {'settings': settings, 'sources': sources}
+
+def _image_source_available(source, request_info):
+    """判断来源是否具备执行条件（密钥、关键词、提示词等），不具备的来源不占用对冲名额"""
+    config = request_info['config']
+    keyword = request_info['keyword']
+    if source in CIRCUIT_BREAKER_IMAGE_SOURCES and get_circuit_breaker(source).is_open():
+        print(f"图片源 {source} 熔断中，跳过")
+        return False
+    if source == 'comfyui':
+        if not (request_info['visual_prompts'] and request_info['topic']):
+            print("缺少 ComfyUI 所需的 prompt 信息，跳过")
+            return False
+        if not request_info['comfy_settings'].get('workflow_path'):
+            print("ComfyUI 未配置 workflow_path，跳过")
+            return False
+        return True
+    if source == 'user_uploaded':
+        path = request_info['user_uploaded_path']
+        return bool(path and os.path.exists(path))
+    if source == 'unsplash':
+        return bool(config.get('unsplash_access_key') and keyword)
+    if source == 'pexels':
+        return bool(config.get('pexels_api_key') and keyword)
+    if source == 'pixabay':
+        return bool(config.get('pixabay_api_key') and keyword)
+    return source == 'local'
+
+def _fetch_from_image_source(source, request_info):
+    """从单个来源获取图片，返回 (image_path, metadata)，未获取到时 image_path 为 None"""
+    config = request_info['config']
+    keyword = request_info['keyword']
+
+    if source == 'comfyui':
+        breaker = get_circuit_breaker('comfyui')
+        if not breaker.allow():
+            print("ComfyUI 熔断中，跳过")
+            return None, {}
+        started = time.monotonic()
+        try:
+            image_path, metadata = work_scheduler.run(
+                'comfyui', generate_image_with_comfyui,
+                request_info['topic'],
+                request_info['visual_prompts'],
+                request_info['blueprint'],
+                config,
+                settings_override=request_info['comfy_settings'],
+                **schedule_options(config)
+            )
+        except Exception as e:
+            breaker.record(False, (time.monotonic() - started) * 1000, e)
+            raise
+        metadata = metadata or {}
+        errors = metadata.get('errors') or []
+        breaker.record(bool(image_path), (time.monotonic() - started) * 1000, errors[-1] if errors else None)
+        if image_path:
+            print(f"ComfyUI 生成成功: {image_path}")
+        return image_path, metadata
+
+    if source == 'user_uploaded':
+        print(f"使用用户上传的图片: {request_info['user_uploaded_path']}")
+        return request_info['user_uploaded_path'], {}
+
+    if source in ('unsplash', 'pexels', 'pixabay'):
+        provider_name = {'unsplash': 'Unsplash', 'pexels': 'Pexels', 'pixabay': 'Pixabay'}[source]
+        print(f"尝试从 {provider_name} 下载图片，关键词: {keyword}")
+        if source == 'unsplash':
+            image_path = download_unsplash_image(keyword, config.get('unsplash_access_key'), config)
+        elif source == 'pexels':
+            image_path = download_pexels_image(keyword, config.get('pexels_api_key'), config)
+        else:
+            image_path = download_pixabay_image(keyword, config.get('pixabay_api_key'), config)
+        if image_path:
+            print(f"{provider_name} 下载成功: {image_path}")
+        return image_path, {}
+
+    tags = keyword.lower().split() if keyword else []
+    # 关键词与段落摘要一起作为语义匹配的查询
+    query = ' '.join(filter(None, [keyword, (request_info['visual_prompts'] or {}).get('positive_prompt')]))
+    print(f"尝试从本地图库获取图片，标签: {tags}")
+    image_path = get_local_image_by_tags(tags if tags else None, config, query=query)
+    if image_path:
+        print(f"本地图库选择成功: {image_path}")
+    return image_path, {}
+
+def _timed_fetch_from_image_source(source, request_info):
+    """执行来源请求并记录耗时，异常视为未获取到"""
+    started = time.monotonic()
+    image_path, metadata = None, {}
+    try:
+        image_path, metadata = _fetch_from_image_source(source, request_info)
+    except Exception as e:
+        print(f"图片源 {source} 失败: {e}，尝试下一项...")
+    record_image_source_latency(source, (time.monotonic() - started) * 1000, bool(image_path))
+    return image_path, metadata
+
+def _resolve_image_hedged(sources, request_info, settings):
+    """对冲获取一组检索类来源，返回 (image_path, source, metadata)，全部失败时返回 (None, None, {})
+
+    delay 模式先启动最高优先级来源，它在对冲延迟内没有返回（或已失败）时启动下一来源；
+    all 模式同时启动全部来源。某来源成功且所有更高优先级来源都已结束时立即采用；
+    超过截止时间后采用已到达的最高优先级结果。落选结果释放其图片仓库引用并撤销近期使用记录，
+    尚未启动的来源不再启动。
+    """
+    results = queue.Queue()
+    cancel_lock = threading.Lock()
+    cancelled = [False]
+
+    def discard(image_path, journal):
+        # 获取失败的来源保留记录，避免下次再选中同一张下载失败的图片
+        if image_path:
+            release_image_refs([image_path])
+            recent_image_ledger.undo(journal)
+
+    def worker(index):
+        recent_image_ledger.start_journal()
+        try:
+            image_path, metadata = _timed_fetch_from_image_source(sources[index], request_info)
+        finally:
+            journal = recent_image_ledger.finish_journal()
+        with cancel_lock:
+            if not cancelled[0]:
+                results.put((index, image_path, metadata, journal))
+                return
+        # 已经选出结果，落选的图片直接释放
+        discard(image_path, journal)
+
+    def launch(index):
+        threading.Thread(target=worker, args=(index,), daemon=True).start()
+
+    started = time.monotonic()
+    deadline = started + settings['deadline_seconds']
+    launched, finished = 0, set()
+    best, best_result = None, None
+    next_launch_at = started
+
+    if settings['mode'] == 'all':
+        for index in range(len(sources)):
+            launch(index)
+        launched = len(sources)
+
+    while True:
+        now = time.monotonic()
+        if best is not None and (all(index in finished for index in range(best)) or now >= deadline):
+            break
+        if best is None and launched < len(sources) and now >= next_launch_at:
+            launch(launched)
+            next_launch_at = now + get_image_hedge_delay(sources[launched], settings)
+            launched += 1
+            continue
+        if best is None and len(finished) == launched == len(sources):
+            break
+
+        wait_until = None
+        if best is None and launched < len(sources):
+            wait_until = next_launch_at
+        if best is not None:
+            wait_until = deadline
+        try:
+            timeout = None if wait_until is None else max(0, wait_until - now)
+            index, image_path, metadata, journal = results.get(timeout=timeout)
+        except queue.Empty:
+            continue
+
+        finished.add(index)
+        if image_path and (best is None or index < best):
+            if best_result:
+                discard(best_result[0], best_result[2])
+            best, best_result = index, (image_path, metadata, journal)
+        else:
+            discard(image_path, journal)
+            if not image_path and best is None and len(finished) == launched:
+                # 已启动的来源全部失败，不必等待对冲延迟
+                next_launch_at = now
+
+    with cancel_lock:
+        cancelled[0] = True
+        while not results.empty():
+            index, image_path, metadata, journal = results.get_nowait()
+            discard(image_path, journal)
+
+    if best is None:
+        return None, None, {}
+    print(f"对冲获取图片: 采用 {sources[best]}，耗时 {time.monotonic() - started:.2f}s，启动 {launched}/{len(sources)} 个来源")
+    return best_result[0], sources[best], best_result[1]
+
 def resolve_image_with_priority(keyword, config, user_uploaded_path=None, visual_prompts=None, blueprint=None, topic=None):
-    """扩展版的图片获取逻辑，支持 ComfyUI 自动生成并返回元数据"""
+    """扩展版的图片获取逻辑，支持 ComfyUI 自动生成并返回元数据
+
+    按 image_source_priority 获取图片；image_hedge_settings.mode 不为 serial 时，
+    连续的检索类来源（图库、本地图库等）以对冲方式并发获取。
+    """
     comfy_settings = get_comfyui_settings(config)
 
     if user_uploaded_path and os.path.exists(user_uploaded_path):
@@ -836,83 +4171,121 @@ def resolve_image_with_priority(keyword, config, user_uploaded_path=None, visual
     if comfy_settings.get('enabled', True) and 'comfyui' not in priority:
         priority = ['comfyui'] + [src for src in priority if src != 'comfyui']
 
-    tags = keyword.lower().split() if keyword else []
-
-    for source in priority:
-        try:
-            if source == 'comfyui':
-                if visual_prompts and topic:
-                    workflow_path = comfy_settings.get('workflow_path')
-                    if not workflow_path:
-                        print("ComfyUI 未配置 workflow_path，跳过")
-                        continue
-                    image_path, metadata = generate_image_with_comfyui(
-                        topic,
-                        visual_prompts,
-                        blueprint,
-                        config,
-                        settings_override=comfy_settings
-                    )
-                    if image_path:
-                        print(f"ComfyUI 生成成功: {image_path}")
-                        return image_path, 'comfyui', metadata
-                else:
-                    print("缺少 ComfyUI 所需的 prompt 信息，跳过")
+    request_info = {
+        'keyword': keyword,
+        'config': config,
+        'comfy_settings': comfy_settings,
+        'user_uploaded_path': user_uploaded_path,
+        'visual_prompts': visual_prompts,
+        'blueprint': blueprint,
+        'topic': topic
+    }
+    hedge_settings = get_image_hedge_settings(config)
+    available = [source for source in priority if _image_source_available(source, request_info)]
+
+    # 按 ComfyUI 切分为若干组，组内检索类来源对冲获取
+    groups = []
+    for source in available:
+        if source == 'comfyui' or hedge_settings['mode'] == 'serial' or not groups or groups[-1][0] == 'comfyui':
+            groups.append([source])
+        else:
+            groups[-1].append(source)
 
-            elif source == 'user_uploaded' and user_uploaded_path:
-                if os.path.exists(user_uploaded_path):
-                    print(f"使用用户上传的图片: {user_uploaded_path}")
-                    return user_uploaded_path, 'user_uploaded', {}
+    for group in groups:
+        if len(group) == 1:
+            image_path, metadata = _timed_fetch_from_image_source(group[0], request_info)
+            if image_path:
+                return image_path, group[0], metadata
+            continue
+        image_path, source, metadata = _resolve_image_hedged(group, request_info, hedge_settings)
+        if image_path:
+            return image_path, source, metadata
 
-            elif source == 'unsplash':
-                unsplash_key = config.get('unsplash_access_key')
-                if unsplash_key and keyword:
-                    print(f"尝试从 Unsplash 下载图片，关键词: {keyword}")
-                    image_path = download_unsplash_image(keyword, unsplash_key)
-                    if image_path:
-                        print(f"Unsplash 下载成功: {image_path}")
-                        return image_path, 'unsplash', {}
+    print("所有图片源都失败，将不使用配图")
+    return None, 'none', {}
 
-            elif source == 'pexels':
-                pexels_key = config.get('pexels_api_key')
-                if pexels_key and keyword:
-                    print(f"尝试从 Pexels 下载图片，关键词: {keyword}")
-                    image_path = download_pexels_image(keyword, pexels_key)
-                    if image_path:
-                        print(f"Pexels 下载成功: {image_path}")
-                        return image_path, 'pexels', {}
+def _generate_image_for_slot(i, slot_index, para_text, para_summary, topic, config,
+                             visual_prompts, visual_blueprint, image_keyword):
+    """为单个图片位置获取图片（在图片线程池中执行）
 
-            elif source == 'pixabay':
-                pixabay_key = config.get('pixabay_api_key')
-                if pixabay_key and keyword:
-                    print(f"尝试从 Pixabay 下载图片，关键词: {keyword}")
-                    image_path = download_pixabay_image(keyword, pixabay_key)
-                    if image_path:
-                        print(f"Pixabay 下载成功: {image_path}")
-                        return image_path, 'pixabay', {}
+    Args:
+        para_summary: 已生成的段落摘要，或提前生成摘要的 Future；为空时在此单独生成
+    Returns:
+        (image_entry, metadata_entry)，图片获取失败时 image_entry 为 None
+    """
+    if isinstance(para_summary, Future):
+        para_summary = para_summary.result()
 
-            elif source == 'local':
-                print(f"尝试从本地图库获取图片，标签: {tags}")
-                image_path = get_local_image_by_tags(tags if tags else None, config)
-                if image_path:
-                    print(f"本地图库选择成功: {image_path}")
-                    return image_path, 'local', {}
+    # 批量摘要中缺失的段落单独生成摘要
+    if not para_summary:
+        if para_text is not None:
+            para_summary = summarize_paragraph_for_image(para_text, topic, config)
+        else:
+            para_summary = f"visual representation of {topic}"
+
+    # 使用段落摘要作为主要内容，视觉蓝图作为辅助
+    # 注意：段落摘要应该是最重要的，放在最前面
+    if visual_prompts:
+        custom_prompts = {
+            'positive_prompt': para_summary,  # 段落摘要作为主体
+            'negative_prompt': visual_prompts.get('negative_prompt', 'lowres, blurry, watermark')
+        }
+    else:
+        custom_prompts = {
+            'positive_prompt': para_summary,
+            'negative_prompt': 'lowres, blurry, watermark'
+        }
 
-        except Exception as e:
-            print(f"图片源 {source} 失败: {e}，尝试下一项...")
-            continue
+    # 生成图片
+    image_path, image_source, image_metadata = resolve_image_with_priority(
+        image_keyword,
+        config,
+        None,  # 不使用用户上传图片
+        custom_prompts,
+        visual_blueprint,
+        topic
+    )
+
+    if not image_path:
+        print(f"✗ 第 {i+1} 张图片生成失败,跳过")
+        return None, {
+            'source': 'failed',
+            'order': i,
+            'error': '生成失败'
+        }
 
-    print("所有图片源都失败，将不使用配图")
-    return None, 'none', {}
+    print(f"✓ 第 {i+1} 张图片生成成功: {image_path}")
+    image_entry = {
+        'path': image_path,
+        'summary': para_summary,
+        'paragraph_index': slot_index,
+        'source': image_source,
+        'order': i
+    }
+    metadata_entry = {
+        'source': image_source,
+        'path': image_path,
+        'summary': para_summary,
+        'paragraph_index': slot_index,
+        'order': i,
+        'metadata': image_metadata
+    }
+    return image_entry, metadata_entry
 
-def _execute_single_article_generation(topic, config, user_uploaded_images=None):
+def _execute_single_article_generation(topic, config, user_uploaded_images=None, progress_callback=None, event_callback=None):
     """为单个主题生成文章（将在后台线程中执行）
 
     Args:
         topic: 文章主题
         config: 配置对象
         user_uploaded_images: 用户上传的图片列表(数组格式),每项包含 {type, path, order}
+        progress_callback: 流式生成时的进度回调 progress_callback(topic, text, usage)
+        event_callback: 阶段完成时的事件回调 event_callback(event_type, data)
     """
+    def emit(event_type, data):
+        if event_callback:
+            event_callback(event_type, dict(data, topic=topic))
+
     aliyun_api_key = config.get('aliyun_api_key', '')
     aliyun_base_url = config.get('aliyun_base_url', 'https://dashscope.aliyuncs.com')
     pandoc_path = config.get('pandoc_path', '')
@@ -927,9 +4300,35 @@ def _execute_single_article_generation(topic, config, user_uploaded_images=None)
     if user_uploaded_images and not isinstance(user_uploaded_images, list):
         user_uploaded_images = [user_uploaded_images]
 
+    user_image_count = len(user_uploaded_images) if user_uploaded_images else 0
+
+    # 流式生成时，首个配图位置总是第一段（见 compute_image_slots），
+    # 第一段写完即可提前生成它的图片摘要，与文章剩余部分的生成并行
+    prefetched_summaries = {}
+
+    def on_article_progress(partial_text, usage):
+        if progress_callback:
+            progress_callback(topic, partial_text, usage)
+        if not enable_image or prefetched_summaries or user_image_count > 0 or target_image_count < 1:
+            return
+        finished = get_completed_paragraphs(partial_text)
+        if finished:
+            para_text = finished[0]['text']
+            prefetched_summaries[para_text] = work_scheduler.submit(
+                'llm', summarize_paragraph_for_image, para_text, topic, config, **schedule_options(config)
+            )
+
     # 1. 使用阿里云 Qwen 生成文章
-    article = generate_article_with_qwen(topic, aliyun_api_key, aliyun_base_url, model_name, custom_prompt)
+    article = work_scheduler.run(
+        'llm', generate_article_with_qwen,
+        topic, aliyun_api_key, aliyun_base_url, model_name, custom_prompt,
+        stream_settings=get_article_stream_settings(config),
+        on_progress=on_article_progress,
+        config=config,
+        **schedule_options(config)
+    )
     article_title = extract_article_title(article)
+    emit('article-done', {'article_title': article_title, 'chars': len(article)})
 
     # 2. 提取段落结构
     paragraphs = extract_paragraph_structures(article)
@@ -943,7 +4342,6 @@ def _execute_single_article_generation(topic, config, user_uploaded_images=None)
 
     if enable_image:
         # 确定需要生成多少张图片
-        user_image_count = len(user_uploaded_images) if user_uploaded_images else 0
         need_generate_count = target_image_count - user_image_count
 
         # 先使用用户上传的图片
@@ -965,86 +4363,52 @@ def _execute_single_article_generation(topic, config, user_uploaded_images=None)
 
         # 如果还需要更多图片,自动生成
         if need_generate_count > 0:
-            try:
-                # 生成视觉蓝图(仅一次)
-                visual_blueprint = generate_visual_blueprint_qwen(topic, article, aliyun_api_key, aliyun_base_url, model_name)
-                visual_prompts = build_visual_prompts(visual_blueprint)
-                image_keyword = derive_keyword_from_blueprint(visual_blueprint)
-            except Exception as e:
-                print(f"生成视觉蓝图失败: {e}")
-                visual_blueprint = None
-                visual_prompts = None
-                image_keyword = ''
-
-            # 为每个需要生成的图片位置生成图片
+            slot_plans = []
             for i in range(user_image_count, target_image_count):
+                slot_index = image_slots[i] if i < len(image_slots) else None
+                para_text = None
+                prefetched = None
+                if slot_index is not None and slot_index < len(paragraphs):
+                    para_text = paragraphs[slot_index]['text']
+                    prefetched = prefetched_summaries.pop(para_text, None)
+                slot_plans.append((i, slot_index, para_text, prefetched))
+
+            # 尚未提前生成摘要的段落与视觉蓝图一起规划
+            pending_texts = [plan[2] for plan in slot_plans if plan[2] is not None and plan[3] is None]
+            visual_blueprint, batch_summaries = plan_article_visuals(topic, article, pending_texts, config)
+            visual_prompts = build_visual_prompts(visual_blueprint)
+            image_keyword = derive_keyword_from_blueprint(visual_blueprint)
+
+            # 每个图片位置作为独立工作提交到调度器的 image 阶段，多张图片并行生成
+            slot_futures = []
+            for i, slot_index, para_text, prefetched in slot_plans:
+                para_summary = prefetched if prefetched is not None else batch_summaries.get(para_text)
+                slot_futures.append((i, work_scheduler.submit(
+                    'image', _generate_image_for_slot,
+                    i, slot_index, para_text, para_summary, topic, config,
+                    visual_prompts, visual_blueprint, image_keyword,
+                    **schedule_options(config)
+                )))
+
+            # 按 order 顺序收集结果，保证插图顺序与串行生成一致
+            for i, future in slot_futures:
                 try:
-                    slot_index = image_slots[i] if i < len(image_slots) else None
-
-                    # 为该段落生成摘要
-                    if slot_index is not None and slot_index < len(paragraphs):
-                        para_text = paragraphs[slot_index]['text']
-                        para_summary = summarize_paragraph_for_image(para_text, topic, config)
-                    else:
-                        para_summary = f"visual representation of {topic}"
-
-                    # 使用段落摘要作为主要内容，视觉蓝图作为辅助
-                    # 注意：段落摘要应该是最重要的，放在最前面
-                    if visual_prompts:
-                        # 从视觉蓝图中提取一些通用描述（不包括具体主题）
-                        blueprint_style = visual_prompts.get('positive_prompt', '')
-                        # 段落摘要 + 通用风格描述
-                        custom_prompts = {
-                            'positive_prompt': para_summary,  # 段落摘要作为主体
-                            'negative_prompt': visual_prompts.get('negative_prompt', 'lowres, blurry, watermark')
-                        }
-                    else:
-                        custom_prompts = {
-                            'positive_prompt': para_summary,
-                            'negative_prompt': 'lowres, blurry, watermark'
-                        }
-
-                    # 生成图片
-                    image_path, image_source, image_metadata = resolve_image_with_priority(
-                        image_keyword,
-                        config,
-                        None,  # 不使用用户上传图片
-                        custom_prompts,
-                        visual_blueprint,
-                        topic
-                    )
-
-                    if image_path:
-                        image_list.append({
-                            'path': image_path,
-                            'summary': para_summary,
-                            'paragraph_index': slot_index,
-                            'source': image_source,
-                            'order': i
-                        })
-                        images_metadata.append({
-                            'source': image_source,
-                            'path': image_path,
-                            'summary': para_summary,
-                            'paragraph_index': slot_index,
-                            'order': i,
-                            'metadata': image_metadata
-                        })
-                        print(f"✓ 第 {i+1} 张图片生成成功: {image_path}")
-                    else:
-                        print(f"✗ 第 {i+1} 张图片生成失败,跳过")
-                        images_metadata.append({
-                            'source': 'failed',
-                            'order': i,
-                            'error': '生成失败'
-                        })
+                    image_entry, metadata_entry = future.result()
                 except Exception as e:
                     print(f"✗ 第 {i+1} 张图片生成异常: {e}")
-                    images_metadata.append({
+                    image_entry, metadata_entry = None, {
                         'source': 'error',
                         'order': i,
                         'error': str(e)
-                    })
+                    }
+                if image_entry:
+                    image_list.append(image_entry)
+                images_metadata.append(metadata_entry)
+                emit('image-done', {
+                    'order': i,
+                    'success': image_entry is not None,
+                    'source': metadata_entry.get('source')
+                })
 
     # 5. 生成 Word 文档(使用新的多图插入方式)
     filename = create_word_document(article_title, article, image_list, enable_image, pandoc_path, config)
@@ -1064,122 +4428,116 @@ def _execute_generation_task(task_id, topics, config):
     total_topics = len(topics)
 
     # 获取主题图片映射
-    with task_lock:
-        task = generation_tasks.get(task_id, {})
-        topic_images = task.get('topic_images', {})
-
-    # 使用 futures 来跟踪每个主题的生成任务
-    with ThreadPoolExecutor(max_workers=config.get('max_concurrent_tasks', 3)) as single_task_executor:
-        futures = {}
-        for topic in topics:
-            # 获取该主题对应的图片信息并转换为数组格式
-            topic_image_info = topic_images.get(topic)
-            user_uploaded_images = []
-
-            if topic_image_info:
-                # 兼容旧格式:将单个图片对象转为数组
-                if isinstance(topic_image_info, dict):
-                    # 单个图片对象
-                    if topic_image_info.get('type') == 'uploaded':
+    topic_images = task_store.get_topic_images(task_id)
+
+    # 流式进度事件按主题限频，避免每个增量片段都推送一次
+    last_progress_event = {}
+
+    def publish_progress(topic, partial_text, usage):
+        """将流式生成的中间文本和 token 用量写入任务状态"""
+        progress = {
+            'status': 'writing',
+            'partial_text': partial_text,
+            'chars': len(partial_text),
+            'output_tokens': usage.get('output_tokens', 0),
+            'input_tokens': usage.get('input_tokens', 0)
+        }
+        task_store.update_topic_progress(task_id, topic, progress)
+        now = time.time()
+        if now - last_progress_event.get(topic, 0) >= 1:
+            last_progress_event[topic] = now
+            publish_task_event(task_id, 'writing', dict(_compact_topic_progress({topic: progress})[topic], topic=topic))
+
+    def publish_stage(event_type, data):
+        publish_task_event(task_id, event_type, data)
+
+    def run_topic(topic, user_uploaded_images):
+        """在调度器中真正开始执行时才标记主题为进行中"""
+        task_store.mark_topic_started(task_id, topic)
+        publish_task_event(task_id, 'started', {'topic': topic})
+        return _execute_single_article_generation(topic, config, user_uploaded_images, publish_progress, publish_stage)
+
+    # 每个主题作为 article 阶段的一项工作提交到全局调度器，futures 用来跟踪结果
+    futures = {}
+    for topic in topics:
+        # 获取该主题对应的图片信息并转换为数组格式
+        topic_image_info = topic_images.get(topic)
+        user_uploaded_images = []
+
+        if topic_image_info:
+            # 兼容旧格式:将单个图片对象转为数组
+            if isinstance(topic_image_info, dict):
+                # 单个图片对象
+                if topic_image_info.get('type') == 'uploaded':
+                    user_uploaded_images.append({
+                        'type': 'uploaded',
+                        'path': topic_image_info.get('path'),
+                        'summary': topic_image_info.get('summary', '配图'),
+                        'order': 0
+                    })
+                elif topic_image_info.get('type') == 'url':
+                    # 如果是URL，需要先下载
+                    url = topic_image_info.get('url')
+                    try:
+                        # 存入图片仓库，重试和其他主题使用同一 URL 时不再重复下载
+                        temp_path = fetch_image_to_store(url, config=config, filename_prefix='temp_url', timeout=10)
                         user_uploaded_images.append({
                             'type': 'uploaded',
-                            'path': topic_image_info.get('path'),
+                            'path': temp_path,
                             'summary': topic_image_info.get('summary', '配图'),
                             'order': 0
                         })
-                    elif topic_image_info.get('type') == 'url':
-                        # 如果是URL，需要先下载
-                        url = topic_image_info.get('url')
+                    except Exception as e:
+                        print(f"下载URL图片失败 ({topic}): {e}")
+            elif isinstance(topic_image_info, list):
+                # 已经是数组格式，直接使用
+                for idx, img in enumerate(topic_image_info):
+                    if img.get('type') == 'uploaded':
+                        user_uploaded_images.append({
+                            'type': 'uploaded',
+                            'path': img.get('path'),
+                            'summary': img.get('summary', '配图'),
+                            'order': img.get('order', idx)
+                        })
+                    elif img.get('type') == 'url':
+                        # 下载URL图片
+                        url = img.get('url')
                         try:
-                            response = requests.get(url, timeout=10)
-                            response.raise_for_status()
-
-                            # 保存临时文件
-                            ext = url.split('.')[-1].lower()
-                            if ext not in ALLOWED_EXTENSIONS:
-                                ext = 'jpg'
-                            output_dir = config.get('output_directory', 'output')
-                            os.makedirs(output_dir, exist_ok=True)
-                            temp_path = os.path.join(output_dir, f'temp_url_{datetime.now().strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:8]}.{ext}')
-                            with open(temp_path, 'wb') as f:
-                                f.write(response.content)
+                            temp_path = fetch_image_to_store(url, config=config, filename_prefix='temp_url', timeout=10)
                             user_uploaded_images.append({
                                 'type': 'uploaded',
                                 'path': temp_path,
-                                'summary': topic_image_info.get('summary', '配图'),
-                                'order': 0
-                            })
-                        except Exception as e:
-                            print(f"下载URL图片失败 ({topic}): {e}")
-                elif isinstance(topic_image_info, list):
-                    # 已经是数组格式，直接使用
-                    for idx, img in enumerate(topic_image_info):
-                        if img.get('type') == 'uploaded':
-                            user_uploaded_images.append({
-                                'type': 'uploaded',
-                                'path': img.get('path'),
                                 'summary': img.get('summary', '配图'),
                                 'order': img.get('order', idx)
                             })
-                        elif img.get('type') == 'url':
-                            # 下载URL图片
-                            url = img.get('url')
-                            try:
-                                response = requests.get(url, timeout=10)
-                                response.raise_for_status()
-
-                                ext = url.split('.')[-1].lower()
-                                if ext not in ALLOWED_EXTENSIONS:
-                                    ext = 'jpg'
-                                output_dir = config.get('output_directory', 'output')
-                                os.makedirs(output_dir, exist_ok=True)
-                                temp_path = os.path.join(output_dir, f'temp_url_{datetime.now().strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:8]}.{ext}')
-                                with open(temp_path, 'wb') as f:
-                                    f.write(response.content)
-                                user_uploaded_images.append({
-                                    'type': 'uploaded',
-                                    'path': temp_path,
-                                    'summary': img.get('summary', '配图'),
-                                    'order': img.get('order', idx)
-                                })
-                            except Exception as e:
-                                print(f"下载URL图片失败 ({topic}, 第{idx+1}张): {e}")
-
-            futures[single_task_executor.submit(_execute_single_article_generation, topic, config, user_uploaded_images)] = topic
-
-        for future in as_completed(futures):
-            topic = futures[future]
-            try:
-                result = future.result()
-                with task_lock:
-                    task = generation_tasks[task_id]
-                    task['results'].append(result)
-                    print(f"✓ 文章生成成功: {topic}")
-                    print(f"  当前结果数: {len(task['results'])}, 错误数: {len(task['errors'])}")
+                        except Exception as e:
+                            print(f"下载URL图片失败 ({topic}, 第{idx+1}张): {e}")
 
-            except Exception as e:
-                with task_lock:
-                    task = generation_tasks[task_id]
-                    task['errors'].append({'topic': topic, 'error': str(e)})
-                    print(f"✗ 文章生成失败: {topic} - {str(e)}")
-                    print(f"  当前结果数: {len(task['results'])}, 错误数: {len(task['errors'])}")
+        futures[work_scheduler.submit(
+            'article', run_topic, topic, user_uploaded_images, **schedule_options(config)
+        )] = topic
 
-            finally:
-                with task_lock:
-                    task = generation_tasks[task_id]
-                    completed_count = len(task['results']) + len(task['errors'])
-                    # 使用任务的total字段，而不是局部的total_topics
-                    task_total = task.get('total', len(topics))
-                    task['progress'] = (completed_count / task_total) * 100 if task_total > 0 else 0
-                    print(f"  进度更新: {completed_count}/{task_total} = {task['progress']:.1f}%")
-
-        # 所有任务完成后，设置状态为completed
-        with task_lock:
-            task = generation_tasks[task_id]
-            completed_count = len(task['results']) + len(task['errors'])
-            if completed_count >= task.get('total', 0):
-                task['status'] = 'completed'
-                print(f"✓ 任务完成! 总结果: {len(task['results'])} 成功, {len(task['errors'])} 失败")
+    succeeded, failed = 0, 0
+    for future in as_completed(futures):
+        topic = futures[future]
+        try:
+            result = future.result()
+            task_store.record_result(task_id, topic, result)
+            publish_task_event(task_id, 'docx-done', _compact_task_result(result))
+            succeeded += 1
+            print(f"✓ 文章生成成功: {topic}")
+        except Exception as e:
+            task_store.record_error(task_id, topic, str(e))
+            publish_task_event(task_id, 'topic-error', {'topic': topic, 'error': str(e)})
+            failed += 1
+            print(f"✗ 文章生成失败: {topic} - {str(e)}")
+        finally:
+            print(f"  本轮进度: {succeeded + failed}/{total_topics}, 成功 {succeeded}, 失败 {failed}")
+
+    # 所有任务完成后，设置状态为completed
+    if task_store.complete_if_finished(task_id):
+        publish_task_event(task_id, 'task-completed', {'status': 'completed'})
+        print(f"✓ 任务完成! 本轮结果: {succeeded} 成功, {failed} 失败")
 
 @app.route('/api/download-image-from-url', methods=['POST'])
 def download_image_from_url():
@@ -1191,38 +4549,24 @@ def download_image_from_url():
         return jsonify({'success': False, 'error': '请提供图片URL'}), 400
 
     try:
-        # 下载图片
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-
-        # 验证是否为图片
-        content_type = response.headers.get('Content-Type', '')
-        if not content_type.startswith('image/'):
-            return jsonify({'success': False, 'error': 'URL不是有效的图片'}), 400
-
-        # 生成文件名
-        ext = content_type.split('/')[-1]
-        if ext not in ALLOWED_EXTENSIONS:
-            ext = 'jpg'
-
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'url_image_{timestamp}_{uuid.uuid4().hex[:8]}.{ext}'
-
-        # 保存到 uploads 目录
-        upload_dir = load_config().get('uploaded_images_dir', 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-        filepath = os.path.join(upload_dir, filename)
-
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
+        # 流式下载到 uploads 目录（校验 Content-Type 与大小）
+        config = load_config()
+        upload_dir = config.get('uploaded_images_dir', 'uploads')
+        downloaded = download_image_to_file(url, target_dir=upload_dir, filename_prefix='url_image', config=config, timeout=10)
+        filepath = downloaded['path']
+        filename = os.path.basename(filepath)
+        schedule_thumbnail_generation(filepath, config)
 
         return jsonify({
             'success': True,
             'filename': filename,
             'path': filepath,
+            'thumbnail_url': thumbnail_url(filepath),
             'message': '图片下载成功'
         })
 
+    except ImageDownloadError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except requests.exceptions.Timeout:
         return jsonify({'success': False, 'error': '下载超时'}), 500
     except requests.exceptions.RequestException as e:
@@ -1240,30 +4584,37 @@ def generate_article():
     if not topics:
         return jsonify({'error': '请提供至少一个主题'}), 400
 
+    try:
+        priority = int(data.get('priority', 0) or 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'priority 必须是整数'}), 400
+
     config = load_config()
     if not config.get('aliyun_api_key'):
         return jsonify({'error': '请先配置阿里云 API Key'}), 400
     if not config.get('pandoc_path'):
         return jsonify({'error': '请先在配置页面设置 Pandoc 可执行文件路径！'}), 400
 
+    # bypass_cache 为 True 时忽略已缓存的蓝图/摘要，重新请求模型
+    if data.get('bypass_cache'):
+        config['llm_cache_bypass'] = True
+
     task_id = str(uuid.uuid4())
-    with task_lock:
-        generation_tasks[task_id] = {
-            'status': 'running',
-            'progress': 0,
-            'results': [],
-            'errors': [],
-            'total': len(topics),
-            'topic_images': topic_images  # 保存图片映射
-        }
+    task_store.create_task(task_id, topics, topic_images)
 
-    # 提交到线程池执行
-    executor.submit(_execute_generation_task, task_id, topics, config)
+    # 启动任务，主题按 priority 在全局调度器中排队
+    start_generation_task(task_id, topics, config, priority=priority)
 
     return jsonify({'success': True, 'task_id': task_id})
 
-def generate_article_with_qwen(topic, api_key, base_url, model_name, custom_prompt=''):
-    """使用阿里云 Qwen API 生成文章"""
+def generate_article_with_qwen(topic, api_key, base_url, model_name, custom_prompt='', stream_settings=None, on_progress=None, config=None):
+    """使用阿里云 Qwen API 生成文章
+
+    Args:
+        stream_settings: 流式输出配置（见 get_article_stream_settings），为空或未启用时使用一次性返回
+        on_progress: 流式模式下每收到一段增量时回调 on_progress(text, usage)
+        config: 配置对象，用于读取限流设置
+    """
     # 使用自定义 prompt 或默认 prompt
     if custom_prompt:
         prompt = custom_prompt.replace('{topic}', topic)
@@ -1286,10 +4637,11 @@ def generate_article_with_qwen(topic, api_key, base_url, model_name, custom_prom
     # 使用 HTTP 请求调用阿里云 Qwen API
     url = f'{base_url}/api/v1/services/aigc/text-generation/generation'
     search = True;
+    streaming = bool(stream_settings and stream_settings.get('enabled'))
     headers = {
         'Authorization': f'Bearer {api_key}',
         'Content-Type': 'application/json',
-        'X-DashScope-SSE': 'disable'
+        'X-DashScope-SSE': 'enable' if streaming else 'disable'
     }
     data = {
         'model': model_name,
@@ -1308,15 +4660,105 @@ def generate_article_with_qwen(topic, api_key, base_url, model_name, custom_prom
         }
     }
 
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    # 文章输出约 800-1200 字，加上联网检索的输入，按 2000 token 预估
+    estimated_tokens = estimate_qwen_tokens(data['input']['messages'], 2000)
+    if streaming:
+        data['parameters']['incremental_output'] = True
+        return call_qwen_with_limits(
+            api_key, model_name, config,
+            lambda: _stream_qwen_text(url, headers, data, stream_settings, on_progress),
+            estimated_tokens
+        )
 
-    result = response.json()
+    def send():
+        response = http_post(url, headers=headers, json=data)
+        response.raise_for_status()
+        result = response.json()
+        return result, _qwen_usage_tokens(result.get('usage'))
+
+    result = call_qwen_with_limits(api_key, model_name, config, send, estimated_tokens)
     if 'output' in result and 'text' in result['output']:
         return result['output']['text']
     else:
         raise Exception('无法从 API 响应中提取文章内容')
 
+def _stream_qwen_text(url, headers, data, stream_settings, on_progress=None):
+    """以 SSE 方式调用 DashScope，边接收边拼接增量文本
+
+    读超时即为无数据超时：连接在 inactivity_timeout 秒内没有任何新数据时抛出异常，
+    避免挂起的连接长期占用工作线程。
+    """
+    timeout = (stream_settings.get('connect_timeout', 10), stream_settings.get('inactivity_timeout', 60))
+    chunks = []
+    usage = {}
+    event_type = None
+    data_lines = []
+
+    def dispatch(event_type, payload_text):
+        if not payload_text:
+            return
+        payload = json.loads(payload_text)
+        if event_type == 'error' or payload.get('code'):
+            message = f"DashScope 流式输出错误: {payload.get('code')} {payload.get('message', '')}".strip()
+            # 尚未输出内容时的限流错误可以安全重试
+            if str(payload.get('code', '')).startswith('Throttling') and not chunks:
+                raise QwenThrottledError(message)
+            raise Exception(message)
+        output = payload.get('output') or {}
+        delta = output.get('text') or ''
+        if delta:
+            chunks.append(delta)
+        if payload.get('usage'):
+            usage.update(payload['usage'])
+        if on_progress and (delta or payload.get('usage')):
+            on_progress(''.join(chunks), dict(usage))
+
+    with http_post(url, headers=headers, json=data, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        try:
+            for raw_line in response.iter_lines(decode_unicode=False):
+                line = raw_line.decode('utf-8') if raw_line is not None else ''
+                if not line:
+                    # 空行表示一个事件结束
+                    dispatch(event_type, '\n'.join(data_lines))
+                    event_type = None
+                    data_lines = []
+                    continue
+                if line.startswith(':'):
+                    continue
+                field, _, value = line.partition(':')
+                if field == 'event':
+                    event_type = value.strip()
+                elif field == 'data':
+                    data_lines.append(value)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # 与限流错误一样，只有尚未输出内容时才可以安全重试
+            if not chunks:
+                raise
+            raise QwenStreamInterruptedError(f'DashScope 流式输出中断（已接收 {len("".join(chunks))} 字）: {e}') from e
+        dispatch(event_type, '\n'.join(data_lines))
+
+    text = ''.join(chunks)
+    if not text:
+        raise Exception('无法从 API 响应中提取文章内容')
+    return text, _qwen_usage_tokens(usage)
+
+def get_completed_paragraphs(partial_text):
+    """从尚未生成完的文章中提取已经结束的段落
+
+    段落后出现空行或标题行才视为结束，正在输出的最后一段不会被返回，
+    因此返回结果与完整文章中对应位置的段落一致。
+    """
+    cut = partial_text.rfind('\n')
+    if cut < 0:
+        return []
+    stable_text = partial_text[:cut]
+    paragraphs = extract_paragraph_structures(stable_text)
+    last_line = stable_text.split('\n')[-1].strip()
+    if paragraphs and last_line and not last_line.startswith('#'):
+        paragraphs = paragraphs[:-1]
+    return paragraphs
+
 def extract_article_title(article):
     """从文章内容中提取标题（第一行或第一段）"""
     lines = article.strip().split('\n')
@@ -1349,7 +4791,7 @@ def extract_image_keyword(article, api_key, base_url, model_name):
         }]
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    response = http_post(url, headers=headers, json=data)
     response.raise_for_status()
 
     result = response.json()
@@ -1360,123 +4802,234 @@ def extract_image_keyword(article, api_key, base_url, model_name):
     else:
         raise Exception('无法从 API 响应中提取关键词')
 
-def download_unsplash_image(keyword, access_key):
-    """从 Unsplash 下载图片"""
-    try:
-        # 搜索图片
-        search_url = 'https://api.unsplash.com/search/photos'
-        headers = {'Authorization': f'Client-ID {access_key}'}
-        params = {'query': keyword, 'per_page': 1, 'orientation': 'landscape'}
+# 默认的图库搜索结果缓存配置：同一关键词只搜索一次，多次请求轮流分发不同的结果
+DEFAULT_IMAGE_SEARCH_CACHE_CONFIG = {
+    'enabled': True,
+    'ttl_seconds': 6 * 3600,
+    'per_page': 20,
+    'max_keywords': 500
+}
 
-        response = requests.get(search_url, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
+# 各图库单页结果数上限（Pixabay 下限为 3）
+IMAGE_SEARCH_PAGE_LIMITS = {'unsplash': 30, 'pexels': 80, 'pixabay': 200}
 
-        data = response.json()
-        if not data['results']:
-            return None
+# 搜索缓存运行时：(图库, 规范化关键词, 方向) -> {'urls', 'cursor', 'created_at'}，按最近使用顺序淘汰
+image_search_cache_lock = threading.Lock()
+image_search_cache = OrderedDict()
+image_search_inflight = {}
+image_search_cache_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
 
-        # 获取第一张图片的下载链接
-        image_url = data['results'][0]['urls']['regular']
+def get_image_search_cache_settings(config):
+    """合并默认搜索缓存配置和用户配置"""
+    merged = DEFAULT_IMAGE_SEARCH_CACHE_CONFIG.copy()
+    user_cfg = (config or {}).get('image_search_cache_settings') or {}
+    for key, value in user_cfg.items():
+        if value is not None:
+            merged[key] = value
+    merged['enabled'] = bool(merged.get('enabled', True))
+    merged['ttl_seconds'] = max(0, int(merged.get('ttl_seconds', DEFAULT_IMAGE_SEARCH_CACHE_CONFIG['ttl_seconds'])))
+    merged['per_page'] = max(1, int(merged.get('per_page', DEFAULT_IMAGE_SEARCH_CACHE_CONFIG['per_page'])))
+    merged['max_keywords'] = max(1, int(merged.get('max_keywords', DEFAULT_IMAGE_SEARCH_CACHE_CONFIG['max_keywords'])))
+    return merged
 
-        # 下载图片
-        image_response = requests.get(image_url, timeout=10)
-        image_response.raise_for_status()
+def normalize_search_keyword(keyword):
+    """规范化搜索关键词：小写、去标点、去重并排序词语，使 "Mountain, landscape" 与 "landscape mountain" 命中同一缓存"""
+    words = re.findall(r'\w+', (keyword or '').lower())
+    return ' '.join(sorted(set(words)))
 
-        # 保存到临时位置
-        config = load_config()
-        output_dir = config.get('output_directory', 'output')
-        os.makedirs(output_dir, exist_ok=True)
-        image_path = os.path.join(output_dir, f'temp_{datetime.now().strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:8]}.jpg')
-        with open(image_path, 'wb') as f:
-            f.write(image_response.content)
+def _take_cached_stock_url(entry, task_id):
+    """从缓存页的游标处取下一张未用过的图片并记录使用，调用方需持有 image_search_cache_lock"""
+    index = recent_image_ledger.pick_index(entry['urls'], entry['cursor'], task_id)
+    if index is None:
+        return None
+    entry['cursor'] = index + 1
+    recent_image_ledger.record(entry['urls'][index], task_id)
+    recent_image_ledger.add_undo(lambda: _rewind_stock_cursor(entry, index))
+    return entry['urls'][index]
 
-        return image_path
+def _rewind_stock_cursor(entry, index):
+    """撤销一次取图：游标之后没有再被推进时退回到该图片"""
+    with image_search_cache_lock:
+        if entry['cursor'] == index + 1:
+            entry['cursor'] = index
 
-    except Exception as e:
-        print(f"Unsplash 下载图片失败: {e}")
+def next_stock_image_url(provider, keyword, orientation, search, config=None):
+    """从搜索缓存中取下一张候选图片 URL，未命中或过期时调用 search(per_page) 拉取一整页结果
+
+    同一关键词的重复请求依次返回不同的结果，跳过本批次已用过和全局近期用过的图片，
+    都用过时选最久未用的一张；无结果也会被缓存，避免反复消耗配额。并发请求同一关键词时只搜索一次。
+
+    Args:
+        search: 接收 per_page、返回图片 URL 列表的函数
+    Returns:
+        图片 URL，没有结果时返回 None
+    """
+    if config is None:
+        config = load_config()
+    settings = get_image_search_cache_settings(config)
+    task_id = config.get('task_id')
+    per_page = min(max(settings['per_page'], 3 if provider == 'pixabay' else 1), IMAGE_SEARCH_PAGE_LIMITS.get(provider, 30))
+    if not settings['enabled']:
+        urls = search(per_page)
+        index = recent_image_ledger.pick_index(urls, 0, task_id)
+        if index is None:
+            return None
+        recent_image_ledger.record(urls[index], task_id)
+        return urls[index]
+
+    key = (provider, normalize_search_keyword(keyword), orientation)
+    while True:
+        with image_search_cache_lock:
+            entry = image_search_cache.get(key)
+            if entry and settings['ttl_seconds'] and time.time() - entry['created_at'] > settings['ttl_seconds']:
+                del image_search_cache[key]
+                image_search_cache_stats['expired'] += 1
+                entry = None
+            if entry:
+                image_search_cache.move_to_end(key)
+                image_search_cache_stats['hits'] += 1
+                return _take_cached_stock_url(entry, task_id)
+            waiter = image_search_inflight.get(key)
+            if waiter is None:
+                waiter = threading.Event()
+                image_search_inflight[key] = waiter
+                image_search_cache_stats['misses'] += 1
+                break
+        # 其他线程正在搜索同一关键词，等待其写入缓存
+        waiter.wait(timeout=30)
+
+    try:
+        urls = search(per_page)
+        with image_search_cache_lock:
+            entry = {'urls': urls, 'cursor': 0, 'created_at': time.time()}
+            image_search_cache[key] = entry
+            while len(image_search_cache) > settings['max_keywords']:
+                image_search_cache.popitem(last=False)
+                image_search_cache_stats['evictions'] += 1
+            return _take_cached_stock_url(entry, task_id)
+    finally:
+        with image_search_cache_lock:
+            image_search_inflight.pop(key, None)
+        waiter.set()
+
+def get_image_search_cache_stats():
+    """返回搜索缓存的命中率和条目数"""
+    with image_search_cache_lock:
+        stats = dict(image_search_cache_stats)
+        stats['keywords'] = len(image_search_cache)
+    stats['recent_use'] = recent_image_ledger.snapshot()
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+    return stats
+
+def _download_stock_image(provider, keyword, orientation, search, config=None):
+    """经熔断器搜索并下载图库图片；请求异常计为失败，没有搜索结果计为成功"""
+    breaker = get_circuit_breaker(provider)
+    if not breaker.allow():
+        print(f"图片源 {provider} 熔断中，跳过")
         return None
+    started = time.monotonic()
+    try:
+        config = config or load_config()
+        image_url = next_stock_image_url(provider, keyword, orientation, search, config)
+        # 存入图片仓库，同一图片被多个主题选中时只下载一次
+        image_path = fetch_image_to_store(image_url, config=config) if image_url else None
+    except Exception as e:
+        breaker.record(False, (time.monotonic() - started) * 1000, e)
+        raise
+    breaker.record(True, (time.monotonic() - started) * 1000)
+    return image_path
 
-def download_pexels_image(keyword, api_key):
-    """从 Pexels 下载图片"""
+def download_unsplash_image(keyword, access_key, config=None):
+    """从 Unsplash 下载图片"""
     try:
-        search_url = 'https://api.pexels.com/v1/search'
-        headers = {'Authorization': api_key}
-        params = {'query': keyword, 'per_page': 1, 'orientation': 'landscape'}
+        search_url = 'https://api.unsplash.com/search/photos'
+        headers = {'Authorization': f'Client-ID {access_key}'}
 
-        response = requests.get(search_url, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
+        def search(per_page):
+            params = {'query': keyword, 'per_page': per_page, 'orientation': 'landscape'}
+            response = http_get(search_url, headers=headers, params=params)
+            response.raise_for_status()
+            return [item['urls']['regular'] for item in response.json().get('results', [])]
 
-        data = response.json()
-        if not data.get('photos'):
-            return None
+        return _download_stock_image('unsplash', keyword, 'landscape', search, config)
 
-        # 获取第一张图片的下载链接（中等尺寸）
-        image_url = data['photos'][0]['src']['large']
+    except Exception as e:
+        print(f"Unsplash 下载图片失败: {e}")
+        return None
 
-        # 下载图片
-        image_response = requests.get(image_url, timeout=10)
-        image_response.raise_for_status()
+def download_pexels_image(keyword, api_key, config=None):
+    """从 Pexels 下载图片"""
+    try:
+        search_url = 'https://api.pexels.com/v1/search'
+        headers = {'Authorization': api_key}
 
-        # 保存到临时位置
-        config = load_config()
-        output_dir = config.get('output_directory', 'output')
-        os.makedirs(output_dir, exist_ok=True)
-        image_path = os.path.join(output_dir, f'temp_{datetime.now().strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:8]}.jpg')
-        with open(image_path, 'wb') as f:
-            f.write(image_response.content)
+        def search(per_page):
+            params = {'query': keyword, 'per_page': per_page, 'orientation': 'landscape'}
+            response = http_get(search_url, headers=headers, params=params)
+            response.raise_for_status()
+            # 使用 large 尺寸
+            return [photo['src']['large'] for photo in response.json().get('photos', [])]
 
-        return image_path
+        return _download_stock_image('pexels', keyword, 'landscape', search, config)
 
     except Exception as e:
         print(f"Pexels 下载图片失败: {e}")
         return None
 
-def download_pixabay_image(keyword, api_key):
+def download_pixabay_image(keyword, api_key, config=None):
     """从 Pixabay 下载图片"""
     try:
         search_url = 'https://pixabay.com/api/'
-        params = {
-            'key': api_key,
-            'q': keyword,
-            'per_page': 3,
-            'image_type': 'photo',
-            'orientation': 'horizontal'
-        }
 
-        response = requests.get(search_url, params=params, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-        if not data.get('hits'):
-            return None
-
-        # 获取第一张图片的下载链接
-        image_url = data['hits'][0]['largeImageURL']
-
-        # 下载图片
-        image_response = requests.get(image_url, timeout=10)
-        image_response.raise_for_status()
-
-        # 保存到临时位置
-        config = load_config()
-        output_dir = config.get('output_directory', 'output')
-        os.makedirs(output_dir, exist_ok=True)
-        image_path = os.path.join(output_dir, f'temp_{datetime.now().strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:8]}.jpg')
-        with open(image_path, 'wb') as f:
-            f.write(image_response.content)
+        def search(per_page):
+            params = {
+                'key': api_key,
+                'q': keyword,
+                'per_page': per_page,
+                'image_type': 'photo',
+                'orientation': 'horizontal'
+            }
+            response = http_get(search_url, params=params)
+            response.raise_for_status()
+            return [hit['largeImageURL'] for hit in response.json().get('hits', [])]
 
-        return image_path
+        return _download_stock_image('pixabay', keyword, 'horizontal', search, config)
 
     except Exception as e:
         print(f"Pixabay 下载图片失败: {e}")
         return None
 
-def get_local_image_by_tags(tags=None, config=None):
-    """从本地图库中根据标签选择图片"""
+def _scan_local_image_directories(local_dirs):
+    """直接扫描目录列出图片（索引关闭时使用）"""
+    images = []
+    for dir_config in local_dirs:
+        dir_path = dir_config.get('path', '')
+        if os.path.exists(dir_path) and os.path.isdir(dir_path):
+            for file in os.listdir(dir_path):
+                file_path = os.path.join(dir_path, file)
+                if os.path.isfile(file_path) and file.lower().endswith(tuple(ALLOWED_EXTENSIONS)):
+                    images.append({
+                        'filename': file,
+                        'path': file_path,
+                        'directory': dir_path,
+                        'tags': dir_config.get('tags', [])
+                    })
+    return images
+
+def get_local_image_by_tags(tags=None, config=None, query=None):
+    """从本地图库中根据标签选择图片（优先使用索引）
+
+    Args:
+        query: 段落摘要或图片关键词，索引开启语义匹配时按文本相似度选择
+    """
     try:
         if not config:
             config = load_config()
 
+        if local_image_index.settings['enabled'] and local_image_index.ready:
+            return local_image_index.choose(tags, query=query, task_id=config.get('task_id'))
+
         local_dirs = config.get('local_image_directories', [{'path': 'pic', 'tags': ['default']}])
 
         # 如果指定了标签，优先从匹配标签的目录中选择
@@ -1485,19 +5038,10 @@ def get_local_image_by_tags(tags=None, config=None):
             if matching_dirs:
                 local_dirs = matching_dirs
 
-        # 收集所有可用的图片
-        available_images = []
-        for dir_config in local_dirs:
-            dir_path = dir_config.get('path', '')
-            if os.path.exists(dir_path) and os.path.isdir(dir_path):
-                for file in os.listdir(dir_path):
-                    file_path = os.path.join(dir_path, file)
-                    if os.path.isfile(file_path) and file.lower().endswith(tuple(ALLOWED_EXTENSIONS)):
-                        available_images.append(file_path)
-
-        # 随机选择一张图片
+        # 随机选择一张图片，本批次和近期用过的图片降权
+        available_images = [image['path'] for image in _scan_local_image_directories(local_dirs)]
         if available_images:
-            return random.choice(available_images)
+            return _weighted_choice_with_recent_use(available_images, [1.0] * len(available_images), config.get('task_id'))
 
         return None
 
@@ -1574,7 +5118,9 @@ def create_word_document(title, content, image_list=None, enable_image=True, pan
             '--standalone'
         ]
 
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        result = work_scheduler.run(
+            'pandoc', subprocess.run, cmd, capture_output=True, text=True, timeout=60, **schedule_options(config)
+        )
 
         if result.returncode != 0:
             raise Exception(f'Pandoc 转换失败: {result.stderr}')
@@ -1585,11 +5131,11 @@ def create_word_document(title, content, image_list=None, enable_image=True, pan
         except:
             pass
 
-        # 删除临时图片文件
+        # 仓库外的临时图片（仓库关闭时产生）直接删除
         if image_list and isinstance(image_list, list):
             for img_info in image_list:
                 img_path = img_info.get('path', '')
-                if img_path and 'temp_' in os.path.basename(img_path) and os.path.exists(img_path):
+                if img_path and not is_image_store_path(img_path) and 'temp_' in os.path.basename(img_path) and os.path.exists(img_path):
                     try:
                         os.remove(img_path)
                     except:
@@ -1608,6 +5154,10 @@ def create_word_document(title, content, image_list=None, enable_image=True, pan
         except:
             pass
         raise e
+    finally:
+        # 无论转换成功与否，本文档都不再持有仓库图片的引用
+        if image_list and isinstance(image_list, list):
+            release_image_refs([img_info.get('path', '') for img_info in image_list])
 
 def _add_no_image_warning(content):
     """在第一段后添加配图提示"""
@@ -1631,15 +5181,84 @@ def _add_no_image_warning(content):
 
 @app.route('/api/generate/status/<task_id>', methods=['GET'])
 def get_generation_status(task_id):
-    """获取生成任务的状态"""
-    with task_lock:
-        task = generation_tasks.get(task_id)
-        if not task:
+    """获取生成任务的状态
+
+    查询参数:
+        since: 上次返回的 version，提供时只返回此后新增的结果、错误和重新排队的主题
+        mode: compact 时省略 images_info 和流式中间文本
+    """
+    since = request.args.get('since', type=int)
+    compact = request.args.get('mode') == 'compact'
+
+    if since is not None:
+        delta = task_store.get_task_delta(task_id, since, compact)
+        if not delta:
             return jsonify({'error': '任务不存在'}), 404
-        # 返回任务的副本以避免在迭代时被修改
-        task_copy = task.copy()
-        print(f"[API] 返回任务状态: results={len(task_copy['results'])}, errors={len(task_copy['errors'])}, status={task_copy['status']}")
-        return jsonify(task_copy)
+        return jsonify(delta)
+
+    task = task_store.get_task(task_id)
+    if not task:
+        return jsonify({'error': '任务不存在'}), 404
+    if compact:
+        task = _compact_task_snapshot(task)
+    print(f"[API] 返回任务状态: results={len(task['results'])}, errors={len(task['errors'])}, status={task['status']}")
+    return jsonify(task)
+
+@app.route('/api/generate/events/<task_id>', methods=['GET'])
+def stream_generation_events(task_id):
+    """以 SSE 推送任务事件
+
+    事件类型: snapshot / started / writing / article-done / image-done / docx-done / topic-error / task-completed
+    断线重连时浏览器会携带 Last-Event-ID，缓冲中仍有的事件直接补发，否则先推送 snapshot。
+    """
+    if not task_store.get_task(task_id):
+        return jsonify({'error': '任务不存在'}), 404
+    last_seq = _parse_task_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+
+    def event_stream():
+        cursor = last_seq
+        while True:
+            with task_event_condition:
+                if cursor is not None:
+                    events, complete = _get_task_events_after(task_id, cursor)
+                    if complete and not events:
+                        task_event_condition.wait(timeout=TASK_EVENT_KEEPALIVE_SECONDS)
+                        events, complete = _get_task_events_after(task_id, cursor)
+                if cursor is None or not complete:
+                    buffer = task_event_buffers.get(task_id)
+                    cursor = buffer['next_id'] - 1 if buffer else 0
+                    events = None
+
+            if events is None:
+                # 先记录游标再读取快照，期间产生的事件会重复推送，客户端按主题去重
+                snapshot = task_store.get_task(task_id)
+                if not snapshot:
+                    return
+                yield _format_sse('snapshot', _compact_task_snapshot(snapshot), cursor)
+                if snapshot['status'] == 'completed':
+                    return
+                continue
+
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for event_id, event_type, data in events:
+                yield _format_sse(event_type, data, event_id)
+                cursor = event_id
+                if event_type == 'task-completed':
+                    return
+
+    return Response(stream_with_context(event_stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/generate/tasks', methods=['GET'])
+def list_generation_tasks():
+    """按状态列出任务（如 running / completed / interrupted）"""
+    status = request.args.get('status') or None
+    limit = min(200, max(1, request.args.get('limit', 50, type=int)))
+    return jsonify({'success': True, 'tasks': task_store.list_tasks(status, limit)})
 
 @app.route('/api/generate/retry', methods=['POST'])
 def retry_failed_topics():
@@ -1651,30 +5270,45 @@ def retry_failed_topics():
     if not task_id or not topics_to_retry:
         return jsonify({'error': '缺少 task_id 或 topics'}), 400
 
-    with task_lock:
-        task = generation_tasks.get(task_id)
-        if not task:
-            return jsonify({'error': '任务不存在'}), 404
+    # 将失败记录重置为待处理，任务状态改回 running，总数保持不变；只重新提交确实失败过的主题
+    reset_topics = task_store.reset_topics_for_retry(task_id, topics_to_retry)
+    if reset_topics is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if not reset_topics:
+        return jsonify({'error': '指定的主题没有失败记录，无需重试'}), 400
 
-        # 从错误列表中移除需要重试的主题
-        new_errors = [e for e in task['errors'] if e['topic'] not in topics_to_retry]
-        task['errors'] = new_errors
+    # 重新提交任务（未变化的蓝图和摘要会命中 LLM 缓存，除非指定 bypass_cache）
+    config = load_config()
+    if data.get('bypass_cache'):
+        config['llm_cache_bypass'] = True
+    # 重试的主题优先于普通批量任务执行
+    start_generation_task(task_id, reset_topics, config, priority=1)
 
-        # 更新任务状态，但保持总数不变
-        task['status'] = 'running'
+    return jsonify({'success': True, 'message': f'已重新提交 {len(reset_topics)} 个主题进行生成'})
 
-        # 根据原始总数重新计算进度
-        completed_count = len(task['results']) + len(task['errors'])
-        if task.get('total', 0) > 0:
-            task['progress'] = (completed_count / task['total']) * 100
-        else:
-            task['progress'] = 0
+@app.route('/api/generate/resume', methods=['POST'])
+def resume_generation_task():
+    """继续因服务重启而中断的任务，只重新生成尚未完成的主题"""
+    data = request.json or {}
+    task_id = data.get('task_id')
+    if not task_id:
+        return jsonify({'error': '缺少 task_id'}), 400
 
-    # 重新提交任务
-    config = load_config()
-    executor.submit(_execute_generation_task, task_id, topics_to_retry, config)
+    task = task_store.get_task(task_id)
+    if not task:
+        return jsonify({'error': '任务不存在'}), 404
+    if task['status'] != 'interrupted':
+        return jsonify({'error': '任务未中断，无需继续'}), 400
+
+    topics = task_store.get_unfinished_topics(task_id)
+    if not topics:
+        if task_store.complete_if_finished(task_id):
+            publish_task_event(task_id, 'task-completed', {'status': 'completed'})
+        return jsonify({'success': True, 'message': '任务已全部完成'})
 
-    return jsonify({'success': True, 'message': f'已重新提交 {len(topics_to_retry)} 个主题进行生成'})
+    task_store.set_status(task_id, 'running')
+    start_generation_task(task_id, topics, load_config())
+    return jsonify({'success': True, 'message': f'已继续生成 {len(topics)} 个未完成的主题'})
 
 @app.route('/api/download/<filename>')
 def download_file(filename):
@@ -1737,7 +5371,7 @@ def _parse_json_response(text):
                 pass
     raise ValueError('无法解析模型返回的 JSON')
 
-def generate_visual_blueprint_qwen(topic, article, api_key, base_url, model_name):
+def generate_visual_blueprint_qwen(topic, article, api_key, base_url, model_name, config=None):
     """调用阿里云 Qwen 生成结构化的视觉描述"""
     if not api_key:
         return None
@@ -1767,38 +5401,19 @@ def generate_visual_blueprint_qwen(topic, article, api_key, base_url, model_name
 4. 只输出 JSON，禁止添加额外解释或 Markdown。
 """
 
-    url = f'{base_url}/api/v1/services/aigc/text-generation/generation'
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'X-DashScope-SSE': 'disable'
-    }
-    data = {
-        'model': model_name,
-        'input': {
-            'messages': [
-                {'role': 'user', 'content': prompt}
-            ]
-        },
-        'parameters': {
-            'result_format': 'text'
-        }
-    }
-
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
-
-    result = response.json()
-    if 'output' not in result or 'text' not in result['output']:
-        raise Exception('视觉描述生成失败：没有输出内容')
-
-    raw_text = result['output']['text']
-
     try:
-        blueprint = _parse_json_response(raw_text)
-    except ValueError as exc:
+        blueprint = request_qwen_text(
+            api_key, base_url, model_name, prompt,
+            config=config,
+            validator=_parse_json_response
+        )
+    except QwenResponseError as exc:
         raise Exception(f'视觉描述 JSON 解析失败: {exc}')
 
+    return _normalize_visual_blueprint(blueprint, topic)
+
+def _normalize_visual_blueprint(blueprint, topic):
+    """规范化视觉蓝图字段，缺失的字段使用默认描述"""
     template = blueprint.get('template', 'editorial')
     if template not in VISUAL_TEMPLATE_PRESETS:
         template = 'editorial'
@@ -1822,6 +5437,154 @@ def generate_visual_blueprint_qwen(topic, article, api_key, base_url, model_name
 
     return normalized
 
+VISUAL_BLUEPRINT_FIELDS = ('template', 'subject', 'scene', 'mood', 'style', 'lighting', 'composition', 'details', 'negative')
+
+def _validate_visual_plan(plan, paragraph_count):
+    """校验合并视觉计划的结构，不合法时抛出 ValueError
+
+    Returns:
+        (blueprint, summaries)，summaries 与段落一一对应，缺失的条目为 None
+    """
+    if not isinstance(plan, dict):
+        raise ValueError('视觉计划应为 JSON 对象')
+
+    blueprint = plan.get('blueprint')
+    if not isinstance(blueprint, dict):
+        raise ValueError('视觉计划缺少 blueprint 对象')
+    for field in VISUAL_BLUEPRINT_FIELDS:
+        value = blueprint.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f'视觉计划 blueprint.{field} 缺失或不是字符串')
+    if blueprint['template'] not in VISUAL_TEMPLATE_PRESETS:
+        raise ValueError(f"视觉计划 template 取值非法: {blueprint['template']}")
+
+    entries = plan.get('summaries')
+    if not isinstance(entries, list):
+        raise ValueError('视觉计划缺少 summaries 数组')
+
+    summaries = [None] * paragraph_count
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            index = int(entry.get('index'))
+        except (TypeError, ValueError):
+            continue
+        description = str(entry.get('description') or '').strip().strip('"').strip("'")
+        if description and 0 <= index < paragraph_count:
+            summaries[index] = description
+    return blueprint, summaries
+
+def generate_visual_plan_qwen(topic, article, paragraph_texts, api_key, base_url, model_name, config=None):
+    """一次请求同时生成视觉蓝图和各配图段落的摘要
+
+    Returns:
+        (normalized_blueprint, summaries)，summaries 与 paragraph_texts 一一对应，
+        单条摘要缺失时为 None；整体结构校验失败时抛出异常
+    """
+    if not api_key:
+        return None, [None] * len(paragraph_texts)
+
+    truncated_article = article[:2000]
+    numbered = '\n\n'.join(
+        f'[{index}]\n{text[:500]}' for index, text in enumerate(paragraph_texts)
+    )
+    prompt = f"""你是一名资深视觉导演，请阅读以下文章内容，产出一个用于 Stable Diffusion / ComfyUI 的视觉计划，并为指定的配图段落分别写出画面描述。
+标题：{topic}
+正文片段：{truncated_article}
+
+配图段落（共 {len(paragraph_texts)} 段，方括号内为编号）：
+{numbered}
+
+请严格按照以下 JSON 结构输出：
+{{
+  "blueprint": {{
+    "template": "portrait|urban_story|technology|nature|editorial|abstract",
+    "subject": "...",
+    "scene": "...",
+    "mood": "...",
+    "style": "...",
+    "lighting": "...",
+    "composition": "...",
+    "details": "...",
+    "negative": "..."
+  }},
+  "summaries": [{{"index": 0, "description": "..."}}]
+}}
+
+要求：
+1. blueprint.template 字段只能取上述枚举之一。
+2. blueprint 其它字段使用英文短语，长度 4-15 个词，写出具体可视化描述，使用英文逗号分隔短语。
+3. blueprint.negative 字段写出不希望出现的画面元素，使用英文。
+4. summaries 为每个配图段落输出一条中文视觉描述（15-30个汉字），描述段落中的主要主体、动作或场景，聚焦于物体、人物、地点、动作、氛围等视觉元素。
+5. 只输出 JSON，禁止添加额外解释或 Markdown。
+"""
+
+    try:
+        blueprint, summaries = request_qwen_text(
+            api_key, base_url, model_name, prompt,
+            config=config,
+            validator=lambda text: _validate_visual_plan(_parse_json_response(text), len(paragraph_texts))
+        )
+    except QwenResponseError as exc:
+        raise Exception(f'视觉计划校验失败: {exc}')
+
+    return _normalize_visual_blueprint(blueprint, topic), summaries
+
+def plan_article_visuals(topic, article, paragraph_texts, config):
+    """生成文章的视觉蓝图和配图段落摘要
+
+    优先使用合并的视觉计划请求；未启用、摘要模型与写作模型不同或校验失败时，
+    退回到视觉蓝图 + 批量摘要两个并行请求。
+
+    Returns:
+        (visual_blueprint, summaries_by_text)，蓝图失败时为 None，
+        summaries_by_text 中缺失的段落由调用方逐段降级
+    """
+    api_key = config.get('aliyun_api_key', '')
+    base_url = config.get('aliyun_base_url', 'https://dashscope.aliyuncs.com')
+    model_name = config.get('default_model') or 'qwen-plus'
+    summary_model = config.get('comfyui_summary_model', '__default__')
+    if summary_model == '__default__':
+        summary_model = config.get('default_model', 'qwen-plus')
+
+    if paragraph_texts and config.get('enable_fused_visual_plan', True) and summary_model == model_name:
+        unique_texts = list(dict.fromkeys(paragraph_texts))
+        try:
+            visual_blueprint, summaries = generate_visual_plan_qwen(topic, article, unique_texts, api_key, base_url, model_name, config)
+            if visual_blueprint:
+                print(f"合并视觉计划生成成功: 摘要 {sum(1 for item in summaries if item)}/{len(unique_texts)}")
+                return visual_blueprint, {
+                    text: summary for text, summary in zip(unique_texts, summaries) if summary
+                }
+        except Exception as e:
+            print(f"合并视觉计划生成失败: {e}，改用分步生成")
+
+    batch_future = None
+    if paragraph_texts:
+        batch_future = work_scheduler.submit(
+            'llm', summarize_paragraphs_for_images, paragraph_texts, topic, config, False,
+            **schedule_options(config)
+        )
+
+    try:
+        # 生成视觉蓝图(仅一次)
+        visual_blueprint = generate_visual_blueprint_qwen(topic, article, api_key, base_url, model_name, config)
+    except Exception as e:
+        print(f"生成视觉蓝图失败: {e}")
+        visual_blueprint = None
+
+    summaries_by_text = {}
+    if batch_future is not None:
+        try:
+            summaries_by_text = {
+                text: summary for text, summary in zip(paragraph_texts, batch_future.result()) if summary
+            }
+        except Exception as e:
+            print(f"批量段落摘要生成异常: {e}")
+
+    return visual_blueprint, summaries_by_text
+
 def build_visual_prompts(blueprint):
     """根据视觉蓝图和模板生成正/负向提示词"""
     if not blueprint:
@@ -2029,36 +5792,21 @@ def summarize_paragraph_for_image(paragraph_text, topic, config):
 
 视觉描述："""
 
-    try:
-        url = f'{base_url}/api/v1/services/aigc/text-generation/generation'
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'X-DashScope-SSE': 'disable'
-        }
-        data = {
-            'model': summary_model,
-            'input': {
-                'messages': [
-                    {'role': 'user', 'content': prompt}
-                ]
-            },
-            'parameters': {
-                'result_format': 'text'
-            }
-        }
-
-        response = requests.post(url, headers=headers, json=data, timeout=30)
-        response.raise_for_status()
+    def parse_summary(text):
+        summary = text.strip().strip('"').strip("'")
+        if not summary:
+            raise ValueError('摘要为空')
+        return summary
 
-        result = response.json()
-        if 'output' in result and 'text' in result['output']:
-            summary = result['output']['text']
-            summary = summary.strip().strip('"').strip("'")
-            print(f"段落摘要生成成功: {summary}")
-            return summary
-        else:
-            raise Exception('无法从API响应中提取摘要')
+    try:
+        summary = request_qwen_text(
+            api_key, base_url, summary_model, prompt,
+            timeout=30,
+            config=config,
+            validator=parse_summary
+        )
+        print(f"段落摘要生成成功: {summary}")
+        return summary
     except Exception as e:
         print(f"段落摘要生成失败: {e}，使用降级方案")
         # 降级：使用主题或段落前50字符
@@ -2067,6 +5815,80 @@ def summarize_paragraph_for_image(paragraph_text, topic, config):
             return f"illustration of {fallback}"
         return f"visual representation of {topic}"
 
+def summarize_paragraphs_for_images(paragraph_texts, topic, config, fallback=True):
+    """一次请求为多个段落生成图片摘要
+
+    Args:
+        paragraph_texts: 段落文本列表（相同段落只会请求一次）
+        fallback: 为 True 时对解析失败的条目逐个调用 summarize_paragraph_for_image；
+                  为 False 时对应位置返回 None，由调用方自行降级
+    Returns:
+        与 paragraph_texts 一一对应的摘要列表
+    """
+    unique_texts = list(dict.fromkeys(paragraph_texts))
+    summaries_by_text = {}
+
+    summary_model = config.get('comfyui_summary_model', '__default__')
+    if summary_model == '__default__':
+        summary_model = config.get('default_model', 'qwen-plus')
+
+    api_key = config.get('aliyun_api_key', '')
+    base_url = config.get('aliyun_base_url', 'https://dashscope.aliyuncs.com')
+
+    if api_key and unique_texts:
+        numbered = '\n\n'.join(
+            f'[{index}]\n{text[:500]}' for index, text in enumerate(unique_texts)
+        )
+        prompt = f"""阅读以下关于「{topic}」的文章段落（共 {len(unique_texts)} 段，方括号内为编号），为每一段生成适合图片生成的中文视觉描述。
+
+要求：
+1. 描述段落中的主要主体、动作或场景（15-30个汉字）
+2. 要具体且可视化 - 描述你会看到什么，而不是抽象概念
+3. 使用具体的名词、生动的动词和具体细节
+4. 聚焦于视觉元素：物体、人物、地点、动作、氛围
+5. 严格按照以下 JSON 结构输出，每个编号对应一条，只输出 JSON，不要添加额外解释或 Markdown：
+{{"summaries": [{{"index": 0, "description": "..."}}]}}
+
+段落内容：
+{numbered}
+"""
+        def parse_batch(text):
+            parsed = _parse_json_response(text)
+            entries = parsed.get('summaries') if isinstance(parsed, dict) else None
+            if not isinstance(entries, list):
+                raise ValueError('缺少 summaries 数组')
+            return entries
+
+        try:
+            entries = request_qwen_text(
+                api_key, base_url, summary_model, prompt,
+                timeout=60,
+                config=config,
+                validator=parse_batch
+            )
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    continue
+                try:
+                    index = int(entry.get('index'))
+                except (TypeError, ValueError):
+                    continue
+                description = str(entry.get('description') or '').strip().strip('"').strip("'")
+                if description and 0 <= index < len(unique_texts):
+                    summaries_by_text[unique_texts[index]] = description
+            print(f"批量段落摘要生成成功: {len(summaries_by_text)}/{len(unique_texts)}")
+        except Exception as e:
+            print(f"批量段落摘要生成失败: {e}，逐段降级")
+
+    summaries = []
+    for text in paragraph_texts:
+        summary = summaries_by_text.get(text)
+        if summary is None and fallback:
+            summary = summarize_paragraph_for_image(text, topic, config)
+            summaries_by_text[text] = summary
+        summaries.append(summary)
+    return summaries
+
 def inject_images_into_markdown(markdown_text, image_list):
     """将多张图片按指定位置插入到Markdown文章中
 
@@ -2123,8 +5945,7 @@ def inject_images_into_markdown(markdown_text, image_list):
 
     return '\n'.join(lines)
 
-def load_comfyui_prompt_graph(settings):
-    """根据配置加载 ComfyUI workflow"""
+def _resolve_comfyui_workflow_path(settings):
     workflow_path = settings.get('workflow_path')
     if not workflow_path:
         raise ValueError('未配置 ComfyUI workflow 文件路径')
@@ -2134,6 +5955,11 @@ def load_comfyui_prompt_graph(settings):
         workflow_path = Path.cwd() / workflow_path
     if not workflow_path.exists():
         raise FileNotFoundError(f'ComfyUI workflow 文件不存在: {workflow_path}')
+    return workflow_path
+
+def load_comfyui_prompt_graph(settings):
+    """根据配置加载 ComfyUI workflow"""
+    workflow_path = _resolve_comfyui_workflow_path(settings)
 
     with open(workflow_path, 'r', encoding='utf-8') as f:
         raw_data = json.load(f)
@@ -2150,43 +5976,110 @@ def load_comfyui_prompt_graph(settings):
 
     return copy.deepcopy(prompt_graph)
 
+COMFYUI_PLACEHOLDERS = ('{{positive_prompt}}', '{{negative_prompt}}', '{{filename_prefix}}')
+
+# 已编译的 workflow 模板：解析后的路径 -> ((mtime_ns, size), 模板)
+comfyui_workflow_cache_lock = threading.Lock()
+comfyui_workflow_cache = {}
+
+def compile_comfyui_workflow(prompt_graph):
+    """扫描一次 workflow，记录每次生成都需要改写的 (节点, 输入) 位置
+
+    slot 类型: template（包含占位符的字符串）、seed、batch_size、filename_prefix（不含占位符的前缀）
+    """
+    slots = []
+    for node_id, node in prompt_graph.items():
+        inputs = node.get('inputs', {}) if isinstance(node, dict) else None
+        if not isinstance(inputs, dict):
+            continue
+        for key, value in inputs.items():
+            if key == 'seed':
+                slots.append(('seed', node_id, key, None))
+            elif isinstance(value, str) and any(placeholder in value for placeholder in COMFYUI_PLACEHOLDERS):
+                slots.append(('template', node_id, key, value))
+            elif key == 'batch_size' and isinstance(value, int):
+                slots.append(('batch_size', node_id, key, None))
+            elif key == 'filename_prefix' and isinstance(value, str):
+                slots.append(('filename_prefix', node_id, key, None))
+    return {
+        'graph': prompt_graph,
+        'slots': slots,
+        'supports_batch': any(slot[0] == 'batch_size' for slot in slots)
+    }
 
-def build_comfyui_workflow_payload(prompts, settings):
-    """根据模板工作流构造 ComfyUI API 所需的 payload"""
-    prompt_graph = load_comfyui_prompt_graph(settings)
+def get_comfyui_workflow_template(settings):
+    """获取已编译的 workflow 模板，文件 mtime 或大小变化时重新编译"""
+    workflow_path = _resolve_comfyui_workflow_path(settings)
+    stat = workflow_path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cache_key = str(workflow_path)
+    with comfyui_workflow_cache_lock:
+        cached = comfyui_workflow_cache.get(cache_key)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    template = compile_comfyui_workflow(load_comfyui_prompt_graph(settings))
+    with comfyui_workflow_cache_lock:
+        comfyui_workflow_cache[cache_key] = (signature, template)
+    return template
+
+def comfyui_workflow_supports_batch(settings):
+    """workflow 中存在整数 batch_size 输入（如 EmptyLatentImage）时才能合并生成"""
+    return get_comfyui_workflow_template(settings)['supports_batch']
+
+def build_comfyui_workflow_payload(prompts, settings, batch_size=1):
+    """根据模板工作流构造 ComfyUI API 所需的 payload
+
+    模板图本身不被修改：只复制需要改写的节点及其 inputs，其余节点与模板共享。
+    """
+    template = get_comfyui_workflow_template(settings)
 
     seed = settings.get('seed', -1)
     if seed is None or seed < 0:
         seed = random.randint(1, 2**31 - 1)
 
+    filename_prefix = 'auto_' + datetime.now().strftime('%Y%m%d')
     replacements = {
         '{{positive_prompt}}': prompts['positive_prompt'],
         '{{negative_prompt}}': prompts['negative_prompt'],
-        '{{filename_prefix}}': 'auto_' + datetime.now().strftime('%Y%m%d')
+        '{{filename_prefix}}': filename_prefix
     }
 
-    for node in prompt_graph.values():
-        inputs = node.get('inputs', {})
-        if not isinstance(inputs, dict):
-            continue
-
-        for key, value in list(inputs.items()):
-            if isinstance(value, str):
-                for placeholder, actual in replacements.items():
-                    if placeholder in value:
-                        inputs[key] = value.replace(placeholder, actual)
-
-            if key == 'seed':
-                inputs[key] = seed
-            elif key == 'filename_prefix' and isinstance(value, str) and '{{filename_prefix}}' not in value:
-                inputs[key] = 'auto_' + datetime.now().strftime('%Y%m%d')
+    prompt_graph = dict(template['graph'])
+    patched_inputs = {}
+
+    def inputs_of(node_id):
+        if node_id not in patched_inputs:
+            node = dict(prompt_graph[node_id])
+            node['inputs'] = dict(node['inputs'])
+            prompt_graph[node_id] = node
+            patched_inputs[node_id] = node['inputs']
+        return patched_inputs[node_id]
+
+    for kind, node_id, key, original in template['slots']:
+        if kind == 'template':
+            value = original
+            for placeholder, actual in replacements.items():
+                value = value.replace(placeholder, actual)
+            inputs_of(node_id)[key] = value
+        elif kind == 'seed':
+            inputs_of(node_id)[key] = seed
+        elif kind == 'batch_size':
+            if batch_size > 1:
+                inputs_of(node_id)[key] = batch_size
+        elif kind == 'filename_prefix':
+            inputs_of(node_id)[key] = filename_prefix
 
     return {
         'prompt': prompt_graph
     }
-def submit_comfyui_prompt(payload, settings):
+
+def submit_comfyui_prompt(payload, settings, client_id=None):
     server = settings.get('server_url', 'http://127.0.0.1:8188').rstrip('/')
-    response = requests.post(f'{server}/prompt', json=payload, timeout=30)
+    if client_id:
+        # 带上 client_id，ComfyUI 才会把执行事件推送到对应的 websocket 连接
+        payload = dict(payload, client_id=client_id)
+    response = http_post(f'{server}/prompt', json=payload, timeout=30)
     response.raise_for_status()
     data = response.json()
     prompt_id = data.get('prompt_id')
@@ -2199,7 +6092,7 @@ def poll_comfyui_history(server, prompt_id, settings):
     start = time.time()
     while time.time() - start < timeout:
         try:
-            history_resp = requests.get(f'{server}/history/{prompt_id}', timeout=10)
+            history_resp = http_get(f'{server}/history/{prompt_id}', timeout=10)
             if history_resp.status_code == 404:
                 time.sleep(2)
                 continue
@@ -2239,7 +6132,456 @@ def poll_comfyui_history(server, prompt_id, settings):
         time.sleep(2)
     raise TimeoutError('等待 ComfyUI 生成图片超时')
 
-def download_comfyui_image(server, image_meta, output_dir, topic_slug, settings):
+class ComfyUIEventClient:
+    """订阅 ComfyUI /ws 事件流的客户端（每个服务器一个连接）
+
+    提交 prompt 时带上 client_id，ComfyUI 会把该 prompt 的执行事件推送到这个连接：
+    executed 消息携带节点输出，executing(node=None) / execution_success 表示整个 prompt 完成，
+    execution_error 表示失败。连接断开后后台线程自动重连，期间等待方回退为 HTTP 轮询。
+    """
+
+    RECENT_LIMIT = 200
+
+    def __init__(self, server):
+        self.server = server
+        self.client_id = uuid.uuid4().hex
+        self.connected = False
+        self._lock = threading.Lock()
+        self._connected_event = threading.Event()
+        self._waiters = {}  # prompt_id -> {'future', 'outputs', 'progress', 'node'}
+        self._recent = OrderedDict()  # 尚未注册等待方时已结束的 prompt: prompt_id -> (outputs, error)
+        self._ws = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'comfyui-ws-{urlsplit(server).netloc}')
+        self._thread.start()
+
+    def _ws_url(self):
+        parts = urlsplit(self.server)
+        scheme = 'wss' if parts.scheme == 'https' else 'ws'
+        return f'{scheme}://{parts.netloc}{parts.path.rstrip("/")}/ws?clientId={self.client_id}'
+
+    def _run(self):
+        delay = 1
+        while True:
+            try:
+                ws = websocket.create_connection(self._ws_url(), timeout=10)
+                ws.settimeout(None)
+                self._ws = ws
+                self.connected = True
+                self._connected_event.set()
+                delay = 1
+                while True:
+                    message = ws.recv()
+                    if isinstance(message, str):
+                        self._handle(json.loads(message))
+            except Exception as e:
+                if self.connected:
+                    print(f"ComfyUI 事件连接断开 ({self.server}): {e}")
+            finally:
+                self.connected = False
+                self._connected_event.clear()
+                self._ws = None
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def wait_connected(self, timeout):
+        return self._connected_event.wait(timeout)
+
+    def _handle(self, message):
+        event_type = message.get('type')
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        with self._lock:
+            waiter = self._waiters.get(prompt_id)
+            if waiter is None:
+                # 等待方还没注册，只记录结束结果
+                waiter = self._recent_entry(prompt_id)
+            if event_type == 'executing':
+                if data.get('node') is None:
+                    self._finish(prompt_id, waiter)
+                else:
+                    waiter['node'] = data.get('node')
+            elif event_type == 'progress':
+                waiter['progress'][str(data.get('node'))] = {'value': data.get('value'), 'max': data.get('max')}
+            elif event_type == 'executed':
+                waiter['outputs'][str(data.get('node'))] = data.get('output') or {}
+            elif event_type == 'execution_success':
+                self._finish(prompt_id, waiter)
+            elif event_type in ('execution_error', 'execution_interrupted'):
+                error = RuntimeError(data.get('exception_message') or f'ComfyUI 执行失败: {event_type}')
+                self._finish(prompt_id, waiter, error)
+
+    def _recent_entry(self, prompt_id):
+        entry = self._recent.get(prompt_id)
+        if entry is None:
+            entry = self._recent[prompt_id] = {'future': None, 'outputs': {}, 'progress': {}, 'node': None, 'done': False}
+            while len(self._recent) > self.RECENT_LIMIT:
+                self._recent.popitem(last=False)
+        return entry
+
+    def _finish(self, prompt_id, waiter, error=None):
+        future = waiter.get('future')
+        if future is None:
+            waiter['done'] = True
+            waiter['error'] = error
+            return
+        self._waiters.pop(prompt_id, None)
+        if future.done():
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(waiter['outputs'])
+
+    def register(self, prompt_id):
+        """注册等待方，返回在 prompt 完成时得到 outputs 的 Future"""
+        future = Future()
+        with self._lock:
+            entry = self._recent.pop(prompt_id, None) or {'outputs': {}, 'progress': {}, 'node': None, 'done': False}
+            entry['future'] = future
+            if entry.get('done'):
+                if entry.get('error'):
+                    future.set_exception(entry['error'])
+                else:
+                    future.set_result(entry['outputs'])
+            else:
+                self._waiters[prompt_id] = entry
+        return future
+
+    def unregister(self, prompt_id):
+        with self._lock:
+            self._waiters.pop(prompt_id, None)
+
+    def progress(self):
+        """各进行中 prompt 的当前节点与节点进度"""
+        with self._lock:
+            return {
+                prompt_id: {'node': waiter['node'], 'progress': dict(waiter['progress'])}
+                for prompt_id, waiter in self._waiters.items()
+            }
+
+comfyui_event_clients_lock = threading.Lock()
+comfyui_event_clients = {}  # server -> ComfyUIEventClient
+
+def get_comfyui_event_client(server, settings):
+    """获取服务器对应的事件客户端；未启用 use_websocket 时返回 None"""
+    if not settings.get('use_websocket', True):
+        return None
+    with comfyui_event_clients_lock:
+        client = comfyui_event_clients.get(server)
+        if client is None:
+            client = comfyui_event_clients[server] = ComfyUIEventClient(server)
+    # 首次使用时给连接建立留出一点时间，连不上则本次走轮询
+    if not client.connected:
+        client.wait_connected(2)
+    return client if client.connected else None
+
+def wait_comfyui_outputs(server, prompt_id, settings, event_client=None):
+    """等待 prompt 完成并返回 outputs：优先使用事件推送，连接断开或输出缺失时回退为轮询 /history"""
+    if event_client is None:
+        return poll_comfyui_history(server, prompt_id, settings)
+
+    timeout = settings.get('timeout_seconds', 180)
+    deadline = time.time() + timeout
+    future = event_client.register(prompt_id)
+    try:
+        while time.time() < deadline:
+            try:
+                outputs = future.result(timeout=min(5, max(0.1, deadline - time.time())))
+            except FutureTimeoutError:
+                if not event_client.connected:
+                    print("ComfyUI 事件连接已断开，改为轮询 /history")
+                    break
+                continue
+            if outputs:
+                return outputs
+            # 输出节点命中缓存时不会推送 executed，需从 history 读取
+            break
+    finally:
+        event_client.unregister(prompt_id)
+
+    remaining = dict(settings, timeout_seconds=max(10, int(deadline - time.time())))
+    return poll_comfyui_history(server, prompt_id, remaining)
+
+def get_comfyui_progress():
+    """汇总所有 ComfyUI 服务器上进行中 prompt 的节点进度"""
+    with comfyui_event_clients_lock:
+        clients = list(comfyui_event_clients.values())
+    with comfyui_pipelines_lock:
+        pipelines = dict(comfyui_pipelines)
+    servers = {
+        client.server: {'connected': client.connected, 'prompts': client.progress()}
+        for client in clients
+    }
+    for server, pipeline in pipelines.items():
+        servers.setdefault(server, {'connected': False, 'prompts': {}})['pipeline'] = pipeline.snapshot()
+    return servers
+
+# 各 ComfyUI 服务器的健康与负载状态：url -> {healthy, remote_queue, vram_free, probed_at, ...}
+comfyui_backend_lock = threading.Lock()
+comfyui_backend_state = {}
+
+def _get_backend_state(url):
+    return comfyui_backend_state.setdefault(url, {
+        'healthy': True, 'unhealthy_until': 0.0, 'remote_queue': 0, 'vram_free': None,
+        'probed_at': 0.0, 'failures': 0, 'completed': 0
+    })
+
+def probe_comfyui_backend(url, settings):
+    """探测服务器 /queue 与 /system_stats，结果缓存 probe_interval 秒"""
+    with comfyui_backend_lock:
+        state = _get_backend_state(url)
+        if time.time() - state['probed_at'] < settings['probe_interval']:
+            return dict(state)
+        state['probed_at'] = time.time()
+    try:
+        queue_resp = http_get(f'{url}/queue', timeout=(2, 3))
+        # 旧版本或经过代理时可能没有 /queue，此时只确认服务可连通，远端队列按 0 计
+        queue_data = queue_resp.json() if queue_resp.ok else {}
+        remote_queue = len(queue_data.get('queue_running') or []) + len(queue_data.get('queue_pending') or [])
+        vram_free = None
+        try:
+            stats_resp = http_get(f'{url}/system_stats', timeout=(2, 3))
+            if stats_resp.ok:
+                devices = (stats_resp.json() or {}).get('devices') or []
+                vram_free = sum(device.get('vram_free') or 0 for device in devices) or None
+        except requests.RequestException:
+            pass
+        with comfyui_backend_lock:
+            state.update(healthy=True, unhealthy_until=0.0, remote_queue=remote_queue, vram_free=vram_free)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        mark_comfyui_backend_failure(url, settings, e)
+    except ValueError:
+        pass
+    with comfyui_backend_lock:
+        return dict(state)
+
+def mark_comfyui_backend_failure(url, settings, error=None):
+    """记录服务器失败；在冷却时间内不再分配新任务"""
+    with comfyui_backend_lock:
+        state = _get_backend_state(url)
+        state['failures'] += 1
+        state['healthy'] = False
+        state['unhealthy_until'] = time.time() + settings['unhealthy_cooldown']
+    print(f"ComfyUI 服务器 {url} 标记为不可用 {settings['unhealthy_cooldown']} 秒: {error}")
+
+def mark_comfyui_backend_success(url):
+    with comfyui_backend_lock:
+        state = _get_backend_state(url)
+        state.update(healthy=True, unhealthy_until=0.0)
+        state['completed'] += 1
+
+def select_comfyui_backend(settings, exclude=()):
+    """选择负载最低的健康服务器
+
+    负载 = (本进程在该服务器上进行中与排队的请求 + 其他客户端占用的远端队列) / weight。
+    exclude 为本次生成已失败过的服务器，用于在 max_attempts 内切换到其他节点。
+    """
+    candidates = [server for server in settings['servers'] if server['enabled']] or settings['servers']
+    preferred = [server for server in candidates if server['url'] not in exclude] or candidates
+    now = time.time()
+    scored = []
+    for server in preferred:
+        state = probe_comfyui_backend(server['url'], settings)
+        healthy = state['healthy'] or now >= state['unhealthy_until']
+        local_load = 0
+        with comfyui_pipelines_lock:
+            pipeline = comfyui_pipelines.get(server['url'])
+        if pipeline is not None:
+            snapshot = pipeline.snapshot()
+            local_load = snapshot['in_flight'] + snapshot['pending']
+        # 远端队列中包含本进程提交的 prompt，只把超出的部分算作外部负载
+        external_load = max(0, state['remote_queue'] - local_load)
+        load = (local_load + external_load) / server['weight']
+        scored.append((not healthy, load, random.random(), server))
+    # 全部不健康时仍选择负载最低的一台，避免直接放弃
+    scored.sort(key=lambda item: item[:3])
+    return scored[0][3]
+
+def get_comfyui_backend_status(settings):
+    """各服务器的配置、健康状态与负载"""
+    with comfyui_pipelines_lock:
+        pipelines = dict(comfyui_pipelines)
+    status = []
+    for server in settings['servers']:
+        with comfyui_backend_lock:
+            state = dict(_get_backend_state(server['url']))
+        pipeline = pipelines.get(server['url'])
+        status.append(dict(server, **state, pipeline=pipeline.snapshot() if pipeline else None))
+    return status
+
+class ComfyUIPipeline:
+    """单个 ComfyUI 服务器的流水线调度
+
+    调用方提交提示词后等待 Future；分发线程在服务器端进行中的 prompt 少于 queue_size 时
+    立即提交下一个，结果按 prompt_id 分发回各自的 Future。进行中的名额在拿到输出时即释放，
+    下载图片与下一张图的渲染并行。开启 batch_size 时，提示词相同的请求合并为一个 workflow。
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self.in_flight = 0
+        self.queue_size = 1
+        self.stats = {'submitted_prompts': 0, 'batched_requests': 0, 'completed': 0, 'failed': 0}
+        threading.Thread(target=self._dispatch_loop, daemon=True, name=f'comfyui-dispatch-{urlsplit(server).netloc}').start()
+
+    def submit(self, prompts, settings):
+        """排队一次生成，返回 Future，结果为 (prompt_id, image_meta)"""
+        job = {'prompts': prompts, 'settings': settings, 'future': Future(), 'queued_at': time.time()}
+        with self._cond:
+            self.queue_size = settings['queue_size']
+            self._pending.append(job)
+            self._cond.notify_all()
+        return job['future']
+
+    def _batch_key(self, job):
+        return (job['prompts'].get('positive_prompt'), job['prompts'].get('negative_prompt'), job['settings'].get('workflow_path'))
+
+    def _take_group(self):
+        """取出下一组待提交的请求（调用时持有锁）；已取消的请求直接丢弃"""
+        while self._pending:
+            job = self._pending.popleft()
+            if job['future'].set_running_or_notify_cancel():
+                break
+        else:
+            return []
+        group = [job]
+        batch_size = job['settings']['batch_size']
+        if batch_size > 1 and not self._supports_batch(job['settings']):
+            batch_size = 1
+        if batch_size > 1:
+            deadline = job['queued_at'] + job['settings']['batch_window_ms'] / 1000.0
+            key = self._batch_key(job)
+            while True:
+                for other in list(self._pending):
+                    if len(group) >= batch_size:
+                        break
+                    if self._batch_key(other) == key:
+                        self._pending.remove(other)
+                        if other['future'].set_running_or_notify_cancel():
+                            group.append(other)
+                remaining = deadline - time.time()
+                if len(group) >= batch_size or remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+        return group
+
+    def _supports_batch(self, settings):
+        try:
+            return comfyui_workflow_supports_batch(settings)
+        except Exception:
+            return False
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending or self.in_flight >= self.queue_size:
+                    self._cond.wait()
+                group = self._take_group()
+                if not group:
+                    continue
+                self.in_flight += 1
+            threading.Thread(target=self._run_group, args=(group,), daemon=True).start()
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _run_group(self, group):
+        settings = group[0]['settings']
+        released = False
+        try:
+            batch_size = len(group)
+            payload = build_comfyui_workflow_payload(group[0]['prompts'], settings, batch_size)
+            event_client = get_comfyui_event_client(self.server, settings)
+            server, prompt_id = submit_comfyui_prompt(payload, dict(settings, server_url=self.server),
+                                                      event_client.client_id if event_client else None)
+            with self._cond:
+                self.stats['submitted_prompts'] += 1
+                self.stats['batched_requests'] += batch_size if batch_size > 1 else 0
+            outputs = wait_comfyui_outputs(server, prompt_id, settings, event_client)
+            self._release()
+            released = True
+
+            image_metas = _extract_comfyui_images(outputs)
+            for index, job in enumerate(group):
+                if index < len(image_metas):
+                    job['future'].set_result((prompt_id, image_metas[index]))
+                else:
+                    job['future'].set_exception(Exception('未在 ComfyUI 输出中找到图片节点'))
+            with self._cond:
+                self.stats['completed'] += 1
+        except Exception as exc:
+            for job in group:
+                if not job['future'].done():
+                    job['future'].set_exception(exc)
+            with self._cond:
+                self.stats['failed'] += 1
+        finally:
+            if not released:
+                self._release()
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, in_flight=self.in_flight, pending=len(self._pending), queue_size=self.queue_size)
+
+comfyui_pipelines_lock = threading.Lock()
+comfyui_pipelines = {}  # server -> ComfyUIPipeline
+
+def get_comfyui_pipeline(server):
+    with comfyui_pipelines_lock:
+        pipeline = comfyui_pipelines.get(server)
+        if pipeline is None:
+            pipeline = comfyui_pipelines[server] = ComfyUIPipeline(server)
+        return pipeline
+
+def _extract_comfyui_images(outputs):
+    """从 ComfyUI outputs 中按节点顺序取出所有图片信息 {filename, subfolder, type}"""
+    if isinstance(outputs, list):
+        outputs = {str(index): value for index, value in enumerate(outputs)}
+    elif isinstance(outputs, str):
+        try:
+            parsed_outputs = json.loads(outputs)
+            if isinstance(parsed_outputs, dict):
+                outputs = parsed_outputs
+            elif isinstance(parsed_outputs, list):
+                outputs = {str(index): value for index, value in enumerate(parsed_outputs)}
+            else:
+                raise ValueError('Unsupported outputs structure')
+        except json.JSONDecodeError:
+            raise ValueError('ComfyUI 返回的 outputs 结构无法解析')
+    elif not isinstance(outputs, dict):
+        raise ValueError('ComfyUI 返回的 outputs 结构不支持')
+
+    image_metas = []
+    for node_output in outputs.values():
+        images = []
+        if isinstance(node_output, dict):
+            images = node_output.get('images') or []
+        elif isinstance(node_output, list):
+            images = node_output
+        elif isinstance(node_output, str):
+            try:
+                possible = json.loads(node_output)
+                if isinstance(possible, dict):
+                    images = possible.get('images') or []
+                elif isinstance(possible, list):
+                    images = possible
+            except json.JSONDecodeError:
+                images = []
+        image_metas.extend(image_meta for image_meta in images if isinstance(image_meta, dict))
+    return image_metas
+
+def download_comfyui_image(server, image_meta, output_dir, topic_slug, settings, config=None, use_store=False):
+    """下载 ComfyUI 输出图片
+
+    use_store 且图片仓库开启时存入仓库并标记为永久保留（/view 的文件名会被 ComfyUI 复用，不记录 URL 索引）；
+    否则按 comfyui_<主题>_<时间>.<扩展名> 保存到 output_dir。
+    """
     filename = image_meta.get('filename')
     subfolder = image_meta.get('subfolder', '')
     image_type = image_meta.get('type', 'output')
@@ -2251,10 +6593,9 @@ def download_comfyui_image(server, image_meta, output_dir, topic_slug, settings)
         'subfolder': subfolder,
         'type': image_type
     }
-    view_resp = requests.get(f'{server}/view', params=params, timeout=30)
-    view_resp.raise_for_status()
+    if use_store and image_store_runtime['settings']['enabled']:
+        return fetch_image_to_store(f'{server}/view', config=config, index_url=False, keep=True, params=params, timeout=30)
 
-    os.makedirs(output_dir, exist_ok=True)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     _, original_ext = os.path.splitext(filename)
     ext = settings.get('output_format') or original_ext.lstrip('.')
@@ -2262,12 +6603,11 @@ def download_comfyui_image(server, image_meta, output_dir, topic_slug, settings)
         ext = 'png'
     ext = ext.replace('.', '')
     safe_topic = re.sub(r'[^a-zA-Z0-9_-]+', '_', topic_slug)[:40] or 'topic'
-    local_filename = f'comfyui_{safe_topic}_{timestamp}.{ext}'
+    # 多张图片可能在同一秒内并行下载，文件名附加随机后缀避免互相覆盖
+    local_filename = f'comfyui_{safe_topic}_{timestamp}_{uuid.uuid4().hex[:6]}.{ext}'
     local_path = os.path.join(output_dir, local_filename)
 
-    with open(local_path, 'wb') as f:
-        f.write(view_resp.content)
-
+    download_image_to_file(f'{server}/view', target_path=local_path, config=config or load_config(), params=params, timeout=30)
     return local_path
 
 def generate_image_with_comfyui(topic, prompts, blueprint, config, settings_override=None, semaphore_override=None, test_mode=False):
@@ -2278,12 +6618,19 @@ def generate_image_with_comfyui(topic, prompts, blueprint, config, settings_over
     settings = settings_override or get_comfyui_settings(config)
     if not settings.get('enabled', True):
         return None, {}
-
-    semaphore = semaphore_override or comfyui_runtime['semaphore']
-    acquired = semaphore.acquire(timeout=settings.get('timeout_seconds', 180))
-    if not acquired:
-        print("ComfyUI 队列繁忙，放弃生成")
-        return None, {}
+    if test_mode:
+        # 测试工作流时只使用表单中填写的服务器地址
+        settings = dict(settings, servers=get_comfyui_servers(dict(settings, servers=[])))
+
+    # 流水线模式由 ComfyUIPipeline 控制服务器端的进行中数量；测试工作流时仍走独立的信号量
+    pipelined = settings.get('pipeline', True) and semaphore_override is None and not test_mode
+    semaphore = None
+    if not pipelined:
+        semaphore = semaphore_override or comfyui_runtime['semaphore']
+        acquired = semaphore.acquire(timeout=settings.get('timeout_seconds', 180))
+        if not acquired:
+            print("ComfyUI 队列繁忙，放弃生成")
+            return None, {}
 
     base_prompts = prompts or {}
     styled_prompts = apply_style_to_prompts(base_prompts, config)
@@ -2295,70 +6642,70 @@ def generate_image_with_comfyui(topic, prompts, blueprint, config, settings_over
         'negative_prompt': styled_prompts.get('negative_prompt')
     }
 
+    tried_servers = set()
     try:
         attempts = settings.get('max_attempts', 2)
         for attempt in range(1, attempts + 1):
+            backend = None
             try:
-                payload = build_comfyui_workflow_payload(styled_prompts, settings)
-                server, prompt_id = submit_comfyui_prompt(payload, settings)
-                outputs = poll_comfyui_history(server, prompt_id, settings)
-
-                if isinstance(outputs, list):
-                    outputs = {str(index): value for index, value in enumerate(outputs)}
-                elif isinstance(outputs, str):
+                backend = select_comfyui_backend(settings, exclude=tried_servers)
+                server = backend['url']
+                tried_servers.add(server)
+                backend_settings = dict(settings, server_url=server, queue_size=backend['queue_size'])
+                if pipelined:
+                    future = get_comfyui_pipeline(server).submit(styled_prompts, backend_settings)
                     try:
-                        parsed_outputs = json.loads(outputs)
-                        if isinstance(parsed_outputs, dict):
-                            outputs = parsed_outputs
-                        elif isinstance(parsed_outputs, list):
-                            outputs = {str(index): value for index, value in enumerate(parsed_outputs)}
-                        else:
-                            raise ValueError('Unsupported outputs structure')
-                    except json.JSONDecodeError:
-                        raise ValueError('ComfyUI 返回的 outputs 结构无法解析')
-                elif not isinstance(outputs, dict):
-                    raise ValueError('ComfyUI 返回的 outputs 结构不支持')
+                        # 排队等待 + 渲染，给出两倍超时
+                        prompt_id, image_meta = future.result(timeout=settings.get('timeout_seconds', 180) * 2)
+                    except FutureTimeoutError:
+                        future.cancel()
+                        raise TimeoutError('等待 ComfyUI 生成图片超时')
+                    image_metas = [image_meta]
+                else:
+                    payload = build_comfyui_workflow_payload(styled_prompts, backend_settings)
+                    event_client = get_comfyui_event_client(server, backend_settings)
+                    server, prompt_id = submit_comfyui_prompt(payload, backend_settings, event_client.client_id if event_client else None)
+                    outputs = wait_comfyui_outputs(server, prompt_id, backend_settings, event_client)
+                    image_metas = _extract_comfyui_images(outputs)
 
                 image_path = None
-                for node_output in outputs.values():
-                    images = []
-                    if isinstance(node_output, dict):
-                        images = node_output.get('images') or []
-                    elif isinstance(node_output, list):
-                        images = node_output
-                    elif isinstance(node_output, str):
-                        try:
-                            possible = json.loads(node_output)
-                            if isinstance(possible, dict):
-                                images = possible.get('images') or []
-                            elif isinstance(possible, list):
-                                images = possible
-                        except json.JSONDecodeError:
-                            images = []
-
-                    for image_meta in images:
-                        output_dir = os.path.join(config.get('output_directory', 'output'), 'comfyui_images')
-                        image_path = download_comfyui_image(server, image_meta, output_dir, topic, settings)
-                        if image_path:
-                            metadata['comfyui'] = {
-                                'prompt_id': prompt_id,
-                                'node': image_meta.get('type'),
-                                'filename': os.path.basename(image_path),
-                                'attempt': attempt
-                            }
-                            return image_path, metadata
+                for image_meta in image_metas:
+                    output_dir = os.path.join(config.get('output_directory', 'output'), 'comfyui_images')
+                    # 文章配图进入图片仓库随文档引用释放；测试生成的图片留在输出目录供查看
+                    image_path = download_comfyui_image(
+                        server, image_meta, output_dir, topic, settings, config=config, use_store=not test_mode
+                    )
+                    if image_path:
+                        mark_comfyui_backend_success(server)
+                        metadata['comfyui'] = {
+                            'server': server,
+                            'prompt_id': prompt_id,
+                            'node': image_meta.get('type'),
+                            'filename': os.path.basename(image_path),
+                            'attempt': attempt
+                        }
+                        return image_path, metadata
 
                 raise Exception('未在 ComfyUI 输出中找到图片节点')
 
             except Exception as e:
                 print(f"ComfyUI 生成失败（第 {attempt} 次）: {e}")
                 metadata.setdefault('errors', []).append(str(e))
-                time.sleep(3)
+                # 连接类错误说明节点不可用，暂停分配；下次尝试换到其他节点
+                if isinstance(e, (requests.ConnectionError, requests.Timeout, TimeoutError)):
+                    if backend:
+                        mark_comfyui_backend_failure(backend['url'], settings, e)
+                    # 只有一个节点时重试只会再等一轮超时，交给熔断器决定何时再试
+                    if len(settings['servers']) <= 1:
+                        break
+                elif len(settings['servers']) <= 1:
+                    time.sleep(3)
 
         return None, metadata
 
     finally:
-        semaphore.release()
+        if semaphore:
+            semaphore.release()
 
 def find_available_port(start_port=5000, max_attempts=10):
     """查找可用端口，从start_port开始尝试"""
@@ -54,7 +54,7 @@ function savePageState() {
             filename: imageData.filename,
             uploadedPath: imageData.uploadedPath,
             url: imageData.url,
-            preview: imageData.preview // URL 类型的 preview 可以保存
+            preview: imageData.preview // 图片 URL 或上传后的缩略图地址，体积很小可以保存
         };
     });
 
@@ -235,6 +235,10 @@ clearBtn.addEventListener('click', () => {
 
 let currentTaskId = null;
 let statusInterval = null;
+// 本地累积的任务状态，轮询时只拉取 version 之后的增量
+let taskState = null;
+// SSE 事件流；浏览器不支持或连接失败时退回轮询
+let taskEventSource = null;
 
 // 保存任务进度到localStorage
 function saveTaskProgress() {
@@ -257,9 +261,23 @@ async function restoreTaskProgress() {
             const taskId = taskData.taskId;
 
             // 检查任务是否仍然存在
-            const response = await fetch(`/api/generate/status/${taskId}`);
+            const response = await fetch(`/api/generate/status/${taskId}?mode=compact`);
             if (response.ok) {
                 const task = await response.json();
+                task.task_id = taskId;
+                taskState = task;
+
+                // 任务因服务重启而中断，继续生成未完成的主题
+                if (task.status === 'interrupted') {
+                    const resumeResponse = await fetch('/api/generate/resume', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ task_id: taskId })
+                    });
+                    if (resumeResponse.ok) {
+                        task.status = 'running';
+                    }
+                }
 
                 // 如果任务未完成，恢复轮询
                 if (task.status === 'running') {
@@ -269,8 +287,8 @@ async function restoreTaskProgress() {
                     generateBtn.disabled = true;
                     generateBtn.textContent = '生成中...';
 
-                    startPolling(taskId);
                     updateUI(task);
+                    watchTask(taskId);
                 } else if (task.status === 'completed') {
                     // 任务已完成，显示结果
                     progressArea.style.display = 'block';
@@ -368,7 +386,7 @@ generateBtn.addEventListener('click', async () => {
             const data = await response.json();
             currentTaskId = data.task_id;
             saveTaskProgress(); // 保存任务ID
-            startPolling(currentTaskId);
+            watchTask(currentTaskId);
         } else {
             const error = await response.json();
             alert('启动生成任务失败: ' + error.error);
@@ -381,7 +399,130 @@ generateBtn.addEventListener('click', async () => {
 });
 
 
+// 将增量状态合并进本地任务状态
+function applyTaskDelta(delta) {
+    if (!taskState || !delta.incremental) {
+        taskState = delta;
+        return taskState;
+    }
+    // 重新排队或已产生新结果的主题，移除其旧的错误记录
+    const changedTopics = new Set([
+        ...delta.retrying,
+        ...delta.results.map(result => result.topic),
+        ...delta.errors.map(error => error.topic)
+    ]);
+    taskState = {
+        ...delta,
+        results: taskState.results.concat(delta.results),
+        errors: taskState.errors.filter(error => !changedTopics.has(error.topic)).concat(delta.errors)
+    };
+    return taskState;
+}
+
+// 订阅任务进度：优先使用 SSE 推送，不可用时退回定时轮询
+function watchTask(taskId) {
+    stopWatching();
+    if (!window.EventSource) {
+        startPolling(taskId);
+        return;
+    }
+
+    const source = new EventSource(`/api/generate/events/${taskId}`);
+    taskEventSource = source;
+
+    const handle = (type, handler) => {
+        source.addEventListener(type, (event) => {
+            // 连接错误等浏览器自身事件不带 data
+            if (!event.data) {
+                return;
+            }
+            handler(JSON.parse(event.data));
+            if (taskState) {
+                updateUI(taskState);
+            }
+        });
+    };
+
+    handle('snapshot', (snapshot) => {
+        taskState = { ...snapshot, task_id: taskId };
+        if (snapshot.status === 'completed') {
+            finishTask();
+        }
+    });
+    handle('started', (data) => {
+        taskState.status = 'running';
+        taskState.errors = taskState.errors.filter(error => error.topic !== data.topic);
+    });
+    handle('writing', (data) => {
+        taskState.topic_progress = { ...taskState.topic_progress, [data.topic]: data };
+    });
+    handle('article-done', (data) => {
+        const progress = taskState.topic_progress[data.topic] || {};
+        taskState.topic_progress = {
+            ...taskState.topic_progress,
+            [data.topic]: { ...progress, chars: data.chars, images_done: 0 }
+        };
+    });
+    handle('image-done', (data) => {
+        const progress = taskState.topic_progress[data.topic];
+        if (progress && data.success) {
+            progress.images_done = (progress.images_done || 0) + 1;
+        }
+    });
+    handle('docx-done', (result) => {
+        delete taskState.topic_progress[result.topic];
+        taskState.results = taskState.results.filter(item => item.topic !== result.topic).concat(result);
+        updateTaskProgress();
+    });
+    handle('topic-error', (error) => {
+        delete taskState.topic_progress[error.topic];
+        taskState.errors = taskState.errors.filter(item => item.topic !== error.topic).concat(error);
+        updateTaskProgress();
+    });
+    handle('task-completed', () => {
+        taskState.status = 'completed';
+        finishTask();
+    });
+
+    source.onerror = () => {
+        // 连接关闭（如服务不支持或代理拦截）时退回轮询；仅暂时断开时由浏览器自动重连
+        if (source.readyState === EventSource.CLOSED && taskEventSource === source) {
+            taskEventSource = null;
+            startPolling(taskId);
+        }
+    };
+}
+
+function stopWatching() {
+    if (taskEventSource) {
+        taskEventSource.close();
+        taskEventSource = null;
+    }
+    if (statusInterval) {
+        clearInterval(statusInterval);
+        statusInterval = null;
+    }
+}
+
+function updateTaskProgress() {
+    const completedCount = taskState.results.length + taskState.errors.length;
+    taskState.progress = taskState.total > 0 ? (completedCount / taskState.total) * 100 : 0;
+}
+
+// 任务全部完成后的收尾
+function finishTask() {
+    stopWatching();
+    progressText.textContent = '全部任务已完成！';
+    generateBtn.disabled = false;
+    generateBtn.textContent = '开始生成';
+    clearTaskProgress(); // 清除保存的任务进度
+}
+
 function startPolling(taskId) {
+    if (!taskState || taskState.task_id !== taskId) {
+        taskState = null;
+    }
+
     // 立即执行一次，避免延迟
     pollStatus(taskId);
 
@@ -393,18 +534,15 @@ function startPolling(taskId) {
 
 async function pollStatus(taskId) {
     try {
-        const response = await fetch(`/api/generate/status/${taskId}`);
+        const query = taskState ? `since=${taskState.version}&mode=compact` : 'mode=compact';
+        const response = await fetch(`/api/generate/status/${taskId}?${query}`);
         if (response.ok) {
-            const task = await response.json();
+            const task = applyTaskDelta(await response.json());
+            task.task_id = taskId;
             updateUI(task);
 
             if (task.status === 'completed') {
-                clearInterval(statusInterval);
-                statusInterval = null;
-                progressText.textContent = '全部任务已完成！';
-                generateBtn.disabled = false;
-                generateBtn.textContent = '开始生成';
-                clearTaskProgress(); // 清除保存的任务进度
+                finishTask();
             }
         } else if (response.status === 404) {
             // 任务可能已因服务器重启而丢失
@@ -450,6 +588,20 @@ function updateUI(task) {
         resultsList.appendChild(resultItem);
     });
 
+    // 显示正在流式生成的主题
+    Object.entries(task.topic_progress || {}).forEach(([topic, progress]) => {
+        const resultItem = document.createElement('div');
+        resultItem.className = 'result-item';
+        const info = progress.images_done !== undefined
+            ? `文章已完成 (${progress.chars} 字)，正在配图... 已完成 ${progress.images_done} 张`
+            : `正在写作... 已生成 ${progress.chars} 字 (${progress.output_tokens} tokens)`;
+        resultItem.innerHTML = `
+            <div class="result-title">✎ ${topic}</div>
+            <div class="result-info">${info}</div>
+        `;
+        resultsList.appendChild(resultItem);
+    });
+
     // 显示失败结果
     task.errors.forEach(error => {
         const resultItem = document.createElement('div');
@@ -473,10 +625,7 @@ function resetUI() {
     progressArea.style.display = 'none';
     generateBtn.disabled = false;
     generateBtn.textContent = '开始生成';
-    if (statusInterval) {
-        clearInterval(statusInterval);
-        statusInterval = null;
-    }
+    stopWatching();
 }
 
 // 事件委托：处理重试和放弃按钮的点击
@@ -504,11 +653,9 @@ resultsList.addEventListener('click', async (event) => {
                     generateBtn.textContent = '生成中...';
                     progressText.textContent = '任务已重新提交，正在更新状态...';
 
-                    // 停止任何现有的轮询并重新启动，以获取最新状态
-                    if (statusInterval) {
-                        clearInterval(statusInterval);
-                    }
-                    startPolling(currentTaskId);
+                    // 停止任何现有的轮询或事件流并重新订阅，以获取最新状态
+                    stopWatching();
+                    watchTask(currentTaskId);
 
                     // 让新的轮询来更新UI，而不是手动移除元素
                 } else {
@@ -834,6 +981,10 @@ saveImageBtn.addEventListener('click', async () => {
                 const data = await response.json();
                 currentImageData.uploadedPath = data.path;
                 currentImageData.filename = data.filename;
+                // 预览改用服务器缩略图，避免把整张图片的 data URL 存进 localStorage
+                if (data.thumbnail_url) {
+                    currentImageData.preview = data.thumbnail_url;
+                }
 
                 // 保存到 topicImages
                 topicImages.set(currentTopicIndex, currentImageData);